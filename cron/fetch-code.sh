@@ -41,6 +41,8 @@ if ( set -o noclobber; echo "$$" > "$lockfile") 2> /dev/null; then
             else
                 $BIN/bitbucket-backup/backup.py $BB_USE_HTTP -u $BB_USER -l $BITBUCKET/$BBO -p $BB_PW -t $BBO -v 2>&1
             fi
+            # so searches don't have to look up their type and default branch
+            $BIN/github_backup.py record -d $BITBUCKET/$BBO -m $REPOS/.repo-metadata.json 2>&1
         done
 
     fi
@@ -52,12 +54,17 @@ if ( set -o noclobber; echo "$$" > "$lockfile") 2> /dev/null; then
         IFS=',' read -ra ADDR <<< "$GH_ORGS"
         for GHO in "${ADDR[@]}"; do
             echo "fetching for org $GHO..."
-            $BIN/github_backup.py https -u $GH_USER -p $GH_PW -o $GHO -d $GITHUB/$GHO 2>&1
+            $BIN/github_backup.py https -u $GH_USER -p $GH_PW -o $GHO -d $GITHUB/$GHO -m $REPOS/.repo-metadata.json -s $GITHUB/$GHO/.github-state.json --clone-mode shallow --prune 2>&1
         done
 
 
     fi
 
+    # extend the commit message index with what was just fetched. the
+    # history of shallow clones is fetched into mirrors under .commits
+    log "Indexing commit messages..."
+    $BIN/build_commit_index.py --code-root $REPOS --commit-dir $REPOS/.commits --cindex $BIN/codesearch-0.01/cindex 2>&1
+
     log "Finished."
 
     # clean up after yourself, and release your trap
@@ -23,8 +23,16 @@ if ( set -o noclobber; echo "$$" > "$lockfile") 2> /dev/null; then
     log "Starting indexing all repositories..."
     cd $REPOS
 
-    # index everything at once or else index can get borked
-    $BIN/codesearch-0.01/cindex $REPOS
+    # one index shard per org, built in parallel across all cores. only the
+    # shards with repositories that changed since the last run are rebuilt,
+    # into a new generation that searches switch to once it's complete
+    $BIN/build_index.py --code-root $REPOS --shard-dir $REPOS/.shards --cindex $BIN/codesearch-0.01/cindex --metadata $REPOS/.repo-metadata.json
+
+    # read the new generation into the page cache and replay the most popular
+    # searches against it, at idle priority, before users search it cold. the
+    # replayed results land in the search cache on the repos volume, which
+    # the webapp's container reads too (see the Dockerfile)
+    /venv/bin/python /code/manage.py warmup
 
     log "Finished."
     # clean up after yourself, and release your trap
@@ -0,0 +1,386 @@
+#!/venv/bin/python3
+"""
+Builds the index of commit messages the webapp's commit search reads, for
+every git repository under a code root (laid out as vcs_loc/org/repo).
+
+Each repository's history is written to commit-dir/logs/vcs_loc/org/repo/,
+one commit per line: its SHA, author date, author and message, tab separated,
+with the message's newlines replaced by LINE_SEPARATOR. cindex leaves out
+files with lines of 2000 bytes or more or with more than 20000 distinct
+trigrams, so lines are cut at MAX_LINE_BYTES and the lines are spread over
+numbered chunk files of at most MAX_CHUNK_TRIGRAMS trigrams each.
+
+The logs are extended incrementally: commit-dir/state.json records the
+commit each log was last written up to, and only the commits since then are
+appended to its last chunk (or new ones). A log is rewritten from scratch
+when its repository's history was rewritten (the last indexed commit is no
+longer an ancestor of HEAD) or grew backwards (a shallow clone got its
+history fetched).
+
+Each org's logs are indexed by cindex into a shard of their own,
+commit-dir/shards/vcs_loc/org.index, written next to the old one and
+renamed over it once it's complete, so the webapp searches them with
+csearch just like code. cindex reads every file it indexes again, so only
+the shards of the orgs whose logs changed are rebuilt.
+
+A shallow clone (github_backup.py's default) only has its last commits, so
+the history of one is read from a mirror of the same remote instead, kept
+in commit-dir/history/vcs_loc/org/repo.git: a bare, blobless clone of the
+checkout's branch, which has every commit but no file contents, and is
+fetched before each run. The checkouts stay as they are, and other clones
+are read directly.
+"""
+
+import sentry_sdk
+sentry_sdk.init()
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datadog import initialize, statsd
+
+LOGS = 'logs'
+HISTORY = 'history'
+LOG_SUFFIX = '.log'
+CHUNK_FORMAT = '%06d' + LOG_SUFFIX
+STATE_FILE = 'state.json'
+SHARDS = 'shards'
+SHARD_SUFFIX = '.index'
+# the single index of every log, before there were shards
+OLD_INDEX_FILE = 'commits.index'
+# the end of every complete index cindex writes
+INDEX_TRAILER = b'\ncsearch trailr\n'
+# stands in for the newlines of commit messages, so each commit is one line
+LINE_SEPARATOR = '\x1e'
+# %x00 ends each commit, since messages can hold anything but NUL
+LOG_FORMAT = '%H%x09%aI%x09%an <%ae>%x09%B%x00'
+# below cindex's limits of 2000 bytes per line and 20000 trigrams per file
+MAX_LINE_BYTES = 1000
+MAX_CHUNK_TRIGRAMS = 15000
+# seconds a git command may take, mirrors are cloned and fetched over the network
+GIT_TIMEOUT = 10 * 60
+
+initialize()
+
+
+def list_dirs(dirname):
+    # .tmp directories are clones still in progress, see github_backup.py
+    return sorted(d for d in os.listdir(dirname)
+                  if not d.startswith('.') and not d.endswith('.tmp') and os.path.isdir(os.path.join(dirname, d)))
+
+
+def find_repos(code_root):
+    """
+    Returns the git repositories under code_root, keyed by their path
+    relative to it (vcs_loc/org/repo).
+    """
+    repos = {}
+    for vcs_loc in list_dirs(code_root):
+        for org in list_dirs(os.path.join(code_root, vcs_loc)):
+            org_dir = os.path.join(code_root, vcs_loc, org)
+            for repo in list_dirs(org_dir):
+                repo_dir = os.path.join(org_dir, repo)
+                if os.path.exists(os.path.join(repo_dir, '.git')):
+                    repos['%s/%s/%s' % (vcs_loc, org, repo)] = repo_dir
+    return repos
+
+
+def git(repo_dir, *args):
+    return subprocess.check_output(['git', '-C', repo_dir] + list(args), stderr=subprocess.PIPE, encoding='UTF-8',
+                                   errors='replace', timeout=GIT_TIMEOUT)
+
+
+def is_shallow(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, '.git', 'shallow'))
+
+
+def history_dir(commit_dir, key):
+    return os.path.join(commit_dir, HISTORY, key + '.git')
+
+
+def history_repo(commit_dir, key, repo_dir):
+    """
+    Returns the repository to read the history of a checkout from: the
+    checkout itself, or for a shallow clone its mirror, cloned or fetched up
+    to the checkout's branch first.
+    """
+    if not is_shallow(repo_dir):
+        return repo_dir
+    mirror = history_dir(commit_dir, key)
+    url = git(repo_dir, 'remote', 'get-url', 'origin').strip()
+    branch = git(repo_dir, 'symbolic-ref', '--short', 'HEAD').strip()
+    try:
+        if not os.path.isdir(mirror):
+            tmp = mirror + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+            git(os.path.dirname(mirror), 'clone', '--quiet', '--bare', '--filter=blob:none', '--no-tags',
+                '--single-branch', '--branch', branch, url, tmp)
+            os.rename(tmp, mirror)
+        else:
+            # the url changes with the credentials in it
+            git(mirror, 'remote', 'set-url', 'origin', url)
+            git(mirror, 'fetch', '--quiet', '--no-tags', 'origin', '+refs/heads/%s:refs/heads/%s' % (branch, branch))
+            git(mirror, 'symbolic-ref', 'HEAD', 'refs/heads/' + branch)
+    except subprocess.CalledProcessError as e:
+        # the command has the url, and so maybe credentials, in it
+        raise ValueError('unable to fetch the history of %s: %s' % (key, e.stderr.strip())) from None
+    return mirror
+
+
+def remove_history(commit_dir, key):
+    shutil.rmtree(history_dir(commit_dir, key), ignore_errors=True)
+
+
+def is_ancestor(repo_dir, commit, head):
+    return subprocess.call(['git', '-C', repo_dir, 'merge-base', '--is-ancestor', commit, head],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def log_lines(repo_dir, revisions):
+    """
+    Returns the commits of revisions (git log arguments) as log lines,
+    newest first.
+    """
+    output = git(repo_dir, 'log', '--format=' + LOG_FORMAT, *revisions)
+    return [log_line(entry) for entry in output.split('\x00') if entry.strip()]
+
+
+def log_line(entry):
+    sha, date, author, message = entry.lstrip('\n').split('\t', 3)
+    message = LINE_SEPARATOR.join(line.rstrip() for line in message.strip().splitlines())
+    line = '%s\t%s\t%s\t%s' % (sha, date, author.replace('\t', ' '), message)
+    # cut on a character boundary
+    return line.encode('UTF-8')[:MAX_LINE_BYTES - 1].decode('UTF-8', 'ignore') + '\n'
+
+
+def trigrams(data):
+    return {data[i:i + 3] for i in range(len(data) - 2)}
+
+
+class ChunkedLog(object):
+    """
+    Appends log lines to a repository's chunk files, starting a new chunk
+    whenever the last one would grow past MAX_CHUNK_TRIGRAMS trigrams.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        chunks = sorted(f for f in os.listdir(log_dir) if f.endswith(LOG_SUFFIX))
+        self.number = len(chunks) - 1
+        self.trigrams = set()
+        self.tail = b''
+        if chunks:
+            with open(os.path.join(log_dir, chunks[-1]), 'rb') as f:
+                data = f.read()
+            self.trigrams = trigrams(data)
+            self.tail = data[-2:]
+        self.f = None
+
+    def write(self, lines):
+        for line in lines:
+            data = line.encode('UTF-8')
+            # only the trigrams the chunk doesn't have yet, a line adds few
+            new = trigrams(self.tail + data) - self.trigrams
+            if self.number < 0 or (self.trigrams and len(self.trigrams) + len(new) > MAX_CHUNK_TRIGRAMS):
+                self.next_chunk()
+                new = trigrams(data)
+            if self.f is None:
+                self.f = open(os.path.join(self.log_dir, CHUNK_FORMAT % self.number), 'ab')
+            self.f.write(data)
+            self.trigrams.update(new)
+            self.tail = data[-2:]
+
+    def next_chunk(self):
+        self.close()
+        self.number += 1
+        self.trigrams = set()
+        self.tail = b''
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def write_log(log_dir, lines):
+    log = ChunkedLog(log_dir)
+    try:
+        log.write(lines)
+    finally:
+        log.close()
+
+
+def log_dir(commit_dir, key):
+    return os.path.join(commit_dir, LOGS, key)
+
+
+def update_log(commit_dir, key, repo_dir, previous):
+    """
+    Brings a repository's log up to date with its HEAD. previous is what
+    the state recorded for it on the last run, if anything. Returns its new
+    state, and how many commits were written.
+    """
+    head = git(repo_dir, 'rev-parse', 'HEAD').strip()
+    shallow = is_shallow(repo_dir)
+    dirname = log_dir(commit_dir, key)
+    state = {'commit': head, 'shallow': shallow}
+    if previous is not None and previous.get('commit') == head and previous.get('shallow') == shallow \
+            and os.path.isdir(dirname):
+        return state, 0
+
+    if (previous is not None and previous.get('shallow') == shallow and os.path.isdir(dirname)
+            and is_ancestor(repo_dir, previous['commit'], head)):
+        lines = log_lines(repo_dir, ['%s..%s' % (previous['commit'], head)])
+        write_log(dirname, lines)
+        return state, len(lines)
+
+    # written aside and moved into place, searches only briefly miss it
+    lines = log_lines(repo_dir, [head])
+    tmp = dirname + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    write_log(tmp, lines)
+    remove_log(commit_dir, key)
+    os.rename(tmp, dirname)
+    return state, len(lines)
+
+
+def remove_log(commit_dir, key):
+    shutil.rmtree(log_dir(commit_dir, key), ignore_errors=True)
+
+
+def update_repo(commit_dir, key, repo_dir, previous):
+    """
+    update_log() from the history of the checkout in repo_dir.
+    """
+    return update_log(commit_dir, key, history_repo(commit_dir, key, repo_dir), previous)
+
+
+def org_of(key):
+    # vcs_loc/org/repo -> vcs_loc/org
+    return key.rsplit('/', 1)[0]
+
+
+def shard_file(commit_dir, org):
+    return os.path.join(commit_dir, SHARDS, org + SHARD_SUFFIX)
+
+
+def stale_shards(commit_dir, orgs, changed):
+    """
+    Returns the orgs (vcs_loc/org) whose shards have to be built: the ones
+    whose logs changed, and the ones without a shard yet.
+    """
+    return sorted(org for org in orgs if org in changed or not os.path.exists(shard_file(commit_dir, org)))
+
+
+def build_shard(cindex, commit_dir, org):
+    """
+    Indexes the logs of an org into its shard, replacing it only once the
+    new one is complete.
+    """
+    index_file = shard_file(commit_dir, org)
+    tmp = index_file + '.tmp'
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    subprocess.check_output([cindex, log_dir(commit_dir, org)], env=dict(os.environ, CSEARCHINDEX=tmp),
+                            stderr=subprocess.STDOUT, encoding='UTF-8')
+    with open(tmp, 'rb') as f:
+        f.seek(-len(INDEX_TRAILER), os.SEEK_END)
+        if f.read() != INDEX_TRAILER:
+            raise Exception('cindex wrote an incomplete index to %s' % tmp)
+    os.replace(tmp, index_file)
+
+
+def load_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    parser = argparse.ArgumentParser(description='build the commit message index of all git repositories under a directory')
+    parser.add_argument('-r', '--code-root', type=str, required=True, help='directory with the repositories, laid out as vcs_loc/org/repo')
+    parser.add_argument('-d', '--commit-dir', type=str, required=True, help='directory to write the commit logs and their index to')
+    parser.add_argument('-c', '--cindex', type=str, default='cindex', help='path of the cindex binary')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of repositories to read the history of at the same time')
+    parser.add_argument('--full', action='store_true', help='rewrite every log from scratch')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.commit_dir, LOGS), exist_ok=True)
+    state_file = os.path.join(args.commit_dir, STATE_FILE)
+    state = {} if args.full else load_json(state_file, {})
+    repos = find_repos(args.code_root)
+
+    s = time.time()
+    written, failed, changed = 0, [], set()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(update_repo, args.commit_dir, key, repo_dir, state.get(key)): key
+                   for key, repo_dir in repos.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                state[key], n = future.result()
+            except (subprocess.SubprocessError, ValueError) as e:
+                # the log is left as it was and retried on the next run
+                logging.error('error reading the history of %s: %s\n%s', key, e, getattr(e, 'stderr', ''))
+                failed.append(key)
+                continue
+            if n:
+                logging.info('wrote %d commits of %s', n, key)
+                changed.add(org_of(key))
+            written += n
+
+    removed = [key for key in state if key not in repos]
+    for key in removed:
+        remove_log(args.commit_dir, key)
+        remove_history(args.commit_dir, key)
+        changed.add(org_of(key))
+        del state[key]
+    save_json(state_file, state)
+    logging.info('wrote %d commits of %d repositories in %.1f seconds, %d failed, %d removed',
+                 written, len(repos), time.time() - s, len(failed), len(removed))
+
+    s = time.time()
+    orgs = {org_of(key) for key in state}
+    stale = stale_shards(args.commit_dir, orgs, changed)
+    for org in stale:
+        try:
+            build_shard(args.cindex, args.commit_dir, org)
+        except Exception as e:
+            logging.error('error indexing the commits of %s: %s\n%s', org, e, getattr(e, 'output', ''))
+            # its logs are already recorded as written, without a shard it's
+            # built again on the next run
+            if os.path.exists(shard_file(args.commit_dir, org)):
+                os.remove(shard_file(args.commit_dir, org))
+            failed.append(org)
+    for index_file in glob.glob(shard_file(args.commit_dir, '*/*')):
+        # every repository of the org is gone
+        if os.path.relpath(index_file, os.path.join(args.commit_dir, SHARDS))[:-len(SHARD_SUFFIX)] not in orgs:
+            os.remove(index_file)
+    if os.path.exists(os.path.join(args.commit_dir, OLD_INDEX_FILE)):
+        os.remove(os.path.join(args.commit_dir, OLD_INDEX_FILE))
+    if stale:
+        logging.info('indexed the commits of %d of %d orgs in %.1f seconds', len(stale), len(orgs), time.time() - s)
+        statsd.histogram('spt.codesearcher.commits.index_duration', time.time() - s)
+    statsd.gauge('spt.codesearcher.commits.written', written)
+    statsd.gauge('spt.codesearcher.commits.shards_rebuilt', len(stale))
+    if failed:
+        raise SystemExit('failed to read the history or index the commits of: %s' % ', '.join(sorted(failed)))
@@ -0,0 +1,462 @@
+#!/venv/bin/python3
+"""
+Builds the csearch indexes for everything under a code root, as one index
+(shard) per org, e.g. github/sproutsocial, so shards can be built in
+parallel and searched concurrently. Orgs with many repositories can be
+split further into shards of about --repos-per-shard repositories.
+
+Only shards whose repositories changed since they were last built are
+rebuilt. A manifest next to the shards records the commit each repository
+was at (taken from the fetch metadata, or from git), so a new commit, a new
+repository or a removed one each cause just their own shard to be rebuilt.
+
+Searches never see an index being written. Each build is a new generation,
+shard-dir/generations/<id>, holding the rebuilt shards and hard links to the
+unchanged ones of the current generation. Once every shard in it has been
+checked with cindex -list, the shard-dir/current symlink is switched to it in
+one rename. The webapp reads shards through that link, and uses the
+generation's id (from its generation.json) as the cache key and its time
+as "last indexed". The previous --keep generations are kept for searches
+still running against them, older ones are removed.
+
+What goes into the index is decided by an exclusion policy (VCS internals,
+dependencies and vendored code, minified and generated files, huge files
+and binaries by default). Each repository is walked once and cindex is given
+the fewest paths that cover everything else, i.e. whole directories where
+nothing below them is excluded.
+"""
+
+import sentry_sdk
+sentry_sdk.init()
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datadog import initialize, statsd
+
+SHARD_SUFFIX = '.index'
+MANIFEST = 'manifest.json'
+GENERATIONS = 'generations'
+CURRENT = 'current'
+GENERATION_FILE = 'generation.json'
+KEEP_GENERATIONS = 2
+# the end of every complete index cindex writes
+INDEX_TRAILER = b'\ncsearch trailr\n'
+
+EXCLUDE_DIRS = (
+    '.git', '.hg', '.svn', '.bzr',
+    'node_modules', 'bower_components', 'vendor', 'third_party', '__pycache__',
+)
+EXCLUDE_FILES = (
+    '*.min.js', '*.min.css', '*.map', 'package-lock.json', 'yarn.lock', '*.pyc', '*.class',
+    '*.jar', '*.war', '*.so', '*.dylib', '*.dll', '*.exe', '*.o', '*.a',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.ico', '*.pdf', '*.woff', '*.woff2', '*.ttf', '*.eot',
+    '*.zip', '*.gz', '*.tgz', '*.bz2', '*.xz',
+)
+MAX_FILE_SIZE = 1024 * 1024
+# bytes of each file looked at for NUL bytes to spot binaries, the same as git
+BINARY_SNIFF_SIZE = 8000
+# keep cindex command lines well below ARG_MAX
+MAX_ARGS_SIZE = 512 * 1024
+
+initialize()
+
+
+class InvalidShardError(Exception):
+    pass
+
+
+def list_dirs(dirname):
+    # .tmp directories are clones still in progress, see github_backup.py
+    return sorted(d for d in os.listdir(dirname)
+                  if not d.startswith('.') and not d.endswith('.tmp') and os.path.isdir(os.path.join(dirname, d)))
+
+
+def find_shards(code_root, repos_per_shard=0):
+    """
+    Returns a dict of shard name (vcs_loc/org, or vcs_loc/org.N when an org
+    is split up) to the repository directories that go in that shard.
+    """
+    shards = {}
+    for vcs_loc in list_dirs(code_root):
+        for org in list_dirs(os.path.join(code_root, vcs_loc)):
+            org_dir = os.path.join(code_root, vcs_loc, org)
+            repos = [os.path.join(org_dir, r) for r in list_dirs(org_dir)]
+            if not repos:
+                continue
+            if repos_per_shard and len(repos) > repos_per_shard:
+                # repos are spread over the groups by a hash of their name
+                # rather than in runs, so a new repo doesn't shift every
+                # later repo into another group and force a rebuild of them
+                groups = -(-len(repos) // repos_per_shard)
+                for repo in repos:
+                    n = zlib.crc32(os.path.basename(repo).encode('utf-8')) % groups
+                    shards.setdefault('%s/%s.%d' % (vcs_loc, org, n), []).append(repo)
+            else:
+                shards['%s/%s' % (vcs_loc, org)] = repos
+    return shards
+
+
+def repo_versions(code_root, paths, metadata):
+    """
+    Returns the commit each repository is at, keyed by its path relative to
+    the code root. Falls back to asking git for repositories the fetch
+    metadata doesn't know about, and to None if that fails too (e.g. hg).
+    """
+    versions = {}
+    for repo in paths:
+        key = os.path.relpath(repo, code_root)
+        commit = metadata.get(key, {}).get('commit')
+        if commit is None:
+            try:
+                commit = subprocess.check_output(['git', '-C', repo, 'rev-parse', 'HEAD'],
+                                                 stderr=subprocess.DEVNULL, encoding='UTF-8').strip()
+            except (subprocess.CalledProcessError, OSError):
+                pass
+        versions[key] = commit
+    return versions
+
+
+def is_stale(shard_dir, name, entry, manifest):
+    if not os.path.exists(shard_file(shard_dir, name)):
+        return True
+    # repos we can't tell the version of are always reindexed
+    return manifest.get(name) != entry or None in entry['repos'].values()
+
+
+def load_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def save_manifest(shard_dir, manifest):
+    save_json(os.path.join(shard_dir, MANIFEST), manifest)
+
+
+class ExclusionPolicy(object):
+    """
+    Decides which directories and files are left out of the index. Directory
+    and file patterns are matched against single names with fnmatch, not
+    paths, so they can't hold a slash, and ** is the same as *.
+    """
+    def __init__(self, dirs=EXCLUDE_DIRS, files=EXCLUDE_FILES, max_file_size=MAX_FILE_SIZE):
+        self.dirs = sorted(set(dirs))
+        self.files = sorted(set(files))
+        self.max_file_size = max_file_size
+
+    def fingerprint(self):
+        # shards built under another policy have to be rebuilt
+        raw = json.dumps([self.dirs, self.files, self.max_file_size])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def excludes_dir(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.dirs)
+
+    def excludes_file(self, entry):
+        if any(fnmatch.fnmatch(entry.name, pattern) for pattern in self.files):
+            return True
+        try:
+            if entry.stat(follow_symlinks=False).st_size > self.max_file_size:
+                return True
+            with open(entry.path, 'rb') as f:
+                return b'\0' in f.read(BINARY_SNIFF_SIZE)
+        except OSError:
+            return True
+
+
+def covering_paths(dirname, policy):
+    """
+    Returns the fewest paths that cover everything under dirname that the
+    policy lets in, and whether that is all of dirname (in which case the
+    path is just dirname itself).
+    """
+    paths = []
+    complete = True
+    with os.scandir(dirname) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_symlink():
+                # cindex doesn't follow or index symlinks either
+                continue
+            if entry.is_dir():
+                if policy.excludes_dir(entry.name):
+                    complete = False
+                    continue
+                subpaths, subcomplete = covering_paths(entry.path, policy)
+                paths.extend(subpaths)
+                complete = complete and subcomplete
+            elif entry.is_file():
+                if policy.excludes_file(entry):
+                    complete = False
+                    continue
+                paths.append(entry.path)
+    if complete:
+        return [dirname], True
+    return paths, False
+
+
+def arg_batches(paths, max_size=MAX_ARGS_SIZE):
+    batch, size = [], 0
+    for p in paths:
+        if batch and size + len(p) + 1 > max_size:
+            yield batch
+            batch, size = [], 0
+        batch.append(p)
+        size += len(p) + 1
+    if batch:
+        yield batch
+
+
+def shard_file(shard_dir, name):
+    return os.path.join(shard_dir, name + SHARD_SUFFIX)
+
+
+def build_shard(cindex, shard_dir, name, repos, policy):
+    """
+    Builds a shard into a new generation, which nothing searches yet.
+    """
+    index_file = shard_file(shard_dir, name)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    s = time.time()
+    paths = [p for repo in repos for p in covering_paths(repo, policy)[0]]
+    if not paths:
+        logging.info('nothing left to index in %s', name)
+        return time.time() - s
+
+    # paths that don't fit on one command line are added (merged in) by
+    # later runs
+    env = dict(os.environ, CSEARCHINDEX=index_file)
+    for i, batch in enumerate(arg_batches(paths)):
+        reset = ['-reset'] if i == 0 else []
+        subprocess.run([cindex] + reset + batch, env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True, encoding='UTF-8')
+    check_shard(cindex, index_file, paths)
+    return time.time() - s
+
+
+def check_shard(cindex, index_file, paths):
+    """
+    Raises InvalidShardError unless index_file is a complete index of
+    exactly paths.
+    """
+    with open(index_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - len(INDEX_TRAILER)))
+        if f.read() != INDEX_TRAILER:
+            raise InvalidShardError('%s is incomplete' % index_file)
+    listed = subprocess.run([cindex, '-list'], env=dict(os.environ, CSEARCHINDEX=index_file),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True, encoding='UTF-8')
+    expected = {os.path.abspath(p) for p in paths}
+    found = set(listed.stdout.splitlines())
+    if found != expected:
+        raise InvalidShardError('%s indexes %d paths, expected %d' % (index_file, len(found), len(expected)))
+
+
+def link_shard(from_dir, to_dir, name):
+    """
+    Carries an unchanged shard over into a new generation. Returns False if
+    there is no such shard to carry over.
+    """
+    source, target = shard_file(from_dir, name), shard_file(to_dir, name)
+    if not os.path.exists(source):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return True
+
+
+def current_generation(shard_dir):
+    """
+    Returns the directory of the generation searches currently use, or None
+    before the first one is built.
+    """
+    link = os.path.join(shard_dir, CURRENT)
+    if not os.path.islink(link):
+        return None
+    return os.path.join(shard_dir, os.readlink(link))
+
+
+def new_generation(shard_dir):
+    # ids sort in the order generations were built
+    generation_id = '%s-%s' % (time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), os.urandom(3).hex())
+    generation_dir = os.path.join(shard_dir, GENERATIONS, generation_id)
+    os.makedirs(generation_dir)
+    return generation_id, generation_dir
+
+
+def write_generation_info(generation_dir, info):
+    save_json(os.path.join(generation_dir, GENERATION_FILE), info)
+
+
+def swap_generation(shard_dir, generation_dir):
+    """
+    Points shard_dir/current at generation_dir in one rename, so searches
+    see either the old generation or the new one, never a mix.
+    """
+    link = os.path.join(shard_dir, CURRENT)
+    tmp = link + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.relpath(generation_dir, shard_dir), tmp)
+    os.replace(tmp, link)
+
+
+def remove_old_generations(shard_dir, keep=KEEP_GENERATIONS):
+    """
+    Removes all but the newest keep generations, never the current one.
+    """
+    current = current_generation(shard_dir)
+    generations_dir = os.path.join(shard_dir, GENERATIONS)
+    if not os.path.isdir(generations_dir):
+        return
+    generations = sorted(os.listdir(generations_dir), reverse=True)
+    for generation_id in generations[keep:]:
+        generation_dir = os.path.join(generations_dir, generation_id)
+        if current is not None and os.path.samefile(generation_dir, current):
+            continue
+        logging.info('removing old generation %s', generation_id)
+        shutil.rmtree(generation_dir, ignore_errors=True)
+
+
+def remove_unversioned_shards(shard_dir):
+    """
+    Removes the shards built straight into shard_dir before there were
+    generations.
+    """
+    manifest = os.path.join(shard_dir, MANIFEST)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    for name in os.listdir(shard_dir):
+        vcs_dir = os.path.join(shard_dir, name)
+        if name == GENERATIONS or os.path.islink(vcs_dir) or not os.path.isdir(vcs_dir):
+            continue
+        for filename in os.listdir(vcs_dir):
+            if filename.endswith(SHARD_SUFFIX) or filename.endswith(SHARD_SUFFIX + '.tmp'):
+                logging.info('removing unversioned shard %s/%s', name, filename)
+                os.remove(os.path.join(vcs_dir, filename))
+        if not os.listdir(vcs_dir):
+            os.rmdir(vcs_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    parser = argparse.ArgumentParser(description='build sharded csearch indexes of all repositories under a directory')
+    parser.add_argument('-r', '--code-root', type=str, required=True, help='directory with the repositories, laid out as vcs_loc/org/repo')
+    parser.add_argument('-s', '--shard-dir', type=str, required=True, help='directory to write the index shards to')
+    parser.add_argument('-c', '--cindex', type=str, default='cindex', help='path of the cindex binary')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of shards to build at the same time, defaults to the number of cores')
+    parser.add_argument('--repos-per-shard', type=int, default=0, help='split orgs with more repositories than this into several shards')
+    parser.add_argument('-m', '--metadata', type=str, help='repository metadata file written by github_backup.py, used to tell which repositories changed')
+    parser.add_argument('--full', action='store_true', help='rebuild every shard, even ones that have not changed')
+    parser.add_argument('--keep', type=int, default=KEEP_GENERATIONS, help='number of index generations to keep, including the current one')
+    parser.add_argument('--exclude-dir', action='append', default=[], metavar='PATTERN', help='also leave directories with names matching this out of the index')
+    parser.add_argument('--exclude-file', action='append', default=[], metavar='PATTERN', help='also leave files with names matching this out of the index')
+    parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE, help='leave files bigger than this many bytes out of the index')
+    parser.add_argument('--no-default-excludes', action='store_true', help='only exclude what is given with --exclude-dir and --exclude-file')
+    args = parser.parse_args()
+    for pattern in args.exclude_dir + args.exclude_file:
+        if '/' in pattern:
+            parser.error('exclude patterns match names, not paths: %s' % pattern)
+
+    defaults = not args.no_default_excludes
+    policy = ExclusionPolicy(
+        dirs=(EXCLUDE_DIRS if defaults else ()) + tuple(args.exclude_dir),
+        files=(EXCLUDE_FILES if defaults else ()) + tuple(args.exclude_file),
+        max_file_size=args.max_file_size,
+    )
+
+    os.makedirs(args.shard_dir, exist_ok=True)
+    # the generation unchanged shards are carried over from. before the
+    # first generation that's the shards built straight into shard_dir
+    current = current_generation(args.shard_dir)
+    base = current or args.shard_dir
+    if current is not None:
+        # they are only removed a run after the first generation is swapped
+        # in, once searches that started before that are done
+        remove_unversioned_shards(args.shard_dir)
+    metadata = load_json(args.metadata, {'repos': {}})['repos'] if args.metadata else {}
+    manifest = load_json(os.path.join(base, MANIFEST), {})
+
+    shards = find_shards(args.code_root, args.repos_per_shard)
+    entries = {name: {'policy': policy.fingerprint(), 'repos': repo_versions(args.code_root, paths, metadata)}
+               for name, paths in shards.items()}
+    stale = [name for name in shards if args.full or is_stale(base, name, entries[name], manifest)]
+    removed = [name for name in manifest if name not in shards]
+    now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    if current is not None and not stale and not removed:
+        logging.info('all %d shards are up to date', len(shards))
+        info = load_json(os.path.join(current, GENERATION_FILE), {})
+        write_generation_info(current, dict(info, checked_at=now))
+        remove_old_generations(args.shard_dir, args.keep)
+        statsd.gauge('spt.codesearcher.index.shards_rebuilt', 0)
+        raise SystemExit()
+
+    generation_id, generation_dir = new_generation(args.shard_dir)
+    for name in shards:
+        if name not in stale and not link_shard(base, generation_dir, name):
+            stale.append(name)
+    logging.info('building %d of %d shards into generation %s with %d jobs', len(stale), len(shards), generation_id,
+                 args.jobs)
+
+    s = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(build_shard, args.cindex, generation_dir, name, shards[name], policy): name
+                   for name in stale}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                duration = future.result()
+                logging.info('indexed %s in %.1f seconds', name, duration)
+                statsd.histogram('spt.codesearcher.index.shard.duration', duration)
+                manifest[name] = entries[name]
+            except (subprocess.CalledProcessError, InvalidShardError) as e:
+                logging.error('error indexing %s: %s\n%s', name, e, getattr(e, 'output', ''))
+                # the last good build keeps being searched, and it's retried
+                # on the next run
+                if os.path.exists(shard_file(generation_dir, name)):
+                    os.remove(shard_file(generation_dir, name))
+                link_shard(base, generation_dir, name)
+                manifest.pop(name, None)
+                failed.append(name)
+
+    built = len(stale) - len(failed)
+    if current is not None and not built and not removed:
+        logging.info('nothing new to search, keeping the current generation')
+        shutil.rmtree(generation_dir)
+    else:
+        save_manifest(generation_dir, {name: v for name, v in manifest.items() if name in shards})
+        write_generation_info(generation_dir, {'id': generation_id, 'built_at': now, 'checked_at': now,
+                                               'shards': len(shards), 'rebuilt': built})
+        swap_generation(args.shard_dir, generation_dir)
+        logging.info('now searching generation %s', generation_id)
+    remove_old_generations(args.shard_dir, args.keep)
+
+    statsd.histogram('spt.codesearcher.index.duration', time.time() - s)
+    statsd.gauge('spt.codesearcher.index.shards_rebuilt', built)
+    logging.info('built %d shards in %.1f seconds, %d failed, %d unchanged',
+                 built, time.time() - s, len(failed), len(shards) - len(stale))
+    if failed:
+        raise SystemExit('failed to index: %s' % ', '.join(sorted(failed)))
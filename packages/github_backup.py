@@ -8,56 +8,67 @@ sentry_sdk.init()
 
 import argparse
 import base64
-import contextlib
+import fcntl
 import json
 import logging
 import os
+import shutil
+import signal
 import subprocess
+import time
 
 from datadog import initialize, statsd
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote, urlencode
+from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 
 
 API_BASE = 'https://api.github.com/'
 REPO_TYPE_CHOICES = ('all', 'public', 'private', 'forks', 'sources', 'member')
+# full: every branch with all of its history, updated with git pull
+# shallow: only the default branch, --depth commits deep
+# partial: only the default branch, with the history of commits but only the
+#          file contents of what's checked out (a blob:none partial clone)
+CLONE_MODE_CHOICES = ('full', 'shallow', 'partial')
 
 initialize()
 
-@contextlib.contextmanager
-def chdir(dirname=None):
-    curdir = os.getcwd()
-    try:
-        if dirname is not None:
-            os.chdir(dirname)
-        yield
-    finally:
-        os.chdir(curdir)
-
-
 class Helpers(object):
     def __init__(self, args):
         self.args = args
 
-    def exec_cmd(self, command):
+    def exec_cmd(self, command, timeout=None):
         """
         Executes an external command taking into account errors and logging.
+        The command (and anything it started) is killed if it runs for longer
+        than timeout seconds.
         """
         logging.info("Executing command: %s" % self.redact(command))
         try:
-            command_output = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True, encoding='UTF-8')
-            logging.debug("Output of command: \n%s", self.redact(command_output))
-        except subprocess.CalledProcessError as e:
-            logging.warning("Output of failed command: \n%s", self.redact(e.output))
-            if e.returncode < 0:
-                msg = f"Child was terminated by signal {-e.returncode}"
-            else:
-                msg = f"Child returned {e.returncode}"
-            raise Exception(self.redact("Command [%s] failed: %s" % (command, msg)))
+            # in its own process group, so a timeout kills git and not just the shell
+            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True,
+                                  encoding='UTF-8', start_new_session=True) as p:
+                try:
+                    command_output, _ = p.communicate(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    os.killpg(p.pid, signal.SIGKILL)
+                    p.communicate()
+                    raise Exception(self.redact("Command [%s] failed: timed out after %s seconds" % (command, timeout)))
         except OSError as e:
             raise Exception(self.redact("Command [%s] failed: %s" % (command, e)))
 
+        if p.returncode == 0:
+            logging.debug("Output of command: \n%s", self.redact(command_output))
+            return
+        logging.warning("Output of failed command: \n%s", self.redact(command_output))
+        if p.returncode < 0:
+            msg = f"Child was terminated by signal {-p.returncode}"
+        else:
+            msg = f"Child returned {p.returncode}"
+        raise Exception(self.redact("Command [%s] failed: %s" % (command, msg)))
+
     def https_url_with_auth(self, base_url):
         _, suffix = base_url.split('https://')
         return 'https://%s:%s@%s' % (quote(self.args.username), quote(self.args.password), suffix)
@@ -70,6 +81,192 @@ class Helpers(object):
         return s
 
 
+class RepoMetadata(object):
+    """
+    Per-repository metadata (repo type, vcs location, default branch, last
+    fetched commit) that the webapp reads instead of inspecting every
+    repository that shows up in search results.
+
+    Repositories are keyed by their path relative to the directory the
+    metadata file lives in (i.e. CODE_ROOT), e.g. github/org/repo. Updates are
+    merged into the file under a lock since fetches for several orgs share it.
+    changed_at only moves when a fetch brings in new commits, which is what
+    build_index.py uses to only rebuild the shards that changed.
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.root = os.path.dirname(self.filename)
+        self.updates = {}
+        self.changed = set()
+        self.removed = set()
+
+    def key(self, destdir):
+        return os.path.relpath(os.path.abspath(destdir), self.root)
+
+    def update(self, destdir, default_branch, previous_commit=None, repo_type='git'):
+        """
+        Records a fetched repository. previous_commit is what HEAD was before
+        the pull (None for a fresh clone), the repository counts as changed
+        if the fetch moved it.
+        """
+        key = self.key(destdir)
+        commit = head_commit(destdir) if repo_type == 'git' else None
+        if commit is None and repo_type == 'git':
+            logging.warning(f'unable to find the fetched commit of {key}')
+        now = int(time.time())
+        self.updates[key] = {
+            'repo_type': repo_type,
+            'vcs_loc': key.split(os.sep)[0],
+            'default_branch': default_branch,
+            'commit': commit,
+            'fetched_at': now,
+            'changed_at': now,
+        }
+        if commit is None or commit != previous_commit:
+            self.changed.add(key)
+
+    def remove(self, destdir):
+        self.removed.add(self.key(destdir))
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'repos': {}}
+
+    def save(self):
+        with open(self.filename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.load()
+            for key, entry in self.updates.items():
+                # keep when the repo last changed, rather than last fetched
+                previous = data['repos'].get(key, {})
+                if key not in self.changed and previous.get('commit') == entry['commit'] and 'changed_at' in previous:
+                    entry['changed_at'] = previous['changed_at']
+                data['repos'][key] = entry
+            for key in self.removed:
+                data['repos'].pop(key, None)
+            # write then rename, so readers never see a partially written file
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.filename)
+        logging.info('saved metadata for %d repositories (%d changed, %d removed) to %s',
+                     len(self.updates), len(self.changed), len(self.removed), self.filename)
+
+
+def is_shallow(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, '.git', 'shallow'))
+
+
+def lacks_history(repo_dir, clone_mode):
+    """
+    Whether a backup is a shallow clone when clone_mode asks for history
+    (e.g. after switching to partial clones), which fetching can't fix.
+    """
+    return clone_mode != 'shallow' and is_shallow(repo_dir)
+
+
+def head_commit(repo_dir):
+    try:
+        return subprocess.check_output(['git', '-C', repo_dir, 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, encoding='UTF-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def default_git_branch(repo_dir):
+    try:
+        return subprocess.check_output(['git', '-C', repo_dir, 'symbolic-ref', '--short', 'HEAD'], stderr=subprocess.DEVNULL, encoding='UTF-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def record_repos(directory, metadata):
+    """
+    Records the repositories that something else fetched into directory
+    (i.e. bitbucket-backup), so the webapp never has to inspect them on disk,
+    and forgets the ones that are gone. Returns how many were recorded.
+    """
+    recorded = set()
+    for name in sorted(os.listdir(directory)):
+        destdir = os.path.join(directory, name)
+        if name.startswith('.') or name.endswith('.tmp'):
+            continue
+        if os.path.isdir(os.path.join(destdir, '.git')):
+            # unchanged unless the commit differs from the recorded one
+            metadata.update(destdir, default_git_branch(destdir), head_commit(destdir))
+        elif os.path.isdir(os.path.join(destdir, '.hg')):
+            metadata.update(destdir, 'default', repo_type='hg')
+        else:
+            continue
+        recorded.add(metadata.key(destdir))
+
+    prefix = metadata.key(directory) + os.sep
+    for key in metadata.load()['repos']:
+        if key.startswith(prefix) and key not in recorded:
+            metadata.remove(os.path.join(metadata.root, key))
+    return len(recorded)
+
+
+def prune_repos(directory, keep, metadata=None):
+    """
+    Removes repositories under directory that are no longer in the org, i.e.
+    ones that were deleted, renamed (the new name gets cloned) or have since
+    been ignored, so they stop showing up in search results.
+    """
+    for name in sorted(os.listdir(directory)):
+        destdir = os.path.join(directory, name)
+        if name in keep or name.startswith('.') or not os.path.isdir(destdir):
+            continue
+        logging.info(f'*** pruning {destdir}, it is no longer in the org ***')
+        shutil.rmtree(destdir)
+        statsd.increment('spt.codesearcher.git.pruned', tags=[f'repo:{name}'])
+        if metadata:
+            metadata.remove(destdir)
+
+
+class FetchState(object):
+    """
+    What the last fetch of an org saw: the ETag and contents of every page of
+    the org's repository listing, and the pushed_at and commit of each
+    repository that was fetched successfully. With it, unchanged pages of the
+    listing cost a 304 (which github doesn't count against the rate limit)
+    and repositories nobody pushed to since are skipped without running git.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self.cached_pages = data.get('pages', {})
+        self.pages = {}
+        self.repos = data.get('repos', {})
+
+    def cached_page(self, url):
+        return self.cached_pages.get(url)
+
+    def update_page(self, url, etag, repos, next_url):
+        self.pages[url] = {'etag': etag, 'repos': repos, 'next': next_url}
+
+    def is_unchanged(self, repo, destdir):
+        seen = self.repos.get(repo['full_name'])
+        return (seen is not None and repo.get('pushed_at') is not None and seen['pushed_at'] == repo['pushed_at']
+                and seen.get('commit') is not None and os.path.isdir(destdir))
+
+    def update(self, repo, commit):
+        self.repos[repo['full_name']] = {'pushed_at': repo.get('pushed_at'), 'commit': commit}
+
+    def save(self):
+        # only the pages seen this time, so pages that no longer exist go away
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'pages': self.pages, 'repos': self.repos}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
+
+
 Pagination = namedtuple('Pagination', 'first prev next last')
 def get_pagination(raw_link_header):
     link_map = {}
@@ -83,25 +280,53 @@ def add_https_basic_auth(request: Request, username, password):
     request.add_header("Authorization", "Basic %s" % base64string.decode('utf-8'))
 
 
-def get_repos(org, repo_type, access_token=None, username=None, password=None, per_page=25):
+# the only fields of the api's repository objects that get used, the rest is
+# left out of the fetch state
+REPO_FIELDS = ('name', 'full_name', 'fork', 'archived', 'default_branch', 'ssh_url', 'clone_url', 'pushed_at')
+
+
+def get_repos(org, repo_type, access_token=None, username=None, password=None, per_page=100, api_base=API_BASE, state=None):
     """
     Paginates through all of the repositories using github's Link header.
         https://developer.github.com/v3/#link-header
+    Pages that haven't changed since the last fetch (see FetchState) are
+    requested conditionally and served from the state.
     """
-    url = API_BASE + 'orgs/%s/repos?' % org
-    qs_params = {'type': repo_type, 'per_page': per_page}
-    if access_token:
-        qs_params.update({'access_token': args.access_token})
-        url += urlencode(qs_params)
-        request = Request(url)
-    elif username and password:
-        url += urlencode(qs_params)
-        request = Request(url)
-        add_https_basic_auth(request, username, password)
-    else:
+    if not access_token and not (username and password):
         raise ValueError('unworkable combination of authentication inputs')
 
-    response = urlopen(request)
+    url = api_base + 'orgs/%s/repos?' % org + urlencode({'type': repo_type, 'per_page': per_page})
+    while url:
+        request = Request(url)
+        if access_token:
+            request.add_header('Authorization', 'token %s' % access_token)
+        else:
+            add_https_basic_auth(request, username, password)
+
+        repos, next_url = get_repos_page(request, state)
+        for r in repos:
+            if not r.get('archived'):
+                yield r
+            else:
+                logging.info(f'skipping archived repository {r["full_name"]}')
+        url = next_url
+
+
+def get_repos_page(request, state=None):
+    url = request.full_url
+    cached = state.cached_page(url) if state else None
+    if cached:
+        request.add_header('If-None-Match', cached['etag'])
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code != 304 or not cached:
+            raise
+        logging.debug(f'{url} is unchanged')
+        statsd.increment('spt.codesearcher.github.not_modified')
+        state.update_page(url, cached['etag'], cached['repos'], cached['next'])
+        return cached['repos'], cached['next']
+
     # response.headers is an instance of http.client.HTTPMessage, which returns `None`
     # for missing keys. Refer to email.message.Message.__getitem__ (currently at
     # https://github.com/python/cpython/blob/3.11/Lib/email/message.py#L410-L419)
@@ -113,26 +338,82 @@ def get_repos(org, repo_type, access_token=None, username=None, password=None, p
     else:
         pagination = get_pagination(raw_link_header)
 
-    repos = json.loads(response.read())
-    for r in repos:
-        if not r.get('archived'):
-            yield r
-        else:
-            logging.info(f'skipping archived repository {r["full_name"]}')
+    repos = [{f: r.get(f) for f in REPO_FIELDS} for r in json.loads(response.read())]
+    etag = response.headers['ETag']
+    if state and etag:
+        state.update_page(url, etag, repos, pagination.next)
+    return repos, pagination.next
 
-    # so, this isn't the DRYest code ;-)
-    while pagination.next:
-        request = Request(pagination.next)
-        if username and password:
-            add_https_basic_auth(request, username, password)
-        response = urlopen(request)
-        pagination = get_pagination(response.headers['Link'])
-        repos = json.loads(response.read())
-        for r in repos:
-            if not r.get('archived'):
-                yield r
-            else:
-                logging.info(f'skipping archived repository {r["full_name"]}')
+
+FetchResult = namedtuple('FetchResult', 'name action ok duration previous_commit')
+def fetch_repo(h, repo, destdir, repo_path, timeout=None, clone_mode='full', depth=1):
+    """
+    Pulls new commits into the backup of a repository, or clones it if there
+    is no backup yet or the pull fails. Repositories are fetched from several
+    threads at once, so this only touches destdir and never the cwd.
+    """
+    s = time.time()
+    branch = repo['default_branch']
+    tags = [f"repo:{repo['name']}", f"branch:{branch}"]
+    previous_commit = None
+    if os.path.exists(destdir) and lacks_history(destdir, clone_mode):
+        logging.info('*** %s is a shallow clone, re-cloning it with its history... ***' % h.redact(repo_path))
+        previous_commit = head_commit(destdir)
+    elif os.path.exists(destdir):
+        # pull in new commits to an already tracked repository
+        logging.info('*** updating %s... ***' % h.redact(repo_path))
+        previous_commit = head_commit(destdir)
+        try:
+            h.exec_cmd(update_cmd(destdir, branch, clone_mode, depth), timeout)
+            statsd.increment('spt.codesearcher.git.backups', tags=tags)
+            return FetchResult(repo['name'], 'pull', True, time.time() - s, previous_commit)
+        except Exception as e:
+            logging.warning(f'error pulling {repo["name"]}, will re-clone: {e}')
+
+    # either there is no backup of this repo yet, or the git pull failed so we want to attempt a fresh clone
+    logging.info('*** %s clone of %s... ***' % (clone_mode, h.redact(repo_path)))
+    try:
+        # Clone into a temporary path just in case the clone fails for ephemeral reasons, such as a github outage
+        # This way we don't blow away the existing backup if there is one and pull may work again later
+        h.exec_cmd(f'rm -rf {destdir}.tmp && git clone{clone_args(branch, clone_mode, depth)} {repo_path} {destdir}.tmp && rm -rf {destdir} && mv {destdir}.tmp {destdir}', timeout)
+        statsd.increment('spt.codesearcher.git.backups', tags=tags)
+        return FetchResult(repo['name'], 'clone', True, time.time() - s, previous_commit)
+    except Exception as e:
+        logging.error(f'error doing {clone_mode} clone of {repo["name"]}: {e}')
+        statsd.increment('spt.codesearcher.git.failures', tags=tags)
+        # Clean up the tempdir if it got left behind
+        shutil.rmtree(f'{destdir}.tmp', ignore_errors=True)
+        return FetchResult(repo['name'], 'clone', False, time.time() - s, previous_commit)
+
+
+def clone_args(branch, clone_mode, depth):
+    if clone_mode == 'shallow':
+        return f' --depth {depth} --single-branch --no-tags --branch {branch}'
+    if clone_mode == 'partial':
+        return f' --filter=blob:none --single-branch --no-tags --branch {branch}'
+    return ''
+
+
+def update_cmd(destdir, branch, clone_mode, depth):
+    if clone_mode == 'full':
+        return f'git -C {destdir} pull origin {branch}'
+    # only the default branch's tip is fetched, and the working tree is moved
+    # to it, there is never anything to merge (or for a merge to get stuck on)
+    depth_args = f' --depth {depth}' if clone_mode == 'shallow' else ''
+    return f'git -C {destdir} fetch{depth_args} --no-tags origin {branch} && git -C {destdir} reset -q --hard FETCH_HEAD'
+
+
+def log_summary(results, skipped, duration):
+    by_action = {}
+    for r in results:
+        by_action.setdefault(r.action if r.ok else 'failed', []).append(r)
+    logging.info('fetched %d repositories in %.1f seconds: %s, %d skipped as unchanged', len(results), duration,
+                 ', '.join('%d %s' % (len(rs), action) for action, rs in sorted(by_action.items())) or 'nothing to do', skipped)
+    for r in sorted(results, key=lambda r: r.duration, reverse=True)[:5]:
+        logging.info('  %s %s took %.1f seconds', r.action, r.name, r.duration)
+    for r in by_action.get('failed', []):
+        logging.error('  failed to fetch %s', r.name)
+    statsd.histogram('spt.codesearcher.git.fetch_duration', duration)
 
 
 # Github API call, can authenticate via access token, or username and password
@@ -164,6 +445,14 @@ if __name__ == '__main__':
     ssh_parser.add_argument('-a', '--access-token', type=str, help='personal access token or oauth access token')
     ssh_parser.add_argument('-f', '--forks', action='store_true', help='add this arg if you want to backup fork repositories also')
     ssh_parser.add_argument('-i', '--ignore-list', type=repocsv, default=set(), help='add repos you dont want to fetch/index, e.g. --ignore-list org1/repo1,org2/repo2')
+    ssh_parser.add_argument('-m', '--metadata', type=str, help='path of the repository metadata file to update, it should be in the root of the directory tree being indexed')
+    ssh_parser.add_argument('--prune', action='store_true', help='remove local copies of repositories that are no longer in the org (deleted, renamed, ignored or unwanted forks)')
+    ssh_parser.add_argument('-j', '--jobs', type=int, default=8, help='number of repositories to fetch at the same time')
+    ssh_parser.add_argument('--timeout', type=int, default=900, help='seconds to allow each git pull or clone before giving up on it')
+    ssh_parser.add_argument('--clone-mode', type=str, default='full', choices=CLONE_MODE_CHOICES, help='full clones of every branch, shallow clones of the default branch, or partial clones of the default branch without old file contents')
+    ssh_parser.add_argument('--depth', type=int, default=1, help='number of commits of history to keep in shallow clones')
+    ssh_parser.add_argument('-s', '--state', type=str, help='path of a file to keep what this org looked like on the last fetch in, so unchanged repositories are skipped')
+    ssh_parser.add_argument('--api-base', type=str, default=API_BASE, help='base url of the github api')
 
     # uses a username and password for fetching repositories names from
     # github's API, and uses same username and password for
@@ -179,54 +468,88 @@ if __name__ == '__main__':
     https_parser.add_argument('-p', '--password', dest='password', type=str, required=True, help='github password or github personal access token')
     https_parser.add_argument('-f', '--forks', action='store_true', help='add this arg if you want to backup fork repositories also')
     https_parser.add_argument('-i', '--ignore-list', type=repocsv, default=set(), help='add repos you dont want to fetch/index, e.g. --ignore-list org1/repo1,org2/repo2')
+    https_parser.add_argument('-m', '--metadata', type=str, help='path of the repository metadata file to update, it should be in the root of the directory tree being indexed')
+    https_parser.add_argument('--prune', action='store_true', help='remove local copies of repositories that are no longer in the org (deleted, renamed, ignored or unwanted forks)')
+    https_parser.add_argument('-j', '--jobs', type=int, default=8, help='number of repositories to fetch at the same time')
+    https_parser.add_argument('--timeout', type=int, default=900, help='seconds to allow each git pull or clone before giving up on it')
+    https_parser.add_argument('--clone-mode', type=str, default='full', choices=CLONE_MODE_CHOICES, help='full clones of every branch, shallow clones of the default branch, or partial clones of the default branch without old file contents')
+    https_parser.add_argument('--depth', type=int, default=1, help='number of commits of history to keep in shallow clones')
+    https_parser.add_argument('-s', '--state', type=str, help='path of a file to keep what this org looked like on the last fetch in, so unchanged repositories are skipped')
+    https_parser.add_argument('--api-base', type=str, default=API_BASE, help='base url of the github api')
+
+    # records the metadata of repositories fetched by something else, e.g.
+    # bitbucket-backup, without talking to github
+    record_parser = subparsers.add_parser('record', help='update the repository metadata file with the repositories already in a directory, without fetching anything')
+    record_parser.add_argument('-d', '--dir', type=str, dest='directory', required=True, help='full or relative path of the backed up repositories')
+    record_parser.add_argument('-m', '--metadata', type=str, required=True, help='path of the repository metadata file to update, it should be in the root of the directory tree being indexed')
 
     args = parser.parse_args()
 
+    if args.authtype == 'record':
+        metadata = RepoMetadata(args.metadata)
+        n = record_repos(args.directory, metadata)
+        metadata.save()
+        logging.info(f'recorded {n} repositories in {args.directory}')
+        parser.exit()
+
     if not os.path.exists(args.directory):
         os.makedirs(args.directory)
 
+    state = FetchState(args.state) if args.state else None
     if args.authtype == 'ssh':
-        org_repos = get_repos(args.org, args.rtype, args.access_token)
+        org_repos = get_repos(args.org, args.rtype, args.access_token, api_base=args.api_base, state=state)
     else:
-        org_repos = get_repos(args.org, args.rtype, username=args.username, password=args.password)
+        org_repos = get_repos(args.org, args.rtype, username=args.username, password=args.password, api_base=args.api_base, state=state)
 
     h = Helpers(args)
-
-    for repo in org_repos:
-        # skip ignored repos
-        if repo['full_name'] in args.ignore_list:
-            logging.info('skipping ignored repository %s' % repo['full_name'])
-            continue
-
-        # skip forks unless asked not to
-        if not args.forks and repo['fork']:
-            logging.info('skipping fork repository %s' % repo['full_name'])
-            continue
-
-        destdir = os.path.join(args.directory, repo['name'])
-        if args.authtype == 'ssh':
-            repo_path = repo['ssh_url']
-        else:
-            repo_path = h.https_url_with_auth(repo['clone_url'])
-        if os.path.exists(destdir):
-            # pull in new commits to an already tracked repository
-            logging.info('*** updating %s... ***' % h.redact(repo_path))
-            with chdir(destdir):
-                try:
-                    h.exec_cmd('git pull origin %s' % repo['default_branch'])
-                    statsd.increment('spt.codesearcher.git.backups', tags=[f"repo:{repo['name']}", f"branch:{repo['default_branch']}"])
-                    continue
-                except Exception as e:
-                    logging.warning(f'error pulling {repo["name"]}, will re-clone: {e}')
-
-        # either there is no backup of this repo yet, or the git pull failed so we want to attempt a fresh clone
-        logging.info('*** full clone of %s... ***' % h.redact(repo_path))
-        try:
-            # Clone into a temporary path just in case the clone fails for ephemeral reasons, such as a github outage
-            # This way we don't blow away the existing backup if there is one and pull may work again later
-            h.exec_cmd(f'rm -rf {destdir}.tmp && git clone {repo_path} {destdir}.tmp && rm -rf {destdir} && mv {destdir}.tmp {destdir}')
-            statsd.increment('spt.codesearcher.git.backups', tags=[f"repo:{repo['name']}", f"branch:{repo['default_branch']}"])
-        except Exception as e:
-            logging.error(f'error doing full clone of {repo["name"]}: {e}')
-            # Clean up the tempdir if it got left behind
-            h.exec_cmd(f'rm -rf {destdir}.tmp')
+    metadata = RepoMetadata(args.metadata) if args.metadata else None
+
+    s = time.time()
+    fetched = set()
+    skipped = 0
+    results = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for repo in org_repos:
+            # skip ignored repos
+            if repo['full_name'] in args.ignore_list:
+                logging.info('skipping ignored repository %s' % repo['full_name'])
+                continue
+
+            # skip forks unless asked not to
+            if not args.forks and repo['fork']:
+                logging.info('skipping fork repository %s' % repo['full_name'])
+                continue
+
+            destdir = os.path.abspath(os.path.join(args.directory, repo['name']))
+            fetched.add(repo['name'])
+            if state and state.is_unchanged(repo, destdir) and not lacks_history(destdir, args.clone_mode):
+                logging.debug('skipping unchanged repository %s' % repo['full_name'])
+                skipped += 1
+                continue
+            if args.authtype == 'ssh':
+                repo_path = repo['ssh_url']
+            else:
+                repo_path = h.https_url_with_auth(repo['clone_url'])
+            futures[pool.submit(fetch_repo, h, repo, destdir, repo_path, args.timeout, args.clone_mode, args.depth)] = (repo, destdir)
+
+        for future in as_completed(futures):
+            repo, destdir = futures[future]
+            result = future.result()
+            results.append(result)
+            if result.ok and metadata:
+                metadata.update(destdir, repo['default_branch'], result.previous_commit)
+            if result.ok and state:
+                state.update(repo, head_commit(destdir))
+
+    log_summary(results, skipped, time.time() - s)
+
+    if args.prune:
+        # only reached once the whole org has been listed, an API error
+        # above would have stopped us before deleting anything
+        prune_repos(args.directory, fetched, metadata)
+
+    if metadata:
+        metadata.save()
+    if state:
+        state.save()
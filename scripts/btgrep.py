@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import http.client
 import json
+import os
 import sys
 import urllib.parse
-import urllib.request
 
 # You need to fill in the domain of where you install
 # Botanist for this to work, obviously :)
@@ -20,30 +22,62 @@ def get_vcs_prefix(vcs_loc):
         raise ValueError('unknown vcs_loc: %s' % vcs_loc)
 
 
+def stream_matches(params):
+    """
+    Yields matches from botanist's streaming endpoint as they arrive, so
+    output starts right away and stopping early hangs up on the server (which
+    stops the search there too).
+    """
+    url = urllib.parse.urlsplit(BOTANIST_DOMAIN)
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    # http/1.1, so the connection is kept alive for as long as the stream lasts
+    with contextlib.closing(connection_class(url.netloc)) as conn:
+        conn.request('GET', url.path.rstrip('/') + '/search/results.ndjson?' + urllib.parse.urlencode(params, doseq=True),
+                     headers={'Accept': 'application/x-ndjson'})
+        response = conn.getresponse()
+        if response.status != 200:
+            error = json.loads(response.read() or '{}').get('data', {}).get('error')
+            sys.exit('search failed: %s' % (error or response.reason))
+        for line in response:
+            yield json.loads(line)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("PATTERN", help="regex pattern you wish to search for")
     parser.add_argument("-i", "--ignore-case", help="Ignore case distinctions", action="store_true")
+    parser.add_argument("-m", "--max-count", type=int, metavar="NUM", help="Stop after NUM matching lines")
+    parser.add_argument("-r", "--repo", action="append", default=[], metavar="ORG/REPO", help="Only search this repo (can be repeated)")
+    parser.add_argument("-o", "--org", action="append", default=[], help="Only search this org's repos (can be repeated)")
+    parser.add_argument("-p", "--path", metavar="GLOB", help="Only search files matching GLOB, e.g. '*.py' or 'src/**.js'")
+    parser.add_argument("-t", "--timeout", type=float, metavar="SECONDS", help="Give up on the search after SECONDS")
     args = parser.parse_args()
 
-    params = urllib.parse.urlencode({'q': args.PATTERN, 'case': 'insensitive' if args.ignore_case else 'sensitive'})
-    r = urllib.request.urlopen(BOTANIST_DOMAIN + '/search/results.json?' + params).read()
-    data = json.loads(r).get('data', {}).get('results', {})
+    params = {'q': args.PATTERN, 'case': 'insensitive' if args.ignore_case else 'sensitive'}
+    if args.max_count is not None:
+        params['max_count'] = args.max_count
+    params.update({'repo': args.repo, 'org': args.org})
+    if args.path:
+        params['path'] = args.path
+    if args.timeout is not None:
+        params['timeout'] = args.timeout
 
-    if data is None:
+    count = 0
+    try:
+        for match in stream_matches(params):
+            if match.get('timed_out'):
+                print('search timed out, results are incomplete.', file=sys.stderr)
+                break
+            print('%s:%s:%s:%s:%s' % (get_vcs_prefix(match['vcs_loc']), match['repo'], match['filename'],
+                                      match['lineno'], match['srcline']), flush=True)
+            count += 1
+            if args.max_count is not None and count >= args.max_count:
+                break
+    except BrokenPipeError:
+        # whatever we were piped into (e.g. head) has exited, which is fine
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(0)
+
+    if count == 0:
         print('no results found.')
         sys.exit(1)
-
-    for reponame in sorted(data.keys()):
-        for vcs_loc, repo_result_dict in data[reponame].items():
-            files = repo_result_dict['files']
-            for filename in sorted(files.keys()):
-                for srcline_obj in files[filename]:
-                    srcline = srcline_obj.get('srcline')
-                    if srcline is None:
-                        continue
-                    lineno = srcline_obj.get('lineno')
-                    if lineno is None:
-                        continue
-
-                    print('%s:%s:%s:%s:%s' % (get_vcs_prefix(vcs_loc), reponame.encode('utf-8'), filename.encode('utf-8'), lineno, srcline.encode('utf-8')))
@@ -0,0 +1,76 @@
+"""
+ASGI config for codesearch project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+e.g. for `uvicorn codesearch.asgi:application`. Searches are served by the
+asyncio views in ui.aio.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import asyncio
+import logging
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "codesearch.settings")
+os.environ.setdefault("ASYNC_SEARCH", "true")
+
+from django.core.asgi import get_asgi_application
+
+log = logging.getLogger(__name__)
+
+
+def cancel_on_disconnect(app):
+    """
+    Cancels a request's view (and with it the csearch processes it is
+    waiting on) as soon as the client disconnects. Django only reads from
+    the connection while it reads the request body, so once that's done the
+    connection is watched here.
+
+    Servers also report http.disconnect once the whole response has been
+    sent, while Django is still closing the response, so a disconnect only
+    cancels the view when it comes before the response's last body message.
+    """
+    async def wrapper(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        body_read = asyncio.Event()
+        response_sent = False
+
+        async def receive_body():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body'):
+                body_read.set()
+            return message
+
+        async def send_response(message):
+            nonlocal response_sent
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                response_sent = True
+
+        view = asyncio.ensure_future(app(scope, receive_body, send_response))
+        waiters = [asyncio.ensure_future(body_read.wait())]
+        try:
+            await asyncio.wait([view, waiters[0]], return_when=asyncio.FIRST_COMPLETED)
+            if not view.done():
+                # the only thing left to receive is http.disconnect
+                waiters.append(asyncio.ensure_future(receive()))
+                await asyncio.wait([view, waiters[1]], return_when=asyncio.FIRST_COMPLETED)
+                if not view.done() and not response_sent:
+                    log.info('client disconnected, cancelling %s', scope.get('path'))
+                    view.cancel()
+            try:
+                await view
+            except asyncio.CancelledError:
+                if not view.cancelled():
+                    raise
+        finally:
+            for task in waiters + [view]:
+                task.cancel()
+
+    return wrapper
+
+
+application = cancel_on_disconnect(get_asgi_application())
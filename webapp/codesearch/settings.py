@@ -53,6 +53,7 @@ MIDDLEWARE_CLASSES = (
 ROOT_URLCONF = 'codesearch.urls'
 
 WSGI_APPLICATION = 'codesearch.wsgi.application'
+ASGI_APPLICATION = 'codesearch.asgi.application'
 
 
 # Database
@@ -61,10 +62,14 @@ WSGI_APPLICATION = 'codesearch.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # holds the query log (see ui.querylog), so in docker it's kept on
+        # the repos volume where cron/index.sh's warmup can read it
+        'NAME': os.getenv('DATABASE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
     }
 }
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -100,6 +105,74 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'botanist-static')
 # envvars
 CODE_ROOT = os.getenv('CODE_ROOT', '/botanist/repos')
 BIN_PATH = os.getenv('BIN_PATH', '/botanist/bin/codesearch-0.01')
+# same default as csearch and cindex themselves
+CSEARCHINDEX = os.getenv('CSEARCHINDEX', os.path.join(os.path.expanduser('~'), '.csearchindex'))
+# per-org index shards written by build_index.py. searches fan out across
+# all of them concurrently, CSEARCHINDEX is only used if there are none
+INDEX_SHARDS = os.getenv('INDEX_SHARDS', os.path.join(CODE_ROOT, '.shards'))
+# 'csearch' runs the csearch binary for every search, 'index' searches the
+# index in-process (see ui.engine)
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'csearch')
+# csearch is stopped once this many matches have been read, and the results
+# are reported as truncated
+MAX_RESULTS = int(os.getenv('MAX_RESULTS', '10000'))
+# number of results per page of /search/ and /search/results.json
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '500'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '5000'))
+# how long the cursor of a paginated search that timed out keeps working
+# (complete searches are kept for the search cache's TIMEOUT)
+SEARCH_CURSOR_TIMEOUT = int(os.getenv('SEARCH_CURSOR_TIMEOUT', str(15 * 60)))
+# searches are cancelled after SEARCH_TIMEOUT seconds (or the timeout request
+# parameter, up to MAX_SEARCH_TIMEOUT) and return what they found until
+# then, see ui.deadline. keep both below nginx's uwsgi_read_timeout
+SEARCH_TIMEOUT = float(os.getenv('SEARCH_TIMEOUT', '30'))
+MAX_SEARCH_TIMEOUT = float(os.getenv('MAX_SEARCH_TIMEOUT', '55'))
+# commit logs and their index, written by build_commit_index.py after every
+# fetch and searched by ui.commits. commit searches show the newest
+# MAX_COMMIT_RESULTS of the first MAX_COMMIT_SCAN matching commits
+COMMIT_INDEX_DIR = os.getenv('COMMIT_INDEX_DIR', os.path.join(CODE_ROOT, '.commits'))
+MAX_COMMIT_RESULTS = int(os.getenv('MAX_COMMIT_RESULTS', '1000'))
+MAX_COMMIT_SCAN = int(os.getenv('MAX_COMMIT_SCAN', '100000'))
+# written by github_backup.py, see ui.metadata
+REPO_METADATA = os.getenv('REPO_METADATA', os.path.join(CODE_ROOT, '.repo-metadata.json'))
+# admission control, see ui.admission. at most SEARCH_SLOTS csearch
+# processes run at once across all processes, one per index shard a search
+# searches. others wait up to SEARCH_QUEUE_TIMEOUT seconds for slots and
+# are then told the server is busy. identical searches wait up to
+# SEARCH_COALESCE_TIMEOUT seconds for the one already running, which by
+# default is as long as that one can run for.
+SEARCH_SLOTS = int(os.getenv('SEARCH_SLOTS', str(os.cpu_count() or 4)))
+SEARCH_QUEUE_TIMEOUT = float(os.getenv('SEARCH_QUEUE_TIMEOUT', '10'))
+SEARCH_COALESCE_TIMEOUT = float(os.getenv('SEARCH_COALESCE_TIMEOUT', str(SEARCH_TIMEOUT)))
+SEARCH_LOCK_DIR = os.getenv('SEARCH_LOCK_DIR', '/var/tmp/botanist-locks')
+# serve searches with the asyncio views in ui.aio, which codesearch/asgi.py
+# turns on. the uwsgi (wsgi.py) workers use the blocking views in ui.views
+ASYNC_SEARCH = os.getenv('ASYNC_SEARCH', 'false').lower() == 'true'
+# every search is recorded in the database (see ui.querylog), written in
+# batches every QUERY_LOG_FLUSH_INTERVAL seconds and kept for
+# QUERY_LOG_DAYS days. `manage.py warmup` replays the WARMUP_QUERIES most
+# popular searches of the last WARMUP_DAYS days against a new index
+QUERY_LOG = os.getenv('QUERY_LOG', 'true').lower() == 'true'
+QUERY_LOG_DAYS = int(os.getenv('QUERY_LOG_DAYS', '30'))
+QUERY_LOG_FLUSH_INTERVAL = float(os.getenv('QUERY_LOG_FLUSH_INTERVAL', '5'))
+WARMUP_QUERIES = int(os.getenv('WARMUP_QUERIES', '20'))
+WARMUP_DAYS = int(os.getenv('WARMUP_DAYS', '7'))
+
+# search results are cached per index generation (see ui.index), so they
+# never go stale, the timeout only bounds how long unpopular entries linger
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'ui.cache.SQLiteLRUCache',
+        'LOCATION': os.getenv('SEARCH_CACHE', '/var/tmp/botanist-search-cache.sqlite3'),
+        'TIMEOUT': int(os.getenv('SEARCH_CACHE_TIMEOUT', str(24 * 60 * 60))),
+        'OPTIONS': {
+            'MAX_BYTES': int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+        },
+    },
+}
 
 LOGGING = {
     'version': 1,
@@ -0,0 +1,236 @@
+"""
+Admission control and request coalescing for searches, shared by all of the
+webapp's uwsgi processes and threads through flock()ed lock files.
+
+- singleflight(): identical searches run once. Whoever gets the lock for a
+  search runs it and caches the results; everyone else waits for the lock
+  and then finds the results in the search cache. Every search has a lock
+  file of its own, named after its key, which its holder removes when it
+  is done so lock files don't pile up.
+- search_slot(): at most SEARCH_SLOTS csearch processes run at the same
+  time. A search takes one slot per process it runs, i.e. per index shard
+  it searches (all of the slots if it searches more shards than that), and
+  either gets all of them at once or none. The rest queue for up to
+  SEARCH_QUEUE_TIMEOUT seconds, then get a SearchBusyError (a 503) rather
+  than piling up until nginx gives up.
+
+flock() locks belong to an open file, so separate opens conflict even
+within a process, and a lock is released if its holder dies.
+
+asingleflight() and asearch_slot() are the same for the asyncio search in
+ui.aio, waiting with asyncio.sleep() instead of blocking.
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import time
+
+from codesearch.settings import SEARCH_COALESCE_TIMEOUT
+from codesearch.settings import SEARCH_LOCK_DIR
+from codesearch.settings import SEARCH_QUEUE_TIMEOUT
+from codesearch.settings import SEARCH_SLOTS
+
+POLL_INTERVAL = 0.02
+MAX_POLL_INTERVAL = 0.2
+
+E_FLIGHT_BUSY = 'the same search is still running, please try again later.'
+E_SLOTS_BUSY = 'too many searches are running right now, please try again in a few seconds.'
+
+log = logging.getLogger(__name__)
+
+
+class SearchBusyError(Exception):
+    pass
+
+
+def open_lock(name):
+    os.makedirs(SEARCH_LOCK_DIR, exist_ok=True)
+    return open(os.path.join(SEARCH_LOCK_DIR, name), 'a')
+
+
+def try_lock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def backoff(timeout):
+    """
+    Yields how long to wait before each retry, backing off, until timeout
+    seconds have gone by.
+    """
+    deadline = time.monotonic() + timeout
+    interval = POLL_INTERVAL
+    while time.monotonic() < deadline:
+        yield min(interval, max(0, deadline - time.monotonic()))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
+def poll(attempt, timeout):
+    """
+    Calls attempt() until it returns something truthy, backing off between
+    calls. Returns None once timeout seconds have gone by.
+    """
+    result = attempt()
+    for delay in backoff(timeout):
+        if result:
+            break
+        time.sleep(delay)
+        result = attempt()
+    return result or None
+
+
+async def apoll(attempt, timeout):
+    result = attempt()
+    for delay in backoff(timeout):
+        if result:
+            break
+        await asyncio.sleep(delay)
+        result = attempt()
+    return result or None
+
+
+def try_flight(key):
+    """
+    Returns the locked lock file of key's search, or None if someone else
+    holds it. A holder removes the file before unlocking it, so a lock
+    taken on a file that has since been removed (or replaced) doesn't
+    count, the file at the path is what's locked.
+    """
+    f = open_lock('flight-%s.lock' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+    if try_lock(f) and is_current(f):
+        return f
+    f.close()
+    return None
+
+
+def is_current(f):
+    try:
+        st = os.stat(f.name)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(f.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def land(f):
+    try:
+        os.remove(f.name)
+    finally:
+        f.close()
+
+
+@contextlib.contextmanager
+def singleflight(key, timeout=None):
+    timeout = SEARCH_COALESCE_TIMEOUT if timeout is None else timeout
+    f = try_flight(key)
+    if f is None:
+        log.info('waiting for the same search to finish')
+        f = poll(lambda: try_flight(key), timeout)
+        if f is None:
+            raise SearchBusyError(E_FLIGHT_BUSY)
+    try:
+        yield
+    finally:
+        land(f)
+
+
+@contextlib.asynccontextmanager
+async def asingleflight(key, timeout=None):
+    timeout = SEARCH_COALESCE_TIMEOUT if timeout is None else timeout
+    f = try_flight(key)
+    if f is None:
+        log.info('waiting for the same search to finish')
+        f = await apoll(lambda: try_flight(key), timeout)
+        if f is None:
+            raise SearchBusyError(E_FLIGHT_BUSY)
+    try:
+        yield
+    finally:
+        land(f)
+
+
+class Slot(object):
+    def __init__(self, files):
+        self.files = files
+
+    def release(self):
+        # also happens when the slot is garbage collected, e.g. if a
+        # streaming response is dropped before it starts
+        for f in self.files:
+            if not f.closed:
+                f.close()
+
+
+def try_slot(slots, count=1):
+    """
+    Takes count of the slots, or none of them if fewer are free.
+    """
+    held = []
+    for i in range(slots):
+        f = open_lock('slot-%d.lock' % i)
+        if not try_lock(f):
+            f.close()
+            continue
+        held.append(f)
+        if len(held) == count:
+            return Slot(held)
+    for f in held:
+        f.close()
+    return None
+
+
+def acquire_slot(slots=None, timeout=None, count=1):
+    slots = SEARCH_SLOTS if slots is None else slots
+    timeout = SEARCH_QUEUE_TIMEOUT if timeout is None else timeout
+    count = max(1, min(count, slots))
+
+    slot = try_slot(slots, count)
+    if slot is None:
+        log.info('fewer than %d of %d search slots are free, queueing', count, slots)
+        s = time.monotonic()
+        slot = poll(lambda: try_slot(slots, count), timeout)
+        if slot is None:
+            raise SearchBusyError(E_SLOTS_BUSY)
+        log.info('queued for %d search slots for %.2f seconds', count, time.monotonic() - s)
+    return slot
+
+
+async def aacquire_slot(slots=None, timeout=None, count=1):
+    slots = SEARCH_SLOTS if slots is None else slots
+    timeout = SEARCH_QUEUE_TIMEOUT if timeout is None else timeout
+    count = max(1, min(count, slots))
+
+    slot = try_slot(slots, count)
+    if slot is None:
+        log.info('fewer than %d of %d search slots are free, queueing', count, slots)
+        s = time.monotonic()
+        slot = await apoll(lambda: try_slot(slots, count), timeout)
+        if slot is None:
+            raise SearchBusyError(E_SLOTS_BUSY)
+        log.info('queued for %d search slots for %.2f seconds', count, time.monotonic() - s)
+    return slot
+
+
+@contextlib.contextmanager
+def search_slot(slots=None, timeout=None, count=1):
+    slot = acquire_slot(slots, timeout, count)
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+@contextlib.asynccontextmanager
+async def asearch_slot(slots=None, timeout=None, count=1):
+    slot = await aacquire_slot(slots, timeout, count)
+    try:
+        yield
+    finally:
+        slot.release()
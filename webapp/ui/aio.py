@@ -0,0 +1,448 @@
+"""
+asyncio versions of the search views, served when the webapp runs under
+ASGI (see codesearch/asgi.py) instead of uwsgi.
+
+Under uwsgi every search holds a worker thread for as long as csearch runs.
+Here csearch runs as an asyncio subprocess, and its output is read, merged
+and parsed in the event loop, so one process can serve hundreds of
+searches that are mostly waiting on csearch. Everything else is shared
+with ui.views: parsing (ResultParser), grouping, paging and rendering.
+Work that blocks on disk (the search cache, lines of context, listing the
+shards, reloading the repository metadata, the in-process index) runs in
+a pool of worker threads, and parsing a line never touches the disk.
+
+A view is cancelled when its client disconnects (see codesearch/asgi.py),
+which kills its csearch processes the same way the deadline does.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import os
+import signal
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+
+from django.core.cache import caches
+from django.http import HttpResponseBadRequest
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+
+from codesearch.settings import CODE_ROOT
+from codesearch.settings import MAX_RESULTS
+from codesearch.settings import SEARCH_BACKEND
+from ui import views
+from ui.admission import SearchBusyError
+from ui.admission import aacquire_slot
+from ui.admission import asearch_slot
+from ui.admission import asingleflight
+from ui.context import add_context
+from ui.deadline import Deadline
+from ui.index import get_last_indexed
+from ui.index import get_shards
+from ui.metrics import SearchStats
+from ui.scope import ScopeError
+from ui.scope import file_regex
+from ui.scope import get_scope
+from ui.scope import scope_params
+
+# largest csearch output line read, minified code can have very long lines
+READ_LIMIT = 16 * 1024 * 1024
+THREADS = 32
+
+log = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='search')
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    return await asyncio.wrap_future(executor.submit(fn, *args, **kwargs))
+
+
+async def iterate_in_thread(it):
+    """
+    Iterates a blocking iterator in the worker threads. If this stops early,
+    it is closed once the item being fetched (if any) has been.
+    """
+    done = object()
+    pending = None
+    try:
+        while True:
+            pending = executor.submit(next, it, done)
+            item = await asyncio.wrap_future(pending)
+            if item is done:
+                return
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            pending.add_done_callback(lambda f: views.close_iter(it))
+        else:
+            views.close_iter(it)
+
+
+async def search(request):
+    """
+    views.search(), streaming the page as an async iterator.
+    """
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    cursor = request.GET.get('cursor')
+    if query is None:
+        return HttpResponseBadRequest()
+    try:
+        page_size = views.get_page_size(request)
+        before, after = views.get_context_size(request)
+        scope = get_scope(request.GET)
+        deadline = Deadline(views.get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
+
+    page_params = {'q': query, 'case': 'sensitive' if case_sensitive else 'insensitive', 'page_size': page_size,
+                   'before': before, 'after': after}
+    page_params.update(scope_params(scope))
+    if request.GET.get('timeout'):
+        page_params['timeout'] = request.GET['timeout']
+    stats = SearchStats('search', case_sensitive, query, scope)
+    response = StreamingHttpResponse(search_page(request, query, case_sensitive, cursor, page_size, before, after,
+                                                 scope, deadline, stats, page_params),
+                                     content_type='text/html; charset=utf-8')
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def search_page(request, query, case_sensitive, cursor, page_size, before, after, scope, deadline, stats,
+                      page_params):
+    context = {'query': query, 'case': page_params['case'], 'before': before, 'after': after, 'scope': scope}
+    outcome = 'disconnected'
+    try:
+        with stats.timed('render'):
+            header = render_to_string('search_header.html', context, request)
+        yield header
+
+        s = time.time()
+        page, error, page_outcome = None, None, 'ok'
+        try:
+            page = await paginate_search(query, case_sensitive, cursor, page_size, scope=scope, deadline=deadline,
+                                         stats=stats)
+        except views.SEARCH_ERRORS as e:
+            error, page_outcome = views.page_error(e)
+        ts = "%.2f seconds" % (time.time() - s)
+        log.info('search time=%s', ts)
+
+        context.update({'time': ts, 'error': error})
+        if page is not None:
+            page_outcome = views.page_stats(stats, page)
+            chunks = iterate_in_thread(views.render_search_results(page.results, before, after, stats))
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await chunks.aclose()
+            views.add_page_context(context, page, page_params)
+        context['last_indexed'] = await run_in_thread(get_last_indexed)
+        with stats.timed('render'):
+            footer = render_to_string('search_footer.html', context, request)
+        yield footer
+        outcome = page_outcome
+    finally:
+        stats.send(outcome)
+
+
+async def search_json(request):
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    cursor = request.GET.get('cursor')
+    if query is None:
+        return HttpResponseBadRequest()
+    try:
+        page_size = views.get_page_size(request)
+        before, after = views.get_context_size(request)
+        scope = get_scope(request.GET)
+        deadline = Deadline(views.get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
+
+    stats = SearchStats('search_json', case_sensitive, query, scope)
+    outcome = 'disconnected'
+    try:
+        try:
+            page = await paginate_search(query, case_sensitive, cursor, page_size, html=False, scope=scope,
+                                         deadline=deadline, stats=stats)
+            if before or after:
+                with stats.timed('context'):
+                    await run_in_thread(add_context, page.results, CODE_ROOT, before, after, html=False)
+        except views.CSearchMissingError as e:
+            log.error('problem executing csearch: %s', e)
+            outcome = 'error'
+            return views.render_json({'error': views.E_UNABLE_TO_SEARCH}, status_code=500)
+        except SearchBusyError as e:
+            outcome = 'busy'
+            return views.render_busy_json(e)
+        except (views.RegexError, views.CursorError) as e:
+            outcome = 'invalid'
+            return views.render_json({'results': None, 'count': None, 'truncated': False, 'timed_out': False,
+                                      'next_cursor': None, 'error': str(e)})
+
+        page_outcome = views.page_stats(stats, page)
+        with stats.timed('render'):
+            response = views.render_json({'results': page.results, 'count': page.count,
+                                          'truncated': page.truncated, 'timed_out': page.timed_out,
+                                          'offset': page.offset, 'next_cursor': page.next_cursor, 'error': None})
+        outcome = page_outcome
+        return response
+    finally:
+        stats.send(outcome)
+
+
+async def search_ndjson(request):
+    """
+    views.search_ndjson(), streaming matches as csearch finds them.
+    """
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    if query is None:
+        return HttpResponseBadRequest()
+    try:
+        max_count = min(int(request.GET.get('max_count', MAX_RESULTS)), MAX_RESULTS)
+        scope = get_scope(request.GET)
+        deadline = Deadline(views.get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
+
+    stats = SearchStats('search_ndjson', case_sensitive, query, scope)
+    try:
+        slot = await aacquire_slot(count=await run_in_thread(views.search_processes, scope))
+    except SearchBusyError as e:
+        stats.send('busy')
+        return views.render_busy_json(e)
+
+    response = StreamingHttpResponse(ndjson_matches(query, case_sensitive, scope, max_count, slot, deadline, stats),
+                                     content_type='application/x-ndjson')
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def ndjson_matches(query, case_sensitive, scope, max_count, slot, deadline, stats):
+    count, truncated, outcome = 0, False, 'disconnected'
+    lines = do_search(query, case_sensitive, scope, deadline, stats)
+    try:
+        parser = await run_in_thread(views.ResultParser, query, case_sensitive, html=False, stats=stats)
+        async for line in lines:
+            match = parser.parse(line)
+            if match is None:
+                continue
+            if count >= max_count:
+                truncated = True
+                break
+            count += 1
+            s = time.perf_counter()
+            line = views.ndjson_line(*match)
+            stats.add('render', time.perf_counter() - s)
+            yield line
+        outcome = 'ok'
+        if deadline.expired:
+            outcome = 'timed_out'
+            yield json.dumps({'timed_out': True}) + '\n'
+    except (views.CSearchMissingError, views.RegexError) as e:
+        log.error('problem executing csearch: %s', e)
+        outcome = 'error'
+    finally:
+        await lines.aclose()
+        slot.release()
+        stats.results, stats.truncated = count, truncated
+        stats.send(outcome)
+
+
+async def paginate_search(query, case_sensitive, cursor, page_size, html=True, scope=None, deadline=None, stats=None):
+    """
+    views.paginate_search(), with the search cache read and written in the
+    worker threads.
+    """
+    generation, offset, key, spool, matches = await run_in_thread(views.lookup_page, query, case_sensitive, cursor,
+                                                                  page_size, html, scope, stats)
+    if matches is None:
+        spool, matches = await spooled_search(query, case_sensitive, html, generation, scope, deadline, stats)
+        matches = matches[offset:offset + page_size]
+    return views.make_page(generation, offset, spool, matches)
+
+
+async def spooled_search(query, case_sensitive=True, html=True, generation=None, scope=None, deadline=None,
+                         stats=None):
+    """
+    views.spooled_search(), waiting for identical searches and for a search
+    slot without blocking.
+    """
+    key = views.search_cache_key(query, case_sensitive, 'html' if html else 'json', generation, scope)
+    cache = caches['search']
+    found = await run_in_thread(views.read_search, cache, key)
+    if found is not None:
+        log.info('search cache hit')
+        if stats is not None:
+            stats.cached = True
+        return found
+
+    async with asingleflight(key):
+        found = await run_in_thread(views.read_search, cache, key)
+        if found is not None:
+            log.info('search coalesced with an identical one')
+            if stats is not None:
+                stats.cached = True
+            return found
+        async with asearch_slot(count=await run_in_thread(views.search_processes, scope)):
+            results, _, truncated = await search_and_group(query, case_sensitive, html, scope=scope,
+                                                           deadline=deadline, stats=stats)
+        return await run_in_thread(views.write_search, cache, key, results, truncated, deadline)
+
+
+async def search_and_group(query, case_sensitive=True, html=True, max_results=MAX_RESULTS, scope=None, deadline=None,
+                           stats=None):
+    """
+    views.search_and_group(): csearch output is parsed as it is read, and
+    csearch is killed as soon as max_results is reached. Returns
+    (results, count, truncated).
+    """
+    matches = []
+    lines = do_search(query, case_sensitive, scope, deadline, stats)
+    try:
+        parser = await run_in_thread(views.ResultParser, query, case_sensitive, html, stats)
+        async for line in lines:
+            match = parser.parse(line)
+            if match is None:
+                continue
+            matches.append(match)
+            # one more than max_results, so that the results are truncated
+            if len(matches) > max_results:
+                break
+    finally:
+        await lines.aclose()
+    return views.group_search_results(matches, max_results)
+
+
+async def do_search(query: str, case_sensitive=True, scope=None, deadline=None, stats=None):
+    """
+    views.do_search(), with csearch run as asyncio subprocesses: yields its
+    output one line at a time, merged across shards. Stopping early, the
+    deadline passing and the search being cancelled all kill csearch.
+
+    With SEARCH_BACKEND = 'index' the in-process search runs in the worker
+    threads instead.
+    """
+    if SEARCH_BACKEND == 'index':
+        lines = iterate_in_thread(views.do_search(query, case_sensitive, scope, deadline, stats))
+        try:
+            async for line in lines:
+                yield line
+        finally:
+            await lines.aclose()
+        return
+
+    if deadline is not None and deadline.check():
+        return
+
+    shards = await run_in_thread(get_shards, scope)
+    cmd = views.csearch_command(query, case_sensitive, file_regex(scope, CODE_ROOT))
+    log.info('cmd = %s, shards = %d', cmd, len(shards))
+
+    procs = []
+    try:
+        for shard in shards:
+            procs.append(await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=READ_LIMIT,
+                env=dict(os.environ, CSEARCHINDEX=shard), start_new_session=True))
+    except OSError as e:
+        kill_csearch(procs)
+        raise views.CSearchMissingError(e)
+
+    watch = deadline.watch_async(partial(kill_csearch, procs)) if deadline is not None else nullcontext()
+    merged = merge_shard_lines([timed_lines(read_lines(p), stats) for p in procs])
+    try:
+        with watch:
+            async for line in merged:
+                yield line
+    finally:
+        await merged.aclose()
+        errors = await stop_csearch(procs)
+
+    if deadline is not None and deadline.expired:
+        log.info('csearch stopped at the search deadline')
+        return
+
+    for p, err in zip(procs, errors):
+        log.info('csearch return code = %d', p.returncode)
+        if p.returncode > 1:
+            raise views.CSearchMissingError(err)
+
+
+async def read_lines(p):
+    while True:
+        line = await p.stdout.readline()
+        if not line:
+            return
+        yield line.decode('utf-8', 'replace').rstrip('\n')
+
+
+async def timed_lines(lines, stats=None):
+    try:
+        while True:
+            s = time.perf_counter()
+            try:
+                line = await anext(lines)
+            except StopAsyncIteration:
+                return
+            finally:
+                if stats is not None:
+                    stats.add('csearch', time.perf_counter() - s)
+            if stats is not None:
+                stats.bytes += len(line) + 1
+            yield line
+    finally:
+        await lines.aclose()
+
+
+async def merge_shard_lines(shard_lines):
+    """
+    views.merge_shard_lines() for async iterators.
+    """
+    heap = []
+    try:
+        for i, lines in enumerate(shard_lines):
+            line = await anext(lines, None)
+            if line is not None:
+                heap.append((views.shard_line_key(line), i, line))
+        heapq.heapify(heap)
+        while heap:
+            _, i, line = heapq.heappop(heap)
+            yield line
+            line = await anext(shard_lines[i], None)
+            if line is not None:
+                heapq.heappush(heap, (views.shard_line_key(line), i, line))
+    finally:
+        for lines in shard_lines:
+            await lines.aclose()
+
+
+async def stop_csearch(procs):
+    # a process that has written all of its output may just not have been
+    # reaped yet, it is left to exit with its own return code
+    running = [p for p in procs if p.returncode is None and not p.stdout.at_eof()]
+    if running:
+        log.info('stopping csearch early')
+        kill_csearch(running)
+    errors = []
+    for p in procs:
+        _, err = await p.communicate()
+        errors.append(err.decode('utf-8', 'replace'))
+    return errors
+
+
+def kill_csearch(procs):
+    for p in procs:
+        if p.returncode is None:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,234 @@
+"""
+A reproducible benchmark of the search hot path, run with
+`python manage.py benchmark`.
+
+A synthetic CODE_ROOT of orgs, repos and files of python-like code is
+generated from a seed, so every run searches exactly the same corpus. It is
+indexed with cindex into one shard per org, the way build_index.py lays
+shards out, and then each query shape in QUERIES is timed through:
+
+- search: do_search, i.e. csearch (or the in-process index) across shards
+- parse: parse_search_results over the search output
+- highlight: prepare_source_line over every matched line
+- render: rendering the parsed results the way the search page does
+
+Results are JSON, so runs can be kept and compared with compare().
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import time
+
+from datetime import datetime
+from datetime import timezone
+from unittest.mock import patch
+
+from ui import views
+from ui.metadata import RepoMetadata
+
+CORPUS_VERSION = 1
+CORPUS_MARKER = '.benchmark-corpus.json'
+VCS_LOC = 'github'
+
+# planted in about one file in RARE_TOKEN_EVERY, so the rare literal query
+# has a few matches however big the corpus is
+RARE_TOKEN = 'frobnicate_quux_overflow'
+RARE_TOKEN_EVERY = 200
+
+# (name, query, case_sensitive)
+QUERIES = [
+    ('rare_literal', RARE_TOKEN, True),
+    ('common_token', 'return', True),
+    ('case_insensitive', 'config', False),
+    ('heavy_regex', r'def (get|set|load)_\w+\(self(, \w+)+\):', True),
+]
+
+WORDS = [
+    'account', 'user', 'message', 'profile', 'config', 'request', 'response', 'cache', 'token', 'session',
+    'report', 'metric', 'queue', 'item', 'post', 'channel', 'network', 'schedule', 'client', 'event',
+]
+VERBS = ['get', 'set', 'load', 'save', 'build', 'parse', 'send', 'fetch', 'update', 'delete', 'render', 'check']
+MODULES = ['os', 'json', 'logging', 'time', 're', 'datetime', 'collections', 'functools', 'itertools', 'hashlib']
+
+
+def generate_corpus(root, orgs=4, repos=10, files=50, seed=0):
+    """
+    Writes root/github/org<i>/repo<j>/... and the repo metadata file that
+    github_backup.py would have written. Returns a summary of the corpus.
+    Does nothing but return the summary if root already has this corpus.
+    """
+    params = {'version': CORPUS_VERSION, 'orgs': orgs, 'repos': repos, 'files': files, 'seed': seed}
+    marker = os.path.join(root, CORPUS_MARKER)
+    try:
+        with open(marker) as f:
+            corpus = json.load(f)
+        if corpus['params'] == params:
+            return corpus
+    except (OSError, ValueError, KeyError):
+        pass
+
+    shutil.rmtree(os.path.join(root, VCS_LOC), ignore_errors=True)
+    rng = random.Random(seed)
+    metadata = {}
+    n_files, n_lines, n_bytes = 0, 0, 0
+    for o in range(orgs):
+        for r in range(repos):
+            repo_name = 'org%d/repo%d' % (o, r)
+            repo_dir = os.path.join(root, VCS_LOC, repo_name)
+            for i in range(files):
+                package = rng.choice(WORDS)
+                filename = os.path.join(repo_dir, 'src', package, '%s_%d.py' % (rng.choice(WORDS), i))
+                text = source_file(rng)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(filename, 'w') as f:
+                    f.write(text)
+                n_files += 1
+                n_lines += text.count('\n')
+                n_bytes += len(text)
+            metadata['%s/%s' % (VCS_LOC, repo_name)] = {
+                'repo_type': 'git', 'vcs_loc': VCS_LOC, 'default_branch': 'main', 'commit': None,
+            }
+
+    with open(os.path.join(root, '.repo-metadata.json'), 'w') as f:
+        json.dump({'repos': metadata}, f)
+    corpus = {'params': params, 'files': n_files, 'lines': n_lines, 'bytes': n_bytes}
+    with open(marker, 'w') as f:
+        json.dump(corpus, f)
+    return corpus
+
+
+def source_file(rng):
+    lines = ['import %s' % m for m in rng.sample(MODULES, rng.randint(2, 5))]
+    lines.append('')
+    for c in range(rng.randint(1, 3)):
+        noun = rng.choice(WORDS)
+        lines += ['', 'class %s%d(object):' % (noun.capitalize(), c),
+                  '    """Handles %s %s for the %s service."""' % (rng.choice(WORDS), noun, rng.choice(WORDS)),
+                  '', '    def __init__(self, config):', '        self.config = config',
+                  '        self.%s = {}' % rng.choice(WORDS)]
+        for _ in range(rng.randint(3, 8)):
+            lines += [''] + method(rng)
+    return '\n'.join(lines) + '\n'
+
+
+def method(rng):
+    noun, other = rng.choice(WORDS), rng.choice(WORDS)
+    args = ', '.join(rng.sample(WORDS, rng.randint(0, 3)))
+    lines = ['    def %s_%s(self%s):' % (rng.choice(VERBS), noun, ', ' + args if args else '')]
+    for _ in range(rng.randint(2, 8)):
+        kind = rng.random()
+        if kind < 0.3:
+            lines.append('        %s = self.%s.get(%r)' % (other, rng.choice(WORDS), rng.choice(WORDS)))
+        elif kind < 0.5:
+            lines.append('        # TODO: %s the %s before the %s' % (rng.choice(VERBS), noun, other))
+        elif kind < 0.7:
+            lines.append('        if not self.config.get(%r):' % ('%s_%s' % (noun, other)).upper())
+            lines.append('            return None')
+        elif kind < 0.85:
+            lines.append('        logging.info("%s %%s", %s)' % (rng.choice(VERBS), noun))
+        else:
+            lines.append('        self.%s[%r] = %s' % (noun, other, rng.randint(0, 1000)))
+    if rng.randrange(RARE_TOKEN_EVERY) == 0:
+        lines.append('        %s(self.%s)' % (RARE_TOKEN, noun))
+    lines.append('        return self.%s' % noun)
+    return lines
+
+
+def index_corpus(root, shard_dir, cindex):
+    """
+    Builds one shard per org, shard_dir/github/<org>.index, with cindex.
+    """
+    vcs_dir = os.path.join(root, VCS_LOC)
+    for org in sorted(os.listdir(vcs_dir)):
+        shard = os.path.join(shard_dir, VCS_LOC, org + '.index')
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        if os.path.exists(shard):
+            os.remove(shard)
+        org_dir = os.path.join(vcs_dir, org)
+        repo_dirs = [os.path.join(org_dir, repo) for repo in sorted(os.listdir(org_dir))]
+        subprocess.check_call([cindex] + repo_dirs, env=dict(os.environ, CSEARCHINDEX=shard),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - s)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'max': max(times)}
+
+
+def run(root, shard_dir, bin_path, backend='csearch', repeat=5, queries=QUERIES):
+    """
+    Times every stage of every query against an indexed corpus. Returns the
+    timings of each query, keyed by its name.
+    """
+    results = {}
+    # settings are read at import time, so the search code is pointed at the
+    # corpus the same way the tests do it
+    metadata = RepoMetadata(os.path.join(root, '.repo-metadata.json'))
+    with patch.multiple(views, CODE_ROOT=root, BIN_PATH=bin_path, SEARCH_BACKEND=backend, repo_metadata=metadata), \
+            patch('ui.index.INDEX_SHARDS', shard_dir):
+        for name, query, case_sensitive in queries:
+            lines = []
+
+            def search():
+                lines[:] = views.do_search(query, case_sensitive)
+
+            timings = {'search': measure(search, repeat)}
+            timings['parse'] = measure(lambda: views.parse_search_results(lines, query, case_sensitive), repeat)
+            query_re = views.get_query_re(query, case_sensitive)
+            srclines = [line.split(':', 2)[2] for line in lines]
+            timings['highlight'] = measure(lambda: [views.prepare_source_line(query_re, l) for l in srclines], repeat)
+            results_dict, count = views.parse_search_results(lines, query, case_sensitive)
+            timings['render'] = measure(lambda: ''.join(views.render_search_results(results_dict)), repeat)
+            results[name] = {'query': query, 'case_sensitive': case_sensitive, 'matches': count,
+                             'output_bytes': sum(len(line) + 1 for line in lines), 'stages': timings}
+    return results
+
+
+def report(corpus, backend, repeat, results):
+    return {
+        'version': 1,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'backend': backend,
+        'repeat': repeat,
+        'corpus': corpus,
+        'queries': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL, encoding='utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(baseline, current):
+    """
+    Compares the median timings of two reports, returning a
+    (query, stage, baseline, current, ratio) tuple for every query and stage
+    the two have in common.
+    """
+    rows = []
+    for name, result in current['queries'].items():
+        before = baseline['queries'].get(name)
+        if before is None:
+            continue
+        for stage, timing in result['stages'].items():
+            if stage not in before['stages']:
+                continue
+            old, new = before['stages'][stage]['median'], timing['median']
+            rows.append((name, stage, old, new, new / old if old else float('inf')))
+    return rows
@@ -0,0 +1,223 @@
+"""
+A django cache backend backed by a local sqlite file, so that every uwsgi
+process on the box shares the same cache. Unlike django's own file and
+database backends, its size is bounded in bytes (MAX_BYTES) and the least
+recently used entries are evicted first.
+
+Reads don't write: the access times of hits are kept in memory and written
+in batches (ACCESS_BATCH hits, or every ACCESS_INTERVAL seconds), and the
+least recently used entries are only looked for once the running total of
+the entries' sizes, kept by triggers, goes over MAX_BYTES.
+
+    CACHES = {
+        'search': {
+            'BACKEND': 'ui.cache.SQLiteLRUCache',
+            'LOCATION': '/var/tmp/botanist-search-cache.sqlite3',
+            'OPTIONS': {'MAX_BYTES': 256 * 1024 * 1024},
+        },
+    }
+"""
+
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+CREATE TABLE IF NOT EXISTS cache_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(size), 0) FROM cache;
+CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+    UPDATE cache_size SET total = total + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+    UPDATE cache_size SET total = total - OLD.size;
+END;
+"""
+
+# culling stops once the cache is down to this fraction of MAX_BYTES, so
+# that a full cache isn't culled again on the very next set
+CULL_TO = 0.9
+
+
+class SQLiteLRUCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.location = location
+        self.max_bytes = int(options.get('MAX_BYTES', 256 * 1024 * 1024))
+        self.access_batch = int(options.get('ACCESS_BATCH', 100))
+        self.access_interval = float(options.get('ACCESS_INTERVAL', 10))
+        self._local = threading.local()
+
+    @property
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.location, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE only fires the delete trigger for the row it
+            # replaces with recursive triggers on
+            db.execute('PRAGMA recursive_triggers=ON')
+            db.executescript('BEGIN IMMEDIATE;' + SCHEMA + 'COMMIT;')
+            self._local.db = db
+            self._local.accessed = {}
+            self._local.accessed_since = time.time()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _record_access(self, key, now):
+        accessed = self._local.accessed
+        accessed[key] = now
+        if len(accessed) >= self.access_batch or now - self._local.accessed_since >= self.access_interval:
+            self._write_accesses()
+
+    def _write_accesses(self):
+        accessed = self._local.accessed
+        self._local.accessed = {}
+        self._local.accessed_since = time.time()
+        if not accessed:
+            return
+        try:
+            with self._transaction():
+                self._db.executemany(
+                    'UPDATE cache SET accessed = MAX(accessed, ?) WHERE key = ?',
+                    [(now, key) for key, now in accessed.items()]
+                )
+        except sqlite3.OperationalError as e:
+            # they're only used to pick what to evict, so losing a batch
+            # isn't worth failing a request for
+            log.warning('unable to write access times to cache %s: %s', self.location, e)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        try:
+            row = self._db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            value, expires = row
+            if expires is not None and expires <= now:
+                self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return default
+            self._record_access(key, now)
+        except sqlite3.OperationalError as e:
+            # e.g. the database is locked by a long write in another process,
+            # treat it as a miss rather than failing the request
+            log.warning('unable to read from cache %s: %s', self.location, e)
+            return default
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set({key: value}, timeout, version, 'INSERT OR REPLACE')
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._set(data, timeout, version, 'INSERT OR REPLACE')
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return not self._set({key: value}, timeout, version, 'INSERT OR IGNORE')
+
+    def _set(self, data, timeout, version, verb):
+        """
+        Writes data in one transaction, then culls the cache if it has
+        grown over max_bytes. Returns the keys that were not written.
+        """
+        now = time.time()
+        expires = self.get_backend_timeout(timeout)
+        rows, failed = [], []
+        for key, value in data.items():
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if len(value) > self.max_bytes:
+                failed.append(key)
+            else:
+                rows.append((key, self.make_and_validate_key(key, version=version), value))
+        try:
+            with self._transaction():
+                for key, cache_key, value in rows:
+                    if verb == 'INSERT OR IGNORE':
+                        # an expired entry must not stop add() from writing
+                        self._db.execute('DELETE FROM cache WHERE key = ? AND expires IS NOT NULL AND expires <= ?',
+                                         (cache_key, now))
+                    cursor = self._db.execute(
+                        '%s INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)' % verb,
+                        (cache_key, value, len(value), expires, now)
+                    )
+                    if cursor.rowcount == 0:
+                        failed.append(key)
+            if self.total_size() > self.max_bytes:
+                self._cull()
+        except sqlite3.OperationalError as e:
+            log.warning('unable to write to cache %s: %s', self.location, e)
+            return list(data)
+        return failed
+
+    def _cull(self):
+        # drop expired entries, then the least recently used ones until the
+        # cache is down to CULL_TO of max_bytes
+        self._write_accesses()
+        with self._transaction():
+            self._db.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            self._db.execute(
+                'DELETE FROM cache WHERE key IN ('
+                '  SELECT key FROM ('
+                '    SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS running_size FROM cache'
+                '  ) WHERE running_size > ?'
+                ')',
+                (int(self.max_bytes * CULL_TO),)
+            )
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._db.execute('UPDATE cache SET expires = ? WHERE key = ?', (self.get_backend_timeout(timeout), key))
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._db.execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def clear(self):
+        self._db.execute('DELETE FROM cache')
+        self._local.accessed = {}
+
+    def total_size(self):
+        return self._db.execute('SELECT total FROM cache_size').fetchone()[0]
+
+    def close(self, **kwargs):
+        # connections are kept open for the lifetime of each thread, since
+        # django calls close() at the end of every request
+        pass
@@ -0,0 +1,205 @@
+"""
+Searches commit messages, authors and SHAs.
+
+build_commit_index.py writes every repository's history to
+COMMIT_INDEX_DIR/logs/vcs_loc/org/repo/*.log after each fetch, one commit
+per line (SHA, author date, author and message, tab separated, with the
+message's newlines replaced by LINE_SEPARATOR), and indexes each org's logs
+into a shard, COMMIT_INDEX_DIR/shards/vcs_loc/org.index. A search is csearch
+against every shard at once, so the query matches anywhere in a commit's
+line, and git is never run while searching.
+
+The shards are read one after the other, in the path order a single index
+would list them in, and the commits kept in a heap of the newest
+max_results as they're read. Only the first MAX_COMMIT_SCAN matches are
+read, which bounds the time a very common query takes; past that the newest
+commits of the repos later in path order can be missed.
+
+A scope limits the search to the shards of its vcs locations and orgs, and
+to its repos within them. Its path glob doesn't apply to commits and is
+ignored.
+"""
+
+import glob
+import heapq
+import itertools
+import logging
+import os
+import signal
+import time
+
+from contextlib import nullcontext
+from datetime import datetime
+from os import path
+from subprocess import PIPE
+from subprocess import Popen
+
+from codesearch.settings import BIN_PATH
+from codesearch.settings import COMMIT_INDEX_DIR
+from codesearch.settings import MAX_COMMIT_RESULTS
+from codesearch.settings import MAX_COMMIT_SCAN
+from ui.scope import alternation
+from ui.scope import escape
+from ui.scope import select_shards
+
+LOGS = 'logs'
+LOG_SUFFIX = '.log'
+SHARDS = 'shards'
+SHARD_SUFFIX = '.index'
+LINE_SEPARATOR = '\x1e'
+
+COMMIT_LINK_TEMPLATES = {
+    'bitbucket': 'https://bitbucket.org/%(repo)s/commits/%(sha)s',
+    'github': 'https://github.com/%(repo)s/commit/%(sha)s',
+}
+
+log = logging.getLogger(__name__)
+
+
+class CommitIndexMissingError(Exception):
+    pass
+
+
+class CommitSearchError(Exception):
+    pass
+
+
+def log_dir():
+    return path.join(COMMIT_INDEX_DIR, LOGS)
+
+
+def get_commit_shards(scope=None):
+    """
+    Returns the commit index shards that can hold commits in scope, in path
+    order. Raises CommitIndexMissingError if there are none at all.
+    """
+    shard_dir = path.join(COMMIT_INDEX_DIR, SHARDS)
+    shards = sorted(glob.glob(path.join(shard_dir, '*', '*' + SHARD_SUFFIX)))
+    if not shards:
+        raise CommitIndexMissingError('commit messages have not been indexed yet.')
+    return select_shards(shards, shard_dir, scope)
+
+
+def log_file_regex(scope, logs):
+    """
+    Returns a regex matching the paths of the commit logs in scope, for
+    csearch -f.
+    """
+    if scope is None or not (scope.vcs_locs or scope.orgs or scope.repos):
+        return None
+    vcs = alternation(scope.vcs_locs) if scope.vcs_locs else '[^/]+'
+    names = [escape(org) + '/[^/]+' for org in scope.orgs] + [escape(repo) for repo in scope.repos]
+    repo = '(?:%s)' % '|'.join(names) if names else '[^/]+/[^/]+'
+    return '^%s/%s/%s/' % (escape(logs.rstrip('/')), vcs, repo)
+
+
+def search_commits(query, case_sensitive=True, scope=None, deadline=None, max_results=MAX_COMMIT_RESULTS,
+                   max_scan=MAX_COMMIT_SCAN, stats=None):
+    """
+    Returns the newest max_results commits matching query, newest first, as
+    (commits, count, truncated). truncated is set when more commits matched
+    than are returned. csearch is killed once max_scan commits have been
+    read, or when the deadline passes.
+    """
+    shards = get_commit_shards(scope)
+    logs = log_dir()
+    cmd = csearch_command(query, case_sensitive, log_file_regex(scope, logs))
+    log.info('cmd = %s, shards = %d', cmd, len(shards))
+    # every shard is searched at once, each waits on its full pipe until
+    # the ones before it have been read
+    procs = []
+    try:
+        for shard in shards:
+            procs.append(Popen(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8', errors='replace',
+                               env=dict(os.environ, CSEARCHINDEX=shard), start_new_session=True))
+    except OSError as e:
+        for p in procs:
+            kill(p)
+            p.communicate()
+        raise CommitSearchError(e)
+
+    # (timestamp, n, commit), n breaks ties between commits of the same second
+    newest, scanned, order = [], 0, itertools.count()
+    watch = deadline.watch(lambda: [kill(p) for p in procs]) if deadline is not None else nullcontext()
+    s = time.perf_counter()
+    errors = []
+    try:
+        with watch:
+            for line in itertools.chain.from_iterable(p.stdout for p in procs):
+                if stats is not None:
+                    stats.bytes += len(line)
+                commit = parse_commit(line.rstrip('\n'), logs)
+                if commit is None:
+                    continue
+                if scanned == max_scan:
+                    break
+                scanned += 1
+                item = (commit['timestamp'], next(order), commit)
+                if len(newest) < max_results:
+                    heapq.heappush(newest, item)
+                else:
+                    heapq.heappushpop(newest, item)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                kill(p)
+            _, err = p.communicate()
+            # not zero, see the source for csearch
+            if p.returncode > 1:
+                errors.append(err)
+        if stats is not None:
+            stats.add('csearch', time.perf_counter() - s)
+
+    truncated = scanned > len(newest)
+    if scanned < max_scan and not (deadline is not None and deadline.expired) and errors:
+        raise CommitSearchError(errors[0])
+    commits = [commit for _, _, commit in sorted(newest, reverse=True)]
+    return commits, len(commits), truncated
+
+
+def csearch_command(query, case_sensitive=True, file_re=None):
+    # see views.csearch_command, the query is a single argument and no shell
+    # is involved
+    case_args = [] if case_sensitive else ['-i']
+    file_args = [] if file_re is None else ['-f', file_re]
+    return [path.join(BIN_PATH, 'csearch')] + case_args + file_args + ['--', query]
+
+
+def kill(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # exited in the meantime
+        pass
+
+
+def parse_commit(line, logs):
+    """
+    Parses a line of csearch output, logs/vcs_loc/org/repo/N.log:<commit>,
+    into a commit. Returns None if it isn't one.
+    """
+    filename, sep, text = line.partition(LOG_SUFFIX + ':')
+    parts = path.relpath(filename, logs).split('/')
+    fields = text.split('\t', 3)
+    if not sep or len(parts) != 4 or len(fields) != 4:
+        return None
+    vcs_loc, org, repo_name, _ = parts
+    sha, date, author, message = fields
+    try:
+        timestamp = datetime.fromisoformat(date)
+    except ValueError:
+        return None
+    repo = '%s/%s' % (org, repo_name)
+    lines = message.split(LINE_SEPARATOR)
+    template = COMMIT_LINK_TEMPLATES.get(vcs_loc)
+    return {
+        'repo': repo,
+        'vcs_loc': vcs_loc,
+        'sha': sha,
+        'date': date,
+        'timestamp': timestamp.timestamp(),
+        'author': author,
+        'subject': lines[0],
+        'message': '\n'.join(lines),
+        'link': template % {'repo': repo, 'sha': sha} if template else None,
+    }
@@ -0,0 +1,79 @@
+"""
+Lines of context before and after search matches.
+
+Results are already grouped by file, so each matched file is read exactly
+once no matter how many matches it has, and only its first
+MAX_CONTEXT_FILE_SIZE bytes are read. Context is only added to the page of
+results being shown, never to the whole (cached) search.
+"""
+
+from os import path
+
+from django.utils.html import escape
+
+MAX_CONTEXT_LINES = 10
+MAX_CONTEXT_FILE_SIZE = 1024 * 1024
+
+
+def read_lines(filename, max_size=MAX_CONTEXT_FILE_SIZE):
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read(max_size)
+    except OSError:
+        return []
+    # split on newlines only, the way csearch numbers lines
+    lines = data.split(b'\n')
+    if lines and lines[-1] == b'':
+        lines.pop()
+    return lines
+
+
+def add_context(results, code_root, before=0, after=0, html=True):
+    """
+    Adds 'before' and 'after' lists of {'lineno', 'srcline'} to every result
+    in nested search results.
+    """
+    for fully_qualified_repo_name, vcs_results in results.items():
+        for vcs_loc, repo_results in vcs_results.items():
+            add_repo_context(fully_qualified_repo_name, vcs_loc, repo_results, code_root, before, after, html)
+
+
+def add_repo_context(fully_qualified_repo_name, vcs_loc, repo_results, code_root, before=0, after=0, html=True):
+    """
+    Adds context to the results of one repo, for pages rendered a repo at a
+    time.
+    """
+    for filename, matches in repo_results['files'].items():
+        lines = read_lines(path.join(code_root, vcs_loc, fully_qualified_repo_name, filename))
+        add_file_context(matches, lines, before, after, html)
+
+
+def add_file_context(matches, lines, before=0, after=0, html=True):
+    """
+    Adds context to the matches of one file, which are in line order. Like
+    grep, lines are never repeated: context stops at the next match, and
+    starts after the last line shown with the previous one.
+
+    Matches past the lines read get no context: the file was cut off at
+    MAX_CONTEXT_FILE_SIZE, or it changed since it was indexed.
+    """
+    shown = 0
+    for i, result in enumerate(matches):
+        lineno = result['lineno']
+        if lineno > len(lines):
+            result['before'], result['after'] = [], []
+            continue
+        next_lineno = matches[i + 1]['lineno'] if i + 1 < len(matches) else len(lines) + 1
+        start = max(lineno - before, shown + 1, 1)
+        end = min(lineno + after, next_lineno - 1, len(lines))
+        result['before'] = context_lines(lines, start, lineno - 1, html)
+        result['after'] = context_lines(lines, lineno + 1, end, html)
+        shown = max(end, lineno)
+
+
+def context_lines(lines, start, end, html=True):
+    context = []
+    for lineno in range(start, end + 1):
+        srcline = lines[lineno - 1].decode('utf-8', 'replace').rstrip('\r')
+        context.append({'lineno': lineno, 'srcline': escape(srcline) if html else srcline})
+    return context
@@ -0,0 +1,67 @@
+"""
+Per-request search deadlines.
+
+A search that runs past its deadline is cancelled rather than left to
+finish after the client (or nginx, see uwsgi_read_timeout) has given up:
+the csearch processes are killed from a timer thread, which ends their
+output, and whatever was read up to then is returned as partial results
+marked as timed out.
+"""
+
+import asyncio
+import contextlib
+import threading
+import time
+
+
+class Deadline(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+        self.expired = False
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self):
+        """
+        Returns True once the deadline has passed, for code that can stop
+        itself between steps.
+        """
+        if not self.expired and time.monotonic() >= self.expires_at:
+            self.expired = True
+        return self.expired
+
+    @contextlib.contextmanager
+    def watch(self, cancel):
+        """
+        Calls cancel() from another thread if the deadline passes before the
+        block is done, for work that blocks (like reading from csearch).
+        """
+        def expire():
+            self.expired = True
+            cancel()
+
+        timer = threading.Timer(self.remaining(), expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+
+    @contextlib.contextmanager
+    def watch_async(self, cancel):
+        """
+        Like watch(), for code running in an event loop: cancel() is called
+        from the loop rather than from another thread.
+        """
+        def expire():
+            self.expired = True
+            cancel()
+
+        handle = asyncio.get_running_loop().call_later(self.remaining(), expire)
+        try:
+            yield
+        finally:
+            handle.cancel()
@@ -0,0 +1,452 @@
+"""
+An in-process search engine over the index files cindex writes, used instead
+of running csearch for every query when SEARCH_BACKEND is 'index'.
+
+The index is memory-mapped once per process (and re-opened when cindex
+replaces it). A query is turned into a boolean query over trigrams (see
+plan()), the posting lists of those trigrams narrow the search down to
+candidate files, and only those files are read and matched against the
+regex. Matching lines are yielded in the same format as `csearch -n`, so
+they go through the same parsing pipeline as csearch output.
+
+The index format is the one from github.com/google/codesearch/index:
+
+    "csearch index 1\\n"
+    list of indexed paths, NUL terminated, ending with an empty one
+    list of file names, NUL terminated, ending with an empty one
+    posting lists: a trigram followed by uvarint file id deltas, ending with 0
+    name index: 4 byte offset of each name, plus one for the end of the list
+    posting list index: 3 byte trigram, 4 byte count, 4 byte offset per list
+    trailer: offsets of the 5 sections above, then "\\ncsearch trailr\\n"
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+from functools import lru_cache
+
+# private, but the only way to get at the parse tree of a python regex
+from re import _constants as sre_constants
+from re import _parser as sre_parse
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'csearch index 1\n'
+TRAILER_MAGIC = b'\ncsearch trailr\n'
+POST_ENTRY_SIZE = 3 + 4 + 4
+
+# bounds on the sets of strings tracked while planning a query, past these
+# the plan gets less selective rather than exponentially bigger
+MAX_EXACT = 16
+MAX_SET = 32
+MAX_CLASS = 8
+
+
+class CorruptIndexError(Exception):
+    pass
+
+
+class Index(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        d = self.data
+        if len(d) < len(MAGIC) + 5 * 4 + len(TRAILER_MAGIC) or d[:len(MAGIC)] != MAGIC \
+                or d[-len(TRAILER_MAGIC):] != TRAILER_MAGIC:
+            raise CorruptIndexError('corrupt index: %s' % filename)
+
+        n = len(d) - len(TRAILER_MAGIC) - 5 * 4
+        self.path_data, self.name_data, self.post_data, self.name_index, self.post_index = \
+            struct.unpack('>5I', d[n:n + 5 * 4])
+        self.num_names = (self.post_index - self.name_index) // 4 - 1
+        self.num_posts = (n - self.post_index) // POST_ENTRY_SIZE
+        self.postings = lru_cache(maxsize=1024)(self._postings)
+
+    def close(self):
+        self.data.close()
+
+    def name(self, fileid):
+        off, = struct.unpack_from('>I', self.data, self.name_index + 4 * fileid)
+        start = self.name_data + off
+        return self.data[start:self.data.find(b'\0', start)].decode('utf-8', 'replace')
+
+    def _trigram_at(self, i):
+        off = self.post_index + i * POST_ENTRY_SIZE
+        return self.data[off] << 16 | self.data[off + 1] << 8 | self.data[off + 2]
+
+    def find_list(self, trigram):
+        """
+        Returns the (count, offset) of the posting list for trigram, or
+        (0, 0) if no file contains it.
+        """
+        i = bisect.bisect_left(_TrigramSequence(self), trigram)
+        if i >= self.num_posts or self._trigram_at(i) != trigram:
+            return 0, 0
+        return struct.unpack_from('>II', self.data, self.post_index + i * POST_ENTRY_SIZE + 3)
+
+    def _postings(self, trigram):
+        count, offset = self.find_list(trigram)
+        d, pos = self.data, self.post_data + offset + 3
+        fileid, fileids = -1, []
+        for _ in range(count):
+            delta, shift = 0, 0
+            while True:
+                b = d[pos]
+                pos += 1
+                delta |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            fileid += delta
+            fileids.append(fileid)
+        return frozenset(fileids)
+
+    def files(self, query):
+        """
+        Returns the sorted ids of the files that may match a query from plan().
+        """
+        fileids = self._eval(query)
+        return range(self.num_names) if fileids is None else sorted(fileids)
+
+    def _eval(self, query):
+        # None stands for every file in the index
+        op = query[0]
+        if op == 'all':
+            return None
+        if op == 'none':
+            return frozenset()
+        if op == 'tri':
+            return self.postings(query[1])
+        if op == 'and':
+            # cheapest (single trigram) clauses first, so we can stop as soon
+            # as the intersection is empty
+            result = None
+            for sub in sorted(query[1], key=lambda q: q[0] != 'tri'):
+                fileids = self._eval(sub)
+                if fileids is None:
+                    continue
+                result = fileids if result is None else result & fileids
+                if not result:
+                    break
+            return result
+        if op == 'or':
+            result = frozenset()
+            for sub in query[1]:
+                fileids = self._eval(sub)
+                if fileids is None:
+                    return None
+                result = result | fileids
+            return result
+        raise ValueError('unknown query op: %s' % op)
+
+
+class _TrigramSequence(object):
+    # lets bisect binary search the posting list index in place
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_posts
+
+    def __getitem__(self, i):
+        return self.index._trigram_at(i)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(filename):
+    """
+    Returns the Index for filename, opening it only once per process, or
+    again once cindex has replaced it.
+    """
+    st = os.stat(filename)
+    file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _indexes.get(filename)
+    if cached is not None and cached[0] == file_id:
+        return cached[1]
+
+    with _indexes_lock:
+        cached = _indexes.get(filename)
+        if cached is not None and cached[0] == file_id:
+            return cached[1]
+        log.info('opening index %s', filename)
+        index = Index(filename)
+        # forget the indexes of generations that have since been removed
+        for gone in [name for name in _indexes if not os.path.exists(name)]:
+            del _indexes[gone]
+        # the old mapping is left for the garbage collector, since other
+        # threads may still be searching it
+        _indexes[filename] = (file_id, index)
+        return index
+
+
+def search(filename, query, case_sensitive=True, file_re=None, deadline=None):
+    """
+    Searches the index in filename for query, a regular expression, yielding
+    `csearch -n` style 'path:lineno:line' strings. Like csearch -f, file_re
+    limits the search to files with matching paths. Raises re.error if query
+    isn't a valid regular expression.
+
+    With a deadline (see ui.deadline) the search stops at the first file it
+    gets to after the deadline has passed.
+    """
+    flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+    query_re = compile_regex(query, flags)
+    name_re = compile_regex(file_re, 0) if file_re is not None else None
+    index = get_index(filename)
+    candidates = index.files(plan(query, case_sensitive))
+    log.debug('%d candidate files for %s', len(candidates), query)
+
+    for fileid in candidates:
+        if deadline is not None and deadline.check():
+            log.info('search of %s stopped at the deadline', filename)
+            return
+        name = index.name(fileid)
+        if name_re is not None and not name_re.search(name):
+            continue
+        try:
+            with open(name, 'rb') as f:
+                text = f.read().decode('utf-8', 'replace')
+        except OSError as e:
+            log.debug('unable to read %s: %s', name, e)
+            continue
+        yield from grep(query_re, name, text)
+
+
+@lru_cache(maxsize=256)
+def compile_regex(pattern, flags):
+    # re has a cache of its own, but it is small and shared with everything
+    # else in the process
+    return re.compile(pattern, flags)
+
+
+def grep(query_re, name, text):
+    # find matches in the whole file, then check each one against its line
+    # alone, since grep semantics don't allow matches to span lines
+    pos, lineno, counted = 0, 0, 0
+    while True:
+        m = query_re.search(text, pos)
+        if m is None:
+            return
+        start = text.rfind('\n', 0, m.start()) + 1
+        end = text.find('\n', m.start())
+        if end == -1:
+            end = len(text)
+        line = text[start:end]
+        if query_re.search(line):
+            lineno += text.count('\n', counted, start)
+            counted = start
+            # csearch's line numbers are zero based, and parse_search_results
+            # expects that
+            yield '%s:%d:%s' % (name, lineno, line)
+        if end >= len(text):
+            return
+        pos = end + 1
+
+
+# query planning, a simplified version of codesearch's index/regexp.go.
+#
+# Queries are tuples: ('all',) matches every file, ('none',) no file,
+# ('tri', trigram) the files containing trigram, and ('and', [queries]) /
+# ('or', [queries]) combine them.
+
+ALL = ('all',)
+NONE = ('none',)
+
+
+def q_and(*queries):
+    subs = []
+    for q in queries:
+        if q == NONE:
+            return NONE
+        if q == ALL:
+            continue
+        for sub in (q[1] if q[0] == 'and' else [q]):
+            if sub not in subs:
+                subs.append(sub)
+    if not subs:
+        return ALL
+    return subs[0] if len(subs) == 1 else ('and', subs)
+
+
+def q_or(*queries):
+    subs = []
+    for q in queries:
+        if q == ALL:
+            return ALL
+        if q == NONE:
+            continue
+        for sub in (q[1] if q[0] == 'or' else [q]):
+            if sub not in subs:
+                subs.append(sub)
+    if not subs:
+        return NONE
+    return subs[0] if len(subs) == 1 else ('or', subs)
+
+
+def q_string(s):
+    # a string of fewer than 3 bytes doesn't narrow anything down
+    b = s.encode('utf-8')
+    return q_and(*[('tri', b[i] << 16 | b[i + 1] << 8 | b[i + 2]) for i in range(len(b) - 2)])
+
+
+def q_strings(strings):
+    return q_or(*[q_string(s) for s in sorted(strings)])
+
+
+class Info(object):
+    """
+    What is known about the strings a regex (or part of one) matches: either
+    the exact set of them, or sets of prefixes and suffixes they start and
+    end with. In both cases, a file can only contain a match if it matches
+    the query in match.
+    """
+    __slots__ = ('exact', 'prefix', 'suffix', 'match')
+
+    def __init__(self, exact=None, prefix=None, suffix=None, match=ALL):
+        self.exact = exact
+        self.prefix = prefix
+        self.suffix = suffix
+        self.match = match
+
+
+def _empty():
+    return Info(exact={''})
+
+
+def _any():
+    return Info(prefix={''}, suffix={''})
+
+
+def _trim(strings, keep):
+    # shortening prefixes (or suffixes) keeps them true, just less selective
+    for n in (3, 2, 1, 0):
+        if len(strings) <= MAX_SET:
+            break
+        strings = {keep(s, n) for s in strings}
+    return strings
+
+
+def _trim_prefix(strings):
+    return _trim(strings, lambda s, n: s[:n])
+
+
+def _trim_suffix(strings):
+    return _trim(strings, lambda s, n: s[len(s) - n:])
+
+
+def _cross(xs, ys):
+    return {x + y for x in xs for y in ys}
+
+
+def _inexact(info):
+    if info.exact is None:
+        return info
+    return Info(prefix=_trim_prefix(info.exact), suffix=_trim_suffix(info.exact),
+                match=q_and(info.match, q_strings(info.exact)))
+
+
+def _concat(x, y):
+    if x.exact is not None and y.exact is not None and len(x.exact) * len(y.exact) <= MAX_EXACT:
+        return Info(exact=_cross(x.exact, y.exact), match=q_and(x.match, y.match))
+
+    prefix = _trim_prefix(_cross(x.exact, _inexact(y).prefix)) if x.exact is not None else x.prefix
+    suffix = _trim_suffix(_cross(_inexact(x).suffix, y.exact)) if y.exact is not None else y.suffix
+    x, y = _inexact(x), _inexact(y)
+    match = q_and(x.match, y.match)
+    if len(x.suffix) * len(y.prefix) <= MAX_SET:
+        # whatever x's match ends with is followed by what y's starts with
+        match = q_and(match, q_strings(_cross(x.suffix, y.prefix)))
+    return Info(prefix=prefix, suffix=suffix, match=match)
+
+
+def _alternate(x, y):
+    if x.exact is not None and y.exact is not None and len(x.exact | y.exact) <= MAX_EXACT:
+        return Info(exact=x.exact | y.exact, match=q_or(x.match, y.match))
+    x, y = _inexact(x), _inexact(y)
+    return Info(prefix=_trim_prefix(x.prefix | y.prefix), suffix=_trim_suffix(x.suffix | y.suffix),
+                match=q_or(x.match, y.match))
+
+
+def _chars(c, ignore_case):
+    c = chr(c)
+    return {c, c.lower(), c.upper()} if ignore_case else {c}
+
+
+def _analyze(pattern, ignore_case):
+    info = _empty()
+    for op, av in pattern:
+        info = _concat(info, _analyze_node(op, av, ignore_case))
+    return info
+
+
+def _analyze_node(op, av, ignore_case):
+    if op == sre_constants.LITERAL:
+        return Info(exact=_chars(av, ignore_case))
+    if op == sre_constants.IN:
+        chars = set()
+        for item_op, item_av in av:
+            if item_op == sre_constants.LITERAL:
+                chars |= _chars(item_av, ignore_case)
+            elif item_op == sre_constants.RANGE and item_av[1] - item_av[0] < MAX_CLASS:
+                for c in range(item_av[0], item_av[1] + 1):
+                    chars |= _chars(c, ignore_case)
+            else:
+                # negated classes, categories like \w and big ranges
+                return _any()
+        return Info(exact=chars) if 0 < len(chars) <= MAX_CLASS else _any()
+    if op == sre_constants.SUBPATTERN:
+        group, add_flags, del_flags, p = av
+        if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+            ignore_case = True
+        if del_flags & sre_constants.SRE_FLAG_IGNORECASE:
+            ignore_case = False
+        return _analyze(p, ignore_case)
+    if op == sre_constants.ATOMIC_GROUP:
+        return _analyze(av, ignore_case)
+    if op == sre_constants.BRANCH:
+        info = None
+        for p in av[1]:
+            branch = _analyze(p, ignore_case)
+            info = branch if info is None else _alternate(info, branch)
+        return info
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, sre_constants.POSSESSIVE_REPEAT):
+        lo, hi, p = av
+        if hi == 0:
+            return _empty()
+        sub = _analyze(p, ignore_case)
+        if lo == 0:
+            return _alternate(sub, _empty()) if hi == 1 else _any()
+        if lo == 1 and hi == 1:
+            return sub
+        # one or more repetitions start and end like a single one
+        sub = _inexact(sub)
+        return Info(prefix=sub.prefix, suffix=sub.suffix, match=sub.match)
+    if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        # zero width
+        return _empty()
+    # ANY, NOT_LITERAL, back references and anything else we don't know
+    # much about
+    return _any()
+
+
+def plan(query, case_sensitive=True):
+    """
+    Returns the trigram query that every file containing a match for the
+    regular expression query must satisfy.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    parsed = sre_parse.parse(query, flags)
+    info = _analyze(parsed, bool(parsed.state.flags & re.IGNORECASE))
+    if info.exact is not None:
+        return q_and(info.match, q_strings(info.exact))
+    return q_and(info.match, q_strings(info.prefix), q_strings(info.suffix))
@@ -0,0 +1,109 @@
+"""
+Where the csearch indexes are, and which generation of them is current.
+
+build_index.py builds each generation of shards into its own directory,
+INDEX_SHARDS/generations/<id>, and switches the INDEX_SHARDS/current
+symlink to it once it is complete. Shards built before there were
+generations sit straight in INDEX_SHARDS, and are still searched if there
+is no current generation.
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+from datetime import datetime
+from datetime import timezone
+
+from codesearch.settings import CSEARCHINDEX
+from codesearch.settings import INDEX_SHARDS
+from ui.scope import select_shards
+
+SHARD_SUFFIX = '.index'
+CURRENT = 'current'
+GENERATION_FILE = 'generation.json'
+
+
+def get_shards(scope=None):
+    """
+    Returns the csearch index files to search, in order. These are the
+    per-org shards built by build_index.py (INDEX_SHARDS/vcs_loc/org.index),
+    or the single CSEARCHINDEX if no shards have been built. With a scope,
+    only the shards that can hold files in it are returned.
+    """
+    shard_dir = current_generation_dir() or INDEX_SHARDS
+    shards = sorted(glob.glob(os.path.join(shard_dir, '*', '*' + SHARD_SUFFIX)))
+    return select_shards(shards or [CSEARCHINDEX], shard_dir, scope)
+
+
+def current_generation_dir():
+    """
+    Returns the directory of the current generation of shards, resolved, so
+    that a search's shards all come from the same one even if it changes
+    while they are being listed. Returns None if there is none.
+    """
+    try:
+        return os.path.join(INDEX_SHARDS, os.readlink(os.path.join(INDEX_SHARDS, CURRENT)))
+    except OSError:
+        return None
+
+
+def get_generation_info():
+    """
+    Returns what build_index.py recorded about the current generation (its
+    id, when it was built and when it was last checked for changes), or
+    None if there is no current generation.
+    """
+    generation_dir = current_generation_dir()
+    if generation_dir is None:
+        return None
+    try:
+        with open(os.path.join(generation_dir, GENERATION_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_last_indexed():
+    """
+    Returns when the code was last indexed, as an aware datetime, or None
+    if it never was. That's when the current generation was built: runs of
+    build_index.py that found nothing to rebuild only update its
+    checked_at, and the code searched is no newer for them.
+    """
+    info = get_generation_info()
+    if info is not None and info.get('built_at'):
+        return datetime.strptime(info['built_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    mtimes = []
+    for shard in get_shards():
+        try:
+            mtimes.append(os.stat(shard).st_mtime)
+        except OSError:
+            continue
+    if not mtimes:
+        return None
+    return datetime.fromtimestamp(max(mtimes), timezone.utc)
+
+
+def get_index_generation():
+    """
+    Identifies the csearch indexes that searches currently run against:
+    the id of the current generation. Without generations, it's derived
+    from the shards themselves, since cindex writes a new index next to the
+    old one and renames it into place when it's done. Returns None if there
+    is no index yet.
+    """
+    info = get_generation_info()
+    if info is not None and info.get('id'):
+        return info['id']
+    stats = []
+    for shard in get_shards():
+        try:
+            st = os.stat(shard)
+        except OSError:
+            continue
+        stats.append('%s:%d-%d-%d' % (shard, st.st_ino, st.st_mtime_ns, st.st_size))
+    if not stats:
+        return None
+    return hashlib.sha1('\n'.join(stats).encode('utf-8')).hexdigest()[:20]
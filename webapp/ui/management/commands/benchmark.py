@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import tempfile
+
+from os import path
+
+from django.core.management.base import BaseCommand
+
+from codesearch.settings import BIN_PATH
+from ui import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks searching, parsing, highlighting and rendering against a generated corpus '
+            '(see ui.benchmark) and writes the timings as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', help='where to generate the corpus and its index, kept between runs '
+                                           '(default: a temporary directory)')
+        parser.add_argument('--orgs', type=int, default=4)
+        parser.add_argument('--repos', type=int, default=10, help='repos per org')
+        parser.add_argument('--files', type=int, default=50, help='files per repo')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5, help='times each stage is run')
+        parser.add_argument('--backend', choices=['csearch', 'index'], default='csearch')
+        parser.add_argument('--bin-path', default=BIN_PATH, help='where csearch and cindex are')
+        parser.add_argument('-o', '--output', help='write the JSON results here (default: stdout)')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=1.2,
+                            help='flag stages at least this many times slower than the baseline')
+
+    def handle(self, *args, **options):
+        root = options['root'] or tempfile.mkdtemp(prefix='botanist-benchmark-')
+        try:
+            report = self.benchmark(root, options)
+        finally:
+            if not options['root']:
+                shutil.rmtree(root)
+
+        output = json.dumps(report, indent=1, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            self.compare(baseline, report, options['threshold'])
+
+    def benchmark(self, root, options):
+        corpus = benchmark.generate_corpus(root, options['orgs'], options['repos'], options['files'],
+                                           options['seed'])
+        shard_dir = path.join(root, '.shards')
+        self.stderr.write('indexing %(files)d files (%(lines)d lines, %(bytes)d bytes)' % corpus)
+        benchmark.index_corpus(root, shard_dir, path.join(options['bin_path'], 'cindex'))
+        results = benchmark.run(root, shard_dir, options['bin_path'], options['backend'], options['repeat'])
+        return benchmark.report(corpus, options['backend'], options['repeat'], results)
+
+    def compare(self, baseline, report, threshold):
+        if baseline.get('corpus') != report['corpus']:
+            self.stderr.write('warning: the baseline was run against a different corpus')
+        if baseline.get('backend') != report['backend']:
+            self.stderr.write('warning: the baseline was run with the %s backend' % baseline.get('backend'))
+        self.stderr.write('%-18s %-10s %12s %12s %8s' % ('query', 'stage', 'baseline', 'current', 'ratio'))
+        for name, stage, old, new, ratio in benchmark.compare(baseline, report):
+            flag = '  slower' if ratio >= threshold else ''
+            self.stderr.write('%-18s %-10s %11.2fms %11.2fms %7.2fx%s' % (name, stage, old * 1000, new * 1000, ratio, flag))
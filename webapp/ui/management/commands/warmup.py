@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from codesearch.settings import QUERY_LOG_DAYS
+from codesearch.settings import WARMUP_DAYS
+from codesearch.settings import WARMUP_QUERIES
+from ui import querylog
+from ui import warmup
+
+
+class Command(BaseCommand):
+    help = ('Prefaults the current index generation into the page cache and replays the most popular searches '
+            'of the query log against it (see ui.warmup), at idle priority.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=WARMUP_QUERIES,
+                            help='how many of the most popular searches to replay (0 for none)')
+        parser.add_argument('--days', type=int, default=WARMUP_DAYS,
+                            help='replay the most popular searches of this many days')
+        parser.add_argument('--no-prefault', action='store_true', help="don't read the index into the page cache")
+
+    def handle(self, *args, **options):
+        warmup.lower_priority()
+        deleted = querylog.prune(QUERY_LOG_DAYS)
+        if deleted:
+            self.stderr.write('pruned %d searches older than %d days from the query log' % (deleted, QUERY_LOG_DAYS))
+        if not options['no_prefault']:
+            total = warmup.prefault_index()
+            self.stderr.write('prefaulted %d bytes of index' % total)
+        searches = querylog.popular_searches(options['queries'], options['days']) if options['queries'] else []
+        replayed = warmup.replay(searches)
+        self.stderr.write('replayed %d of the %d most popular searches' % (replayed, len(searches)))
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class RepoMetadata(object):
+    """
+    In-memory copy of the repository metadata file that github_backup.py
+    writes while fetching. It maps 'vcs_loc/org/repo' to a dict with the
+    repo_type, vcs_loc, default_branch and last fetched commit of each
+    repository, so searches don't have to inspect repositories on disk.
+
+    The file is re-read whenever it changes on disk (see refresh()).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._file_id = None
+        self._repos = {}
+
+    def refresh(self):
+        """
+        Reloads the metadata file if it was replaced or modified since it was
+        last read. This is a single stat() call when nothing changed.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            self._file_id, self._repos = None, {}
+            return
+
+        file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if file_id == self._file_id:
+            return
+
+        with self._lock:
+            if file_id == self._file_id:
+                return
+            try:
+                with open(self.filename) as f:
+                    repos = json.load(f).get('repos', {})
+            except (OSError, ValueError) as e:
+                log.warning('unable to load repository metadata from %s: %s', self.filename, e)
+                return
+            log.info('loaded metadata for %d repositories from %s', len(repos), self.filename)
+            self._file_id, self._repos = file_id, repos
+
+    def get(self, vcs_loc, fully_qualified_repo_name):
+        return self._repos.get('%s/%s' % (vcs_loc, fully_qualified_repo_name))
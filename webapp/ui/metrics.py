@@ -0,0 +1,89 @@
+"""
+Per-stage latency metrics of searches, sent to datadog's statsd next to the
+spt.codesearcher.git.* and spt.codesearcher.index.* metrics of
+github_backup.py and build_index.py.
+
+The stages of a search run interleaved (csearch output is parsed as it is
+read), so each stage's time is added up as the pipeline runs:
+
+- csearch: waiting for output from csearch, or from the in-process index
+- parse: parsing and highlighting its lines
+- metadata: looking up repo metadata and default branches
+- context: reading lines of context
+- render: rendering the page or serializing json
+
+Once a response is done they are sent as spt.codesearcher.search.<stage>.duration
+histograms, along with the total duration, bytes of csearch output, result
+counts and truncations, all tagged by endpoint, case sensitivity, outcome
+(ok, timed_out, invalid, busy, error or disconnected) and whether the
+results came from the cache.
+
+Searches are also recorded in the query log, see ui.querylog.
+"""
+
+import contextlib
+import logging
+import time
+
+from collections import defaultdict
+
+from datadog import initialize, statsd
+
+from ui.querylog import record_search
+
+PREFIX = 'spt.codesearcher.search'
+
+log = logging.getLogger(__name__)
+
+initialize()
+
+
+class SearchStats(object):
+    def __init__(self, endpoint, case_sensitive=True, query=None, scope=None):
+        self.endpoint = endpoint
+        self.case_sensitive = case_sensitive
+        self.query = query
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.bytes = 0
+        self.results = None
+        self.truncated = False
+        self.cached = False
+        self.sent = False
+
+    def add(self, stage, seconds):
+        self.durations[stage] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        s = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - s)
+
+    def send(self, outcome):
+        if self.sent:
+            return
+        self.sent = True
+        duration = time.perf_counter() - self.started
+        tags = [
+            'endpoint:%s' % self.endpoint,
+            'case:%s' % ('sensitive' if self.case_sensitive else 'insensitive'),
+            'outcome:%s' % outcome,
+            'cached:%s' % ('true' if self.cached else 'false'),
+        ]
+        statsd.increment(PREFIX + '.requests', tags=tags)
+        statsd.histogram(PREFIX + '.duration', duration, tags=tags)
+        for stage, seconds in self.durations.items():
+            statsd.histogram('%s.%s.duration' % (PREFIX, stage), seconds, tags=tags)
+        if not self.cached:
+            statsd.histogram(PREFIX + '.csearch.bytes', self.bytes, tags=tags)
+        if self.results is not None:
+            statsd.histogram(PREFIX + '.results', self.results, tags=tags)
+        if self.truncated:
+            statsd.increment(PREFIX + '.truncated', tags=tags)
+        log.info('%s %s in %.3fs: %s', self.endpoint, outcome, duration,
+                 ' '.join('%s=%.3fs' % (stage, seconds) for stage, seconds in sorted(self.durations.items())))
+        record_search(self, outcome, duration)
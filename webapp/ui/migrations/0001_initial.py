@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('endpoint', models.CharField(max_length=32)),
+                ('query', models.TextField()),
+                ('case_sensitive', models.BooleanField(default=True)),
+                ('scope', models.TextField(blank=True, default='')),
+                ('outcome', models.CharField(max_length=16)),
+                ('duration', models.FloatField()),
+                ('results', models.IntegerField(null=True)),
+                ('truncated', models.BooleanField(default=False)),
+                ('cached', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import models
+
+
+class QueryLog(models.Model):
+    """
+    One search, as recorded by ui.querylog once it's done. What users search
+    for most is replayed against every new index generation (see ui.warmup).
+    """
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # search, search_json or search_ndjson
+    endpoint = models.CharField(max_length=32)
+    query = models.TextField()
+    case_sensitive = models.BooleanField(default=True)
+    # the scope's request parameters, urlencoded (see ui.scope.scope_params)
+    scope = models.TextField(blank=True, default='')
+    # ok, timed_out, invalid, busy, error or disconnected, as in ui.metrics
+    outcome = models.CharField(max_length=16)
+    duration = models.FloatField()
+    results = models.IntegerField(null=True)
+    truncated = models.BooleanField(default=False)
+    cached = models.BooleanField(default=False)
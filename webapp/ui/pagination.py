@@ -0,0 +1,89 @@
+"""
+Cursor based pagination of search results.
+
+The first time a page of a search is requested, its matches are put in a
+stable order (repo, vcs location, file, line) and spooled into the search
+cache in fixed size chunks. A cursor is the index generation plus the offset
+of the next match, so later pages only load the chunks they overlap rather
+than re-running or re-parsing the whole search. Cursors stop working once a
+new index is built, since the same search could give different results.
+"""
+
+import base64
+import json
+
+from collections import namedtuple
+
+SPOOL_CHUNK_SIZE = 1000
+
+Page = namedtuple('Page', 'results count truncated offset size next_cursor timed_out')
+
+
+class CursorError(Exception):
+    pass
+
+
+def encode_cursor(generation, offset):
+    raw = json.dumps([generation, offset]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        generation, offset = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError('invalid cursor: %s' % cursor)
+    if not isinstance(offset, int) or offset < 0:
+        raise CursorError('invalid cursor: %s' % cursor)
+    return generation, offset
+
+
+def ordered_matches(results):
+    """
+    Flattens nested search results into
+    (fully_qualified_repo_name, vcs_loc, filename, result) tuples, ordered by
+    repo, vcs location, file and line.
+    """
+    for fully_qualified_repo_name in sorted(results):
+        for vcs_loc in sorted(results[fully_qualified_repo_name]):
+            files = results[fully_qualified_repo_name][vcs_loc]['files']
+            for filename in sorted(files):
+                for result in sorted(files[filename], key=lambda r: r['lineno']):
+                    yield fully_qualified_repo_name, vcs_loc, filename, result
+
+
+def write_spool(cache, key, results, truncated, timeout, timed_out=False):
+    """
+    Spools the matches of a search into the cache under key. Returns the
+    spool's header and the full list of ordered matches.
+    """
+    matches = list(ordered_matches(results))
+    chunks = {}
+    for i in range(0, len(matches), SPOOL_CHUNK_SIZE):
+        chunks['%s:%d' % (key, i // SPOOL_CHUNK_SIZE)] = matches[i:i + SPOOL_CHUNK_SIZE]
+    cache.set_many(chunks, timeout)
+
+    spool = {'count': len(matches), 'truncated': truncated, 'timed_out': timed_out, 'chunks': len(chunks)}
+    cache.set(key, spool, timeout)
+    return spool, matches
+
+
+def read_spool(cache, key, spool, offset, page_size):
+    """
+    Reads page_size matches starting at offset from a spool. Returns None if
+    any of the chunks needed were evicted from the cache.
+    """
+    if offset >= spool['count']:
+        return []
+
+    first = offset // SPOOL_CHUNK_SIZE
+    last = min((offset + page_size - 1) // SPOOL_CHUNK_SIZE, spool['chunks'] - 1)
+    keys = ['%s:%d' % (key, i) for i in range(first, last + 1)]
+    chunks = cache.get_many(keys)
+    if len(chunks) != len(keys):
+        return None
+
+    matches = [match for k in keys for match in chunks[k]]
+    start = offset - first * SPOOL_CHUNK_SIZE
+    return matches[start:start + page_size]
@@ -0,0 +1,150 @@
+"""
+A log of the searches users run, kept in the database (see ui.models) for
+QUERY_LOG_DAYS days.
+
+SearchStats.send() records every search once its response is done, with its
+query, case sensitivity, scope, outcome, timing and result counts. The log
+is what `manage.py warmup` replays against a new index (see ui.warmup).
+
+Recording a search only appends it to an in-memory buffer, so neither the
+blocking nor the asyncio views ever wait on the database. A writer thread
+per process inserts the buffer in batches every QUERY_LOG_FLUSH_INTERVAL
+seconds (sooner once BATCH_SIZE searches are waiting), so the processes
+sharing the sqlite file take its write lock once per batch rather than once
+per search. Recording never fails a search: if the buffer is full searches
+are dropped, and database errors are only logged.
+"""
+
+import atexit
+import logging
+import os
+import threading
+
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.db import DatabaseError
+from django.db import connection
+from django.db.models import Count
+from django.db.models import Max
+from django.utils import timezone
+
+from codesearch.settings import QUERY_LOG
+from codesearch.settings import QUERY_LOG_DAYS
+from codesearch.settings import QUERY_LOG_FLUSH_INTERVAL
+from ui.models import QueryLog
+from ui.scope import scope_params
+
+# the endpoints of code searches, the ones worth replaying against a new index
+CODE_SEARCH_ENDPOINTS = ('search', 'search_json', 'search_ndjson')
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+# searches kept waiting at most, when the database can't keep up
+MAX_BUFFERED = 10000
+
+# searches waiting to be written, and the writer thread of this process
+# (uwsgi forks its workers, which don't inherit the master's threads)
+buffer = []
+lock = threading.Lock()
+batch_ready = threading.Event()
+writer = None
+
+
+def record_search(stats, outcome, duration):
+    """
+    Records a finished search, described by its SearchStats.
+    """
+    if not QUERY_LOG or stats.query is None:
+        return
+    entry = QueryLog(endpoint=stats.endpoint, query=stats.query, case_sensitive=stats.case_sensitive,
+                     scope=encode_scope(stats.scope), outcome=outcome, duration=duration, results=stats.results,
+                     truncated=stats.truncated, cached=stats.cached)
+    with lock:
+        if len(buffer) >= MAX_BUFFERED:
+            log.warning('query log buffer is full, not recording a search')
+            return
+        buffer.append(entry)
+        if len(buffer) >= BATCH_SIZE:
+            batch_ready.set()
+    start_writer()
+
+
+def start_writer():
+    global writer
+    pid = os.getpid()
+    if writer is not None and writer[0] == pid:
+        return
+    with lock:
+        if writer is not None and writer[0] == pid:
+            return
+        thread = threading.Thread(target=write_batches, name='querylog', daemon=True)
+        thread.start()
+        writer = (pid, thread)
+    atexit.register(flush)
+
+
+def write_batches():
+    while True:
+        batch_ready.wait(QUERY_LOG_FLUSH_INTERVAL)
+        batch_ready.clear()
+        flush()
+        # the connection belongs to this thread, nothing else would close it
+        connection.close()
+
+
+def flush():
+    """
+    Writes the buffered searches to the database. Returns how many were
+    written.
+    """
+    with lock:
+        entries = buffer[:]
+        del buffer[:]
+    if not entries:
+        return 0
+    try:
+        QueryLog.objects.bulk_create(entries)
+    except DatabaseError as e:
+        log.warning('unable to record %d searches in the query log: %s', len(entries), e)
+        return 0
+    return len(entries)
+
+
+def encode_scope(scope):
+    return urlencode(sorted(scope_params(scope).items()), doseq=True)
+
+
+def popular_searches(limit, days):
+    """
+    Returns the code searches run most often in the last days days that
+    found something, most popular first, as dicts of query, case_sensitive,
+    scope, html and count. Searches of the search page are replayed as
+    html, those of results.json and results.ndjson as json.
+    """
+    since = timezone.now() - timedelta(days=days)
+    searches = (QueryLog.objects.filter(created_at__gte=since, outcome='ok', endpoint__in=CODE_SEARCH_ENDPOINTS)
+                .values('query', 'case_sensitive', 'scope', 'endpoint')
+                .annotate(count=Count('id'), last=Max('created_at')))
+    popular = {}
+    for s in searches:
+        html = s['endpoint'] == 'search'
+        key = (s['query'], s['case_sensitive'], s['scope'], html)
+        if key not in popular:
+            popular[key] = {'query': s['query'], 'case_sensitive': s['case_sensitive'], 'scope': s['scope'],
+                            'html': html, 'count': 0, 'last': s['last']}
+        popular[key]['count'] += s['count']
+        popular[key]['last'] = max(popular[key]['last'], s['last'])
+    ranked = sorted(popular.values(), key=lambda s: (s['count'], s['last']), reverse=True)[:limit]
+    for s in ranked:
+        del s['last']
+    return ranked
+
+
+def prune(days=QUERY_LOG_DAYS):
+    """
+    Deletes searches older than days days. Returns how many were deleted.
+    """
+    deleted, _ = QueryLog.objects.filter(created_at__lt=timezone.now() - timedelta(days=days)).delete()
+    return deleted
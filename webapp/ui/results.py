@@ -0,0 +1,102 @@
+"""
+Compact search results.
+
+Broad searches can match hundreds of thousands of lines, so matches are
+slotted Match records rather than dicts. The repo, vcs location, file name
+and deep link of a file are held once, by a SourceFile that all of the
+file's matches point to, and each match's deep link is only built when it
+is rendered. Memory use grows with the number of files matched plus a small
+fixed size per line.
+
+To templates (r.lineno), views (r['lineno']) and JSON (see encode_json())
+a Match still looks like the dict it replaced.
+"""
+
+
+class SourceFile(object):
+    __slots__ = ('vcs_loc', 'repo', 'filename', 'link', 'anchor')
+
+    def __init__(self, vcs_loc, repo, filename, link, anchor):
+        self.vcs_loc = vcs_loc
+        self.repo = repo
+        self.filename = filename
+        # the file's deep link, and the prefix of its line anchors
+        self.link = link
+        self.anchor = anchor
+
+    def deep_link(self, lineno=None):
+        return '%s#%s%s' % (self.link, self.anchor, lineno) if lineno else self.link
+
+
+class Match(object):
+    __slots__ = ('file', 'lineno', 'srcline', 'count', 'spans', 'before', 'after')
+
+    FIELDS = ('filename', 'lineno', 'srcline', 'deeplink', 'count')
+    # only there once they are set, e.g. spans are left out of html results
+    OPTIONAL_FIELDS = ('spans', 'before', 'after')
+
+    def __init__(self, file, lineno, srcline, count, spans=None):
+        self.file = file
+        self.lineno = lineno
+        self.srcline = srcline
+        self.count = count
+        self.spans = spans
+        self.before = None
+        self.after = None
+
+    @property
+    def filename(self):
+        return self.file.filename
+
+    @property
+    def deeplink(self):
+        return self.file.deep_link(self.lineno)
+
+    def keys(self):
+        return self.FIELDS + tuple(k for k in self.OPTIONAL_FIELDS if getattr(self, k) is not None)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS and key not in self.OPTIONAL_FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None and key in self.OPTIONAL_FIELDS:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.OPTIONAL_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {k: self[k] for k in self.keys()}
+
+    def __eq__(self, other):
+        if isinstance(other, Match):
+            other = other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Match(%r)' % self.to_dict()
+
+
+def encode_json(o):
+    """
+    json.dumps default= hook for results holding Matches.
+    """
+    if isinstance(o, Match):
+        return o.to_dict()
+    raise TypeError('%r is not JSON serializable' % o)
@@ -0,0 +1,131 @@
+"""
+Limits a search to some vcs locations, orgs, repos and/or paths within them.
+
+Scopes are pushed down into the search itself rather than applied to its
+output: only the index shards of the selected orgs are searched, and within
+them a file name regex (csearch -f) drops every other file before any of
+them is read. A search of two repos costs about as much as those two repos.
+"""
+
+from collections import namedtuple
+from os import path
+
+Scope = namedtuple('Scope', 'vcs_locs orgs repos path')
+
+# regex metacharacters, escaped by hand because re.escape also escapes
+# characters (like spaces) that csearch's RE2 syntax doesn't allow escaped
+REGEX_SPECIAL = set('\\.+*?()|[]{}^$')
+
+
+class ScopeError(Exception):
+    pass
+
+
+def get_scope(params):
+    """
+    Returns the Scope asked for by the vcs, org, repo (org/repo) and path
+    (a glob) request parameters, or None to search everything.
+    """
+    vcs_locs = sorted(set(v for v in params.getlist('vcs') if v))
+    orgs = sorted(set(o for o in params.getlist('org') if o))
+    repos = sorted(set(r for r in params.getlist('repo') if r))
+    path_glob = params.get('path') or None
+    for name in vcs_locs + orgs:
+        if '/' in name:
+            raise ScopeError('invalid vcs location or org: %s' % name)
+    for repo in repos:
+        if repo.count('/') != 1 or repo.startswith('/') or repo.endswith('/'):
+            raise ScopeError('repos must be given as org/repo: %s' % repo)
+    if not (vcs_locs or orgs or repos or path_glob):
+        return None
+    return Scope(tuple(vcs_locs), tuple(orgs), tuple(repos), path_glob)
+
+
+def scope_params(scope):
+    if scope is None:
+        return {}
+    params = {'vcs': list(scope.vcs_locs), 'org': list(scope.orgs), 'repo': list(scope.repos)}
+    if scope.path:
+        params['path'] = scope.path
+    return params
+
+
+def select_shards(shards, shard_dir, scope):
+    """
+    Returns the shards (shard_dir/vcs_loc/org[.N].index) that can hold files
+    in scope.
+    """
+    if scope is None:
+        return shards
+    orgs = set(scope.orgs) | {repo.split('/')[0] for repo in scope.repos}
+    selected = []
+    for shard in shards:
+        relpath = path.relpath(shard, shard_dir)
+        if relpath.startswith('..') or '/' not in relpath:
+            # not a shard, i.e. the single CSEARCHINDEX
+            selected.append(shard)
+            continue
+        vcs_loc, name = relpath.split('/', 1)
+        org = name.rsplit('.', 1)[0]
+        head, _, tail = org.rpartition('.')
+        if head and tail.isdigit():
+            org = head
+        if scope.vcs_locs and vcs_loc not in scope.vcs_locs:
+            continue
+        if orgs and org not in orgs:
+            continue
+        selected.append(shard)
+    return selected
+
+
+def file_regex(scope, code_root):
+    """
+    Returns a regex matching the full paths of the files in scope, written
+    so that both csearch (RE2) and python's re accept it.
+    """
+    if scope is None:
+        return None
+    vcs = alternation(scope.vcs_locs) if scope.vcs_locs else '[^/]+'
+    names = [escape(org) + '/[^/]+' for org in scope.orgs] + [escape(repo) for repo in scope.repos]
+    repo = '(?:%s)' % '|'.join(names) if names else '[^/]+/[^/]+'
+    return '^%s/%s/%s/%s' % (escape(code_root.rstrip('/')), vcs, repo, glob_regex(scope.path))
+
+
+def glob_regex(glob):
+    """
+    Translates a path glob into a regex for paths relative to a repo. Globs
+    without a slash match file names in any directory (like *.py), others
+    are matched from the root of the repo. * and ? stay within a directory,
+    ** crosses them, and **/ is any number of directories, none included
+    (src/**/x.py matches src/x.py).
+    """
+    if not glob:
+        return ''
+    out = [] if '/' in glob else ['(?:.*/)?']
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        else:
+            out.append(escape(c))
+        i += 1
+    return ''.join(out) + '$'
+
+
+def alternation(names):
+    return '(?:%s)' % '|'.join(escape(name) for name in names)
+
+
+def escape(s):
+    return ''.join('\\' + c if c in REGEX_SPECIAL else c for c in s)
@@ -0,0 +1,5 @@
+from ui import querylog
+
+# the query log's writer thread would write outside of the tests'
+# transactions, tests that look at the log call querylog.flush() instead
+querylog.start_writer = lambda: None
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.test import TestCase
+from django.test import override_settings
+from unittest.mock import patch
+
+from ui.admission import SearchBusyError
+from ui.admission import acquire_slot
+from ui.admission import search_slot
+from ui.admission import singleflight
+from ui.tests.test_do_search import SearchStateMixin
+from ui.views import cached_search
+
+
+# a search with one match, as search_and_group() returns it
+RESULTS = ({'org1/repo1': {'github': {'files': {'a.py': [{'lineno': 1, 'line': 'query'}]}}}}, 1, False)
+
+
+class LockDirMixin(object):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.lock_dir_patch = patch('ui.admission.SEARCH_LOCK_DIR', self.lock_dir)
+        self.lock_dir_patch.start()
+
+    def tearDown(self):
+        self.lock_dir_patch.stop()
+        shutil.rmtree(self.lock_dir)
+
+
+class SearchSlots(LockDirMixin, TestCase):
+
+    def test_busy_once_all_slots_are_taken(self):
+        first = acquire_slot(slots=2, timeout=0)
+        second = acquire_slot(slots=2, timeout=0)
+        with self.assertRaises(SearchBusyError):
+            acquire_slot(slots=2, timeout=0.05)
+
+        first.release()
+        acquire_slot(slots=2, timeout=0).release()
+        second.release()
+
+    def test_a_search_takes_a_slot_per_shard(self):
+        first = acquire_slot(slots=3, timeout=0, count=2)
+        with self.assertRaises(SearchBusyError):
+            acquire_slot(slots=3, timeout=0, count=2)
+        acquire_slot(slots=3, timeout=0).release()
+
+        first.release()
+        # more shards than slots takes all of them
+        acquire_slot(slots=3, timeout=0, count=5).release()
+
+    def test_queued_search_gets_a_released_slot(self):
+        slot = acquire_slot(slots=1, timeout=0)
+        threading.Timer(0.1, slot.release).start()
+        with search_slot(slots=1, timeout=5):
+            pass
+
+
+class SingleFlight(LockDirMixin, TestCase):
+
+    def test_only_identical_searches_wait(self):
+        with singleflight('a', timeout=0):
+            with self.assertRaises(SearchBusyError):
+                with singleflight('a', timeout=0.05):
+                    pass
+            with singleflight('b', timeout=0):
+                pass
+
+    def test_lock_files_are_removed(self):
+        with singleflight('a', timeout=0):
+            pass
+        with singleflight('a', timeout=0):
+            pass
+        self.assertEqual([], os.listdir(self.lock_dir))
+
+
+class CoalescedSearch(LockDirMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches = {'search': {'BACKEND': 'ui.cache.SQLiteLRUCache', 'LOCATION': self.lock_dir + '/cache.sqlite3'}}
+        self.settings_override = override_settings(CACHES=caches)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        super().tearDown()
+
+    @patch('ui.views.get_index_generation', lambda: 'gen-1')
+    @patch('ui.views.search_and_group')
+    def test_identical_concurrent_searches_run_once(self, search_and_group):
+        def slow_search(*args, **kwargs):
+            time.sleep(0.2)
+            return RESULTS
+        search_and_group.side_effect = slow_search
+
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(cached_search('query'))) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, search_and_group.call_count)
+        self.assertEqual([RESULTS] * 3, found)
+
+
+class BusyResponses(SearchStateMixin, TestCase):
+
+    @patch('ui.views.spooled_search')
+    def test_busy_json_search_is_a_503(self, spooled_search):
+        spooled_search.side_effect = SearchBusyError('too many searches')
+        response = self.client.get('/search/results.json', {'q': 'import'})
+
+        self.assertEqual(503, response.status_code)
+        self.assertIn('Retry-After', response)
+
+    @patch('ui.views.acquire_slot')
+    def test_busy_ndjson_search_is_a_503(self, acquire_slot):
+        acquire_slot.side_effect = SearchBusyError('too many searches')
+        response = self.client.get('/search/results.ndjson', {'q': 'import'})
+
+        self.assertEqual(503, response.status_code)
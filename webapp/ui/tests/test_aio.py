@@ -0,0 +1,185 @@
+import asyncio
+import json
+import threading
+import time
+
+from django.test import AsyncRequestFactory
+from django.test import TestCase
+from unittest.mock import patch
+
+from codesearch.asgi import cancel_on_disconnect
+from ui import aio
+from ui.deadline import Deadline
+from ui.tests.test_do_search import ENDLESS_CSEARCH
+from ui.tests.test_do_search import FakeCSearchMixin
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_async_do_search
+from ui.views import CSearchMissingError
+
+LINES = [
+    '/botanist/repos/github/org1/repo1/src/a.py:0:import os',
+    '/botanist/repos/github/org1/repo1/src/b.py:4:    import sys',
+    '/botanist/repos/github/org2/repo1/c.py:9:import re',
+]
+
+
+async def collect(lines):
+    return [line async for line in lines]
+
+
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class AsyncDoSearch(FakeCSearchMixin, TestCase):
+
+    async def test_lines_are_yielded_as_they_are_read(self):
+        self.install_csearch('#!/bin/sh\necho "a:0:one"\necho "b:1:two"\n')
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            self.assertListEqual(['a:0:one', 'b:1:two'], await collect(aio.do_search('one')))
+
+    async def test_shards_and_metadata_are_read_in_worker_threads(self):
+        loop_thread = threading.current_thread()
+        threads = []
+
+        def get_shards(scope=None):
+            threads.append(threading.current_thread())
+            return ['shard']
+
+        def refresh():
+            threads.append(threading.current_thread())
+
+        self.install_csearch('#!/bin/sh\necho "/botanist/repos/github/org/repo/a.py:0:one"\n')
+        with patch('ui.views.BIN_PATH', self.bin_path), patch('ui.aio.get_shards', get_shards), \
+                patch('ui.views.repo_metadata.refresh', refresh):
+            results, count, truncated = await aio.search_and_group('one')
+
+        self.assertEqual(1, count)
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(loop_thread, threads)
+
+    async def test_missing_csearch(self):
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            with self.assertRaises(CSearchMissingError):
+                await collect(aio.do_search('anything'))
+
+    async def test_csearch_is_stopped_once_max_results_is_reached(self):
+        self.install_csearch(ENDLESS_CSEARCH)
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            s = time.time()
+            results, count, truncated = await aio.search_and_group('import', max_results=100)
+
+        self.assertLess(time.time() - s, 5)
+        self.assertEqual(100, count)
+        self.assertTrue(truncated)
+
+    async def test_csearch_is_killed_at_the_deadline(self):
+        self.install_csearch('#!/bin/sh\necho "a:0:one"\nsleep 30\necho "b:1:two"\n')
+        deadline = Deadline(0.5)
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            s = time.time()
+            lines = await collect(aio.do_search('one', deadline=deadline))
+
+        self.assertLess(time.time() - s, 5)
+        self.assertEqual(['a:0:one'], lines)
+        self.assertTrue(deadline.expired)
+
+    async def test_csearch_is_killed_when_the_search_is_cancelled(self):
+        self.install_csearch('#!/bin/sh\necho "a:0:one"\nsleep 30\necho "b:1:two"\n')
+        with patch('ui.views.BIN_PATH', self.bin_path), patch('ui.aio.stop_csearch', wraps=aio.stop_csearch) as stop:
+            search = asyncio.ensure_future(collect(aio.do_search('one')))
+            await asyncio.sleep(0.5)
+            s = time.time()
+            search.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await search
+
+        self.assertLess(time.time() - s, 5)
+        procs = stop.call_args[0][0]
+        self.assertEqual([-9], [p.returncode for p in procs])
+
+    async def test_shards_are_merged_in_repo_order(self):
+        async def shard(lines):
+            for line in lines:
+                yield line
+
+        org1 = ['/botanist/repos/github/org1/repo/a.py:0:x', '/botanist/repos/github/org1/repo/b.py:0:x']
+        org2 = ['/botanist/repos/github/org2/repo/a.py:0:x']
+        dashed = ['/botanist/repos/github/org1/repo-x/a.py:0:x']
+        merged = await collect(aio.merge_shard_lines([shard(org2), shard(org1), shard(dashed)]))
+
+        self.assertListEqual(dashed + org1 + org2, merged)
+
+
+@patch('ui.aio.do_search', fake_async_do_search(LINES))
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class AsyncViews(SearchStateMixin, TestCase):
+
+    async def test_search_json(self):
+        request = AsyncRequestFactory().get('/search/results.json', {'q': 'import'})
+        response = await aio.search_json(request)
+
+        data = json.loads(response.content)['data']
+        self.assertEqual(3, data['count'])
+        self.assertEqual(['src/a.py', 'src/b.py'], list(data['results']['org1/repo1']['github']['files']))
+
+    async def test_search_page_is_streamed(self):
+        request = AsyncRequestFactory().get('/search/', {'q': 'import'})
+        response = await aio.search(request)
+        chunks = [chunk.decode('utf-8') async for chunk in response.streaming_content]
+
+        self.assertIn('id="search-box"', chunks[0])
+        self.assertIn('id="org1/repo1_github"', chunks[1])
+        self.assertIn('id="org2/repo1_github"', chunks[2])
+        self.assertIn('3 results found', chunks[3])
+
+    async def test_search_ndjson(self):
+        request = AsyncRequestFactory().get('/search/results.ndjson', {'q': 'import', 'max_count': '2'})
+        response = await aio.search_ndjson(request)
+        lines = [json.loads(chunk) async for chunk in response.streaming_content]
+
+        self.assertEqual(['src/a.py', 'src/b.py'], [line['filename'] for line in lines])
+
+
+class CancelOnDisconnect(TestCase):
+
+    async def test_view_is_cancelled_when_the_client_disconnects(self):
+        cancelled = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await receive()
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}, {'type': 'http.disconnect'}]
+
+        async def receive():
+            return messages.pop(0)
+
+        await asyncio.wait_for(cancel_on_disconnect(app)({'type': 'http', 'path': '/'}, receive, None), 5)
+        self.assertTrue(cancelled.is_set())
+
+    async def test_view_is_not_cancelled_after_the_response_is_sent(self):
+        closed = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'done', 'more_body': False})
+            # like Django closing the response after the body is sent
+            await asyncio.sleep(0.1)
+            closed.set()
+
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}, {'type': 'http.disconnect'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        with self.assertNoLogs('codesearch.asgi'):
+            await asyncio.wait_for(cancel_on_disconnect(app)({'type': 'http', 'path': '/'}, receive, send), 5)
+        self.assertTrue(closed.is_set())
+        self.assertEqual(b'done', sent[-1]['body'])
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from ui.benchmark import RARE_TOKEN
+from ui.benchmark import compare
+from ui.benchmark import generate_corpus
+
+
+class Corpus(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read_corpus(self, root):
+        files = {}
+        for dirpath, _, filenames in os.walk(os.path.join(root, 'github')):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename)) as f:
+                    files[os.path.relpath(os.path.join(dirpath, filename), root)] = f.read()
+        return files
+
+    def test_same_seed_same_corpus(self):
+        other = tempfile.mkdtemp()
+        try:
+            corpus = generate_corpus(self.root, orgs=2, repos=2, files=5, seed=1)
+            self.assertEqual(corpus, generate_corpus(other, orgs=2, repos=2, files=5, seed=1))
+            self.assertEqual(self.read_corpus(self.root), self.read_corpus(other))
+        finally:
+            shutil.rmtree(other)
+
+        self.assertEqual(20, corpus['files'])
+        self.assertEqual({'github/org0/repo0', 'github/org0/repo1', 'github/org1/repo0', 'github/org1/repo1'},
+                         {'/'.join(path.split('/')[:3]) for path in self.read_corpus(self.root)})
+
+    def test_rare_token_is_rare(self):
+        generate_corpus(self.root, orgs=1, repos=4, files=50)
+        files = self.read_corpus(self.root)
+        with_token = [text for text in files.values() if RARE_TOKEN in text]
+        self.assertTrue(0 < len(with_token) < len(files) / 4)
+
+    def test_existing_corpus_is_reused(self):
+        generate_corpus(self.root, orgs=1, repos=1, files=2)
+        marker = os.path.join(self.root, 'github', 'org0', 'repo0', 'marker')
+        open(marker, 'w').close()
+
+        generate_corpus(self.root, orgs=1, repos=1, files=2)
+        self.assertTrue(os.path.exists(marker))
+        generate_corpus(self.root, orgs=1, repos=1, files=3)
+        self.assertFalse(os.path.exists(marker))
+
+
+class Compare(TestCase):
+
+    def test_median_ratios(self):
+        baseline = {'queries': {'q': {'stages': {'parse': {'median': 0.2}, 'render': {'median': 0.1}}}}}
+        current = {'queries': {'q': {'stages': {'parse': {'median': 0.3}, 'search': {'median': 0.1}}},
+                               'new': {'stages': {'parse': {'median': 0.1}}}}}
+
+        self.assertEqual([('q', 'parse', 0.2, 0.3, 0.3 / 0.2)], compare(baseline, current))
@@ -0,0 +1,134 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.test import TestCase
+
+BUILD_COMMIT_INDEX = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'packages', 'build_commit_index.py')
+
+
+def load_build_commit_index():
+    spec = importlib.util.spec_from_file_location('build_commit_index', BUILD_COMMIT_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CommitLogs(TestCase):
+
+    def setUp(self):
+        self.bci = load_build_commit_index()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.repo = os.path.join(self.tmp, 'repos', 'github', 'org', 'repo')
+        self.commit_dir = os.path.join(self.tmp, 'commits')
+        self.git('init', '-q', '-b', 'main', self.repo)
+        self.commit('first\n\nwith a body')
+
+    def git(self, *args):
+        subprocess.run(['git', '-c', 'user.email=test@example.com', '-c', 'user.name=Test User'] + list(args),
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def commit(self, message, *args):
+        self.git('-C', self.repo, 'commit', '-q', '--allow-empty', '-m', message, *args)
+
+    def update(self, previous=None):
+        return self.bci.update_log(self.commit_dir, 'github/org/repo', self.repo, previous)
+
+    def messages(self):
+        log_dir = os.path.join(self.commit_dir, 'logs', 'github', 'org', 'repo')
+        lines = []
+        for chunk in sorted(os.listdir(log_dir)):
+            with open(os.path.join(log_dir, chunk)) as f:
+                lines += [line.rstrip('\n').split('\t')[3] for line in f]
+        return lines
+
+    def test_repos_are_found(self):
+        self.assertEqual({'github/org/repo': self.repo}, self.bci.find_repos(os.path.join(self.tmp, 'repos')))
+
+    def test_one_line_per_commit(self):
+        state, written = self.update()
+        self.assertEqual(1, written)
+        self.assertEqual({'commit': self.head(), 'shallow': False}, state)
+        self.assertEqual(['first\x1e\x1ewith a body'], self.messages())
+        with open(os.path.join(self.commit_dir, 'logs', 'github', 'org', 'repo', '000000.log')) as f:
+            self.assertIn('\tTest User <test@example.com>\t', f.read())
+
+    def test_new_commits_are_appended(self):
+        state, _ = self.update()
+        self.commit('second')
+        self.commit('third')
+        state, written = self.update(state)
+        self.assertEqual(2, written)
+        self.assertEqual(['first\x1e\x1ewith a body', 'third', 'second'], self.messages())
+        self.assertEqual((state, 0), self.update(state))
+
+    def test_rewritten_history_is_rewritten(self):
+        state, _ = self.update()
+        self.commit('amended', '--amend')
+        _, written = self.update(state)
+        self.assertEqual(1, written)
+        self.assertEqual(['amended'], self.messages())
+
+    def test_long_logs_are_chunked(self):
+        self.bci.MAX_CHUNK_TRIGRAMS = 200
+        self.bci.MAX_LINE_BYTES = 120
+        for i in range(10):
+            self.commit('commit %d %s' % (i, 'abcdefghijklmnopqrstuvwxyz'[i:] * 10))
+        self.update()
+
+        log_dir = os.path.join(self.commit_dir, 'logs', 'github', 'org', 'repo')
+        chunks = sorted(os.listdir(log_dir))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            with open(os.path.join(log_dir, chunk), 'rb') as f:
+                data = f.read()
+            self.assertLessEqual(len(self.bci.trigrams(data)), 200)
+            self.assertTrue(all(len(line) < 120 for line in data.splitlines()))
+        self.assertEqual(11, len(self.messages()))
+
+    def test_the_history_of_shallow_clones_is_read_from_a_mirror(self):
+        self.commit('second')
+        clone = os.path.join(self.tmp, 'repos', 'github', 'org', 'shallow')
+        self.git('clone', '-q', '--depth', '1', 'file://' + self.repo, clone)
+        self.assertEqual(self.bci.history_dir(self.commit_dir, 'github/org/repo'),
+                         self.bci.history_repo(self.commit_dir, 'github/org/repo', clone))
+
+        state, written = self.bci.update_repo(self.commit_dir, 'github/org/repo', clone, None)
+        self.assertEqual(2, written)
+        self.assertFalse(state['shallow'])
+        self.assertEqual(['second', 'first\x1e\x1ewith a body'], self.messages())
+
+        # the mirror is fetched on the next run, the checkout is left as is
+        self.commit('third')
+        _, written = self.bci.update_repo(self.commit_dir, 'github/org/repo', clone, state)
+        self.assertEqual(1, written)
+        self.assertEqual('third', self.messages()[-1])
+        self.assertTrue(os.path.exists(os.path.join(clone, '.git', 'shallow')))
+
+    def test_other_clones_are_read_directly(self):
+        self.assertEqual(self.repo, self.bci.history_repo(self.commit_dir, 'github/org/repo', self.repo))
+        self.assertFalse(os.path.exists(os.path.join(self.commit_dir, 'history')))
+
+    def test_mirror_errors_leave_out_the_url(self):
+        clone = os.path.join(self.tmp, 'shallow')
+        self.git('clone', '-q', '--depth', '1', 'file://' + self.repo, clone)
+        self.git('-C', clone, 'remote', 'set-url', 'origin', 'file:///nowhere/secret@repo')
+        with self.assertRaises(ValueError) as e:
+            self.bci.history_repo(self.commit_dir, 'github/org/repo', clone)
+        self.assertIn('unable to fetch the history of github/org/repo', str(e.exception))
+        self.assertNotIn("'clone'", str(e.exception))
+
+    def test_only_changed_or_missing_shards_are_built(self):
+        for org in ('github/org1', 'github/org2'):
+            os.makedirs(os.path.dirname(self.bci.shard_file(self.commit_dir, org)), exist_ok=True)
+            open(self.bci.shard_file(self.commit_dir, org), 'w').close()
+        self.assertEqual('github/org1', self.bci.org_of('github/org1/repo'))
+        self.assertEqual(['github/org2', 'github/org3'],
+                         self.bci.stale_shards(self.commit_dir, {'github/org1', 'github/org2', 'github/org3'},
+                                               {'github/org2'}))
+
+    def head(self):
+        return subprocess.check_output(['git', '-C', self.repo, 'rev-parse', 'HEAD'], encoding='utf-8').strip()
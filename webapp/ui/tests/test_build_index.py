@@ -0,0 +1,104 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+BUILD_INDEX = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'packages', 'build_index.py')
+
+
+def load_build_index():
+    spec = importlib.util.spec_from_file_location('build_index', BUILD_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CoveringPaths(TestCase):
+    FILES = {
+        'repo/.git/HEAD': b'ref: refs/heads/main\n',
+        'repo/src/app.py': b'import os\n',
+        'repo/src/lib/util.py': b'import sys\n',
+        'repo/web/app.js': b'console.log(1);\n',
+        'repo/web/app.min.js': b'console.log(1);\n',
+        'repo/web/node_modules/left-pad/index.js': b'module.exports = 1;\n',
+        'repo/web/logo.dat': b'\x89PNG\r\n\x1a\n\x00\x00',
+        'repo/web/big.txt': b'x' * 2048,
+    }
+
+    def setUp(self):
+        self.bi = load_build_index()
+        self.root = tempfile.mkdtemp()
+        for relpath, content in self.FILES.items():
+            name = os.path.join(self.root, relpath)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def covering_paths(self, policy):
+        paths, complete = self.bi.covering_paths(os.path.join(self.root, 'repo'), policy)
+        return [os.path.relpath(p, self.root) for p in paths], complete
+
+    def test_excluded_files_are_left_out_and_clean_directories_kept_whole(self):
+        paths, complete = self.covering_paths(self.bi.ExclusionPolicy(max_file_size=1024))
+        self.assertFalse(complete)
+        self.assertListEqual(['repo/src', 'repo/web/app.js'], paths)
+
+    def test_whole_repo_when_nothing_is_excluded(self):
+        os.remove(os.path.join(self.root, 'repo/web/logo.dat'))
+        policy = self.bi.ExclusionPolicy(dirs=(), files=(), max_file_size=4096)
+        self.assertEqual((['repo'], True), self.covering_paths(policy))
+
+    def test_policy_changes_are_noticed(self):
+        self.assertNotEqual(self.bi.ExclusionPolicy().fingerprint(), self.bi.ExclusionPolicy(max_file_size=1).fingerprint())
+
+    def test_arg_batches(self):
+        self.assertListEqual([['aaa', 'bbb'], ['ccc']], list(self.bi.arg_batches(['aaa', 'bbb', 'ccc'], max_size=8)))
+
+
+class Generations(TestCase):
+
+    def setUp(self):
+        self.bi = load_build_index()
+        self.shard_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.shard_dir)
+
+    def build(self, generation_id):
+        generation_dir = os.path.join(self.shard_dir, 'generations', generation_id)
+        os.makedirs(os.path.join(generation_dir, 'github'))
+        with open(os.path.join(generation_dir, 'github', 'org.index'), 'wb') as f:
+            f.write(b'csearch index 1\n' + self.bi.INDEX_TRAILER)
+        return generation_dir
+
+    def test_swap_and_remove_old_generations(self):
+        for generation_id in ('gen-1', 'gen-2', 'gen-3'):
+            generation_dir = self.build(generation_id)
+            self.bi.swap_generation(self.shard_dir, generation_dir)
+            self.assertEqual(generation_dir, self.bi.current_generation(self.shard_dir))
+        self.bi.remove_old_generations(self.shard_dir, keep=2)
+
+        self.assertListEqual(['gen-2', 'gen-3'], sorted(os.listdir(os.path.join(self.shard_dir, 'generations'))))
+        self.assertEqual('generations/gen-3', os.readlink(os.path.join(self.shard_dir, 'current')))
+
+    def test_the_current_generation_is_never_removed(self):
+        self.bi.swap_generation(self.shard_dir, self.build('gen-1'))
+        self.build('gen-2')
+        self.bi.remove_old_generations(self.shard_dir, keep=1)
+        self.assertListEqual(['gen-1', 'gen-2'], sorted(os.listdir(os.path.join(self.shard_dir, 'generations'))))
+
+    def test_unchanged_shards_are_carried_over(self):
+        old, new = self.build('gen-1'), os.path.join(self.shard_dir, 'generations', 'gen-2')
+        self.assertTrue(self.bi.link_shard(old, new, 'github/org'))
+        self.assertFalse(self.bi.link_shard(old, new, 'github/other'))
+        self.assertTrue(os.path.samefile(os.path.join(old, 'github/org.index'), os.path.join(new, 'github/org.index')))
+
+    def test_incomplete_shards_are_rejected(self):
+        index_file = os.path.join(self.build('gen-1'), 'github', 'org.index')
+        with open(index_file, 'r+b') as f:
+            f.truncate(20)
+        with self.assertRaises(self.bi.InvalidShardError):
+            self.bi.check_shard('cindex', index_file, ['/botanist/repos/github/org/repo'])
@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.commits import CommitIndexMissingError
+from ui.commits import log_file_regex
+from ui.commits import parse_commit
+from ui.commits import search_commits
+from ui.scope import Scope
+from ui.tests.test_do_search import FakeCSearchMixin
+from ui.tests.test_do_search import SearchStateMixin
+
+LOGS = '/botanist/repos/.commits/logs'
+LINES = [
+    LOGS + '/github/org1/repo1/000000.log:aaa111\t2024-01-01T10:00:00+00:00\tAnn <ann@example.com>\tfix the login\x1e\x1ewith a body',
+    LOGS + '/github/org2/repo2/000003.log:bbb222\t2024-03-01T10:00:00+01:00\tBob <bob@example.com>\tfix the logout',
+]
+
+
+class FakeCommitIndexMixin(FakeCSearchMixin):
+    def setUp(self):
+        super().setUp()
+        self.commit_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.commit_dir)
+        os.makedirs(os.path.join(self.commit_dir, 'shards', 'github'))
+        with open(os.path.join(self.commit_dir, 'shards', 'github', 'org1.index'), 'w') as f:
+            f.write('csearch index 1\n')
+        for patcher in (patch('ui.commits.COMMIT_INDEX_DIR', self.commit_dir), patch('ui.commits.BIN_PATH', self.bin_path)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def install_commits(self, lines):
+        logs = os.path.join(self.commit_dir, 'logs')
+        self.install_csearch('#!/bin/sh\ncat <<"EOF"\n%s\nEOF\n' % '\n'.join(l.replace(LOGS, logs) for l in lines))
+
+
+class ParseCommit(TestCase):
+
+    def test_commit_lines(self):
+        commit = parse_commit(LINES[0], LOGS)
+        self.assertEqual(('org1/repo1', 'github', 'aaa111', 'Ann <ann@example.com>', 'fix the login'),
+                         (commit['repo'], commit['vcs_loc'], commit['sha'], commit['author'], commit['subject']))
+        self.assertEqual('fix the login\n\nwith a body', commit['message'])
+        self.assertEqual('https://github.com/org1/repo1/commit/aaa111', commit['link'])
+
+    def test_other_lines(self):
+        self.assertIsNone(parse_commit('/elsewhere/file.txt:text', LOGS))
+        self.assertIsNone(parse_commit(LOGS + '/github/org1/repo1/000000.log:not a commit', LOGS))
+
+    def test_scope(self):
+        self.assertIsNone(log_file_regex(None, LOGS))
+        self.assertIsNone(log_file_regex(Scope((), (), (), '*.py'), LOGS))
+        self.assertEqual(r'^/botanist/repos/\.commits/logs/(?:github)/(?:org1/[^/]+|org2/repo\.x)/',
+                         log_file_regex(Scope(('github',), ('org1',), ('org2/repo.x',), None), LOGS))
+
+
+class SearchCommits(FakeCommitIndexMixin, TestCase):
+
+    def test_newest_first(self):
+        self.install_commits(LINES)
+        commits, count, truncated = search_commits('fix')
+        self.assertEqual(['bbb222', 'aaa111'], [c['sha'] for c in commits])
+        self.assertEqual((2, False), (count, truncated))
+
+    def test_truncated_results_are_the_newest(self):
+        self.install_commits(LINES)
+        commits, count, truncated = search_commits('fix', max_results=1)
+        self.assertEqual(['bbb222'], [c['sha'] for c in commits])
+        self.assertEqual((1, True), (count, truncated))
+
+    def test_csearch_is_stopped_at_max_scan(self):
+        self.install_csearch('#!/bin/sh\nwhile true; do echo "%s"; done\n'
+                             % LINES[0].replace(LOGS, os.path.join(self.commit_dir, 'logs')))
+        commits, count, truncated = search_commits('fix', max_results=5, max_scan=50)
+        self.assertEqual((5, True), (count, truncated))
+
+    def test_every_shard_in_scope_is_searched(self):
+        with open(os.path.join(self.commit_dir, 'shards', 'github', 'org2.index'), 'w') as f:
+            f.write('csearch index 1\n')
+        logs = os.path.join(self.commit_dir, 'logs')
+        self.install_csearch('#!/bin/sh\ncase "$CSEARCHINDEX" in\n*org1.index) echo "%s" ;;\n*) echo "%s" ;;\nesac\n'
+                             % tuple(l.replace(LOGS, logs) for l in LINES))
+        commits, count, truncated = search_commits('fix')
+        self.assertEqual(['bbb222', 'aaa111'], [c['sha'] for c in commits])
+
+        commits, count, truncated = search_commits('fix', scope=Scope((), ('org2',), (), None))
+        self.assertEqual(['bbb222'], [c['sha'] for c in commits])
+        self.assertEqual(([], 0, False), search_commits('fix', scope=Scope(('bitbucket',), (), (), None)))
+
+    def test_missing_index(self):
+        shutil.rmtree(os.path.join(self.commit_dir, 'shards'))
+        with self.assertRaises(CommitIndexMissingError):
+            search_commits('fix')
+
+
+@patch('ui.metrics.statsd')
+class CommitSearchViews(SearchStateMixin, FakeCommitIndexMixin, TestCase):
+
+    def test_json(self, statsd):
+        self.install_commits(LINES)
+        response = self.client.get('/search/commits.json', {'q': 'fix'})
+        data = json.loads(response.content)['data']
+        self.assertEqual(2, data['count'])
+        self.assertEqual('fix the logout', data['results'][0]['subject'])
+
+    def test_page(self, statsd):
+        self.install_commits(LINES)
+        response = self.client.get('/search/commits/', {'q': 'login'})
+        self.assertContains(response, '2 commits found')
+        self.assertContains(response, 'fix the <span class="highlighted-search-query">login</span>')
+        self.assertContains(response, 'https://github.com/org2/repo2/commit/bbb222')
+
+    def test_missing_index(self, statsd):
+        shutil.rmtree(os.path.join(self.commit_dir, 'shards'))
+        response = self.client.get('/search/commits.json', {'q': 'fix'})
+        self.assertEqual(500, response.status_code)
+        self.assertEqual('commit messages have not been indexed yet.', json.loads(response.content)['data']['error'])
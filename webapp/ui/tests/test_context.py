@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui import context
+from ui.context import add_file_context
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_do_search
+
+SOURCE = 'import os\nimport sys\n\ndef main():\n    print(os.getcwd())\n    return sys.exit(0)\n'
+
+
+class FileContext(TestCase):
+    LINES = [line.encode('utf-8') for line in SOURCE.splitlines()]
+
+    def test_before_and_after(self):
+        matches = [{'lineno': 4}]
+        add_file_context(matches, self.LINES, before=2, after=1)
+        self.assertListEqual([2, 3], [c['lineno'] for c in matches[0]['before']])
+        self.assertListEqual(['    print(os.getcwd())'], [c['srcline'] for c in matches[0]['after']])
+
+    def test_lines_are_not_repeated_between_nearby_matches(self):
+        matches = [{'lineno': 1}, {'lineno': 2}, {'lineno': 5}]
+        add_file_context(matches, self.LINES, before=2, after=2)
+        self.assertListEqual([([], []), ([], [3, 4]), ([], [6])],
+                             [([c['lineno'] for c in m['before']], [c['lineno'] for c in m['after']]) for m in matches])
+
+    def test_no_context_past_a_cut_off_file(self):
+        fd, filename = tempfile.mkstemp()
+        self.addCleanup(os.remove, filename)
+        with os.fdopen(fd, 'w') as f:
+            f.write(SOURCE)
+        lines = context.read_lines(filename, max_size=len('import os\nimport sys\n'))
+
+        matches = [{'lineno': 1}, {'lineno': 5}]
+        add_file_context(matches, lines, before=2, after=2)
+        self.assertListEqual([2], [c['lineno'] for c in matches[0]['after']])
+        self.assertEqual(([], []), (matches[1]['before'], matches[1]['after']))
+
+    def test_no_context_for_a_file_that_shrank(self):
+        matches = [{'lineno': 10}]
+        add_file_context(matches, [b'a', b'b', b'c'], before=2, after=2)
+        self.assertEqual(([], []), (matches[0]['before'], matches[0]['after']))
+
+    def test_html_is_escaped(self):
+        matches = [{'lineno': 2}]
+        add_file_context(matches, [b'<b>', b'match'], before=1)
+        self.assertEqual('&lt;b&gt;', matches[0]['before'][0]['srcline'])
+
+
+class SearchContext(SearchStateMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'github/org1/repo1'))
+        with open(os.path.join(self.root, 'github/org1/repo1/main.py'), 'w') as f:
+            f.write(SOURCE)
+        self.fake_do_search = fake_do_search([
+            os.path.join(self.root, 'github/org1/repo1/main.py:4:    print(os.getcwd())'),
+            os.path.join(self.root, 'github/org1/repo1/main.py:5:    return sys.exit(0)'),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_each_file_is_read_once(self):
+        with patch('ui.views.CODE_ROOT', self.root), patch('ui.views.do_search', self.fake_do_search), \
+                patch('ui.context.read_lines', wraps=context.read_lines) as read_lines:
+            response = self.client.get('/search/results.json', {'q': 'os|sys', 'context': '1'})
+
+        self.assertEqual(1, read_lines.call_count)
+        matches = json.loads(response.content)['data']['results']['org1/repo1']['github']['files']['main.py']
+        self.assertListEqual(['def main():'], [c['srcline'] for c in matches[0]['before']])
+        self.assertListEqual([], matches[0]['after'])
+        self.assertListEqual([], matches[1]['after'])
+
+    def test_only_the_context_asked_for_is_shown(self):
+        with patch('ui.views.CODE_ROOT', self.root), patch('ui.views.do_search', self.fake_do_search):
+            response = self.client.get('/search/', {'q': 'os', 'before': '1'})
+            # the page is streamed, so it is only searched as it is read
+            content = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertIn('def main():', content)
+        self.assertNotIn('import sys', content)
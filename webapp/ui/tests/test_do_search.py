@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from datetime import datetime
+from datetime import timezone
+from django.test import TestCase
+from django.test import override_settings
+from unittest.mock import patch
+
+from ui.deadline import Deadline
+from ui.index import get_index_generation
+from ui.index import get_last_indexed
+from ui.index import get_shards
+from ui.views import CSearchMissingError
+from ui.views import do_search
+from ui.views import group_search_results
+from ui.views import iter_search_results
+
+# prints an endless stream of matches, like a very broad query would
+ENDLESS_CSEARCH = """#!/bin/sh
+while true; do
+    echo "/botanist/repos/github/org1/repo1/src/file.py:0:import os"
+done
+"""
+
+
+def fake_do_search(lines):
+    """
+    Returns a stand-in for views.do_search() that yields lines, and counts
+    their size into stats like the real one.
+    """
+    def do_search(query, case_sensitive=True, scope=None, deadline=None, stats=None):
+        for line in lines:
+            if stats is not None:
+                stats.bytes += len(line) + 1
+            yield line
+    return do_search
+
+
+def fake_async_do_search(lines):
+    """
+    fake_do_search() for aio.do_search().
+    """
+    async def do_search(query, case_sensitive=True, scope=None, deadline=None, stats=None):
+        for line in fake_do_search(lines)(query, case_sensitive, scope, deadline, stats):
+            yield line
+    return do_search
+
+
+class SearchStateMixin(object):
+    """
+    Gives each test a search cache and search lock directory of its own, so
+    that running the tests never touches the ones of the webapp.
+    """
+    def setUp(self):
+        super().setUp()
+        self.search_state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.search_state_dir)
+        location = os.path.join(self.search_state_dir, 'cache.sqlite3')
+        settings_override = override_settings(CACHES={'search': {'BACKEND': 'ui.cache.SQLiteLRUCache',
+                                                                 'LOCATION': location}})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        lock_dir_patch = patch('ui.admission.SEARCH_LOCK_DIR', os.path.join(self.search_state_dir, 'locks'))
+        lock_dir_patch.start()
+        self.addCleanup(lock_dir_patch.stop)
+
+
+class FakeCSearchMixin(object):
+    def setUp(self):
+        self.bin_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bin_path)
+
+    def install_csearch(self, script):
+        executable = os.path.join(self.bin_path, 'csearch')
+        with open(executable, 'w') as f:
+            f.write(script)
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+
+
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class DoSearch(FakeCSearchMixin, TestCase):
+
+    def test_lines_are_yielded_as_they_are_read(self):
+        self.install_csearch('#!/bin/sh\necho "a:0:one"\necho "b:1:two"\n')
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            self.assertListEqual(['a:0:one', 'b:1:two'], list(do_search('one')))
+
+    def test_missing_csearch(self):
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            with self.assertRaises(CSearchMissingError):
+                list(do_search('anything'))
+
+    def test_csearch_is_stopped_once_max_results_is_reached(self):
+        self.install_csearch(ENDLESS_CSEARCH)
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            s = time.time()
+            matches = iter_search_results(do_search('import'), 'import')
+            results, count, truncated = group_search_results(matches, max_results=100)
+
+        self.assertLess(time.time() - s, 5)
+        self.assertEqual(100, count)
+        self.assertTrue(truncated)
+        self.assertEqual(100, len(results['org1/repo1']['github']['files']['src/file.py']))
+
+    def test_csearch_is_killed_at_the_deadline(self):
+        # sleep holds on to csearch's stdout, so only killing the whole
+        # process group ends the output
+        self.install_csearch('#!/bin/sh\necho "a:0:one"\nsleep 30\necho "b:1:two"\n')
+        deadline = Deadline(0.5)
+        with patch('ui.views.BIN_PATH', self.bin_path):
+            s = time.time()
+            lines = list(do_search('one', deadline=deadline))
+
+        self.assertLess(time.time() - s, 5)
+        self.assertEqual(['a:0:one'], lines)
+        self.assertTrue(deadline.expired)
+
+    def test_not_truncated_when_all_results_fit(self):
+        lines = ['/botanist/repos/github/org1/repo1/src/file.py:%d:import os' % i for i in range(3)]
+        results, count, truncated = group_search_results(iter_search_results(lines, 'import'), max_results=3)
+
+        self.assertEqual(3, count)
+        self.assertFalse(truncated)
+
+
+# prints the lines in the shard's index file, after a second's work
+SHARDED_CSEARCH = """#!/bin/sh
+sleep 1
+cat "$CSEARCHINDEX"
+"""
+
+
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class ShardedSearch(FakeCSearchMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.install_csearch(SHARDED_CSEARCH)
+
+    def write_shard(self, name, lines):
+        shard = os.path.join(self.bin_path, name)
+        with open(shard, 'w') as f:
+            f.write(''.join('/botanist/repos/%s\n' % line for line in lines))
+        return shard
+
+    def test_shards_are_searched_concurrently_and_merged_in_repo_order(self):
+        shards = [
+            self.write_shard('github-org1', ['github/org1/repo-x/a.py:0:x', 'github/org1/repo/a.py:0:x', 'github/org1/repo/b.py:3:x']),
+            self.write_shard('github-org2', ['github/org2/repo/a.py:1:x']),
+            self.write_shard('bitbucket-org1', ['bitbucket/org1/repo/z.py:0:x', 'bitbucket/org1/zzz/a.py:0:x']),
+        ]
+        with patch('ui.views.BIN_PATH', self.bin_path), patch('ui.views.get_shards', lambda scope=None: shards):
+            s = time.time()
+            lines = [line[len('/botanist/repos/'):] for line in do_search('x')]
+
+        self.assertLess(time.time() - s, 2.5)
+        self.assertListEqual([
+            'github/org1/repo-x/a.py:0:x',
+            'bitbucket/org1/repo/z.py:0:x',
+            'github/org1/repo/a.py:0:x',
+            'github/org1/repo/b.py:3:x',
+            'bitbucket/org1/zzz/a.py:0:x',
+            'github/org2/repo/a.py:1:x',
+        ], lines)
+
+    def test_every_shard_is_stopped_early(self):
+        shards = [self.write_shard('a', []), self.write_shard('b', [])]
+        self.install_csearch(ENDLESS_CSEARCH)
+        with patch('ui.views.BIN_PATH', self.bin_path), patch('ui.views.get_shards', lambda scope=None: shards):
+            lines = do_search('import')
+            self.assertEqual(2, len([next(lines), next(lines)]))
+            lines.close()
+
+
+class Shards(TestCase):
+
+    def test_falls_back_to_the_single_index(self):
+        with patch('ui.index.INDEX_SHARDS', '/nonexistent'), patch('ui.index.CSEARCHINDEX', '/tmp/.csearchindex'):
+            self.assertListEqual(['/tmp/.csearchindex'], get_shards())
+
+    def test_shards_are_found_by_org(self):
+        shard_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_dir)
+        for name in ('github/org2.index', 'github/org1.index', 'bitbucket/org1.index'):
+            os.makedirs(os.path.dirname(os.path.join(shard_dir, name)), exist_ok=True)
+            open(os.path.join(shard_dir, name), 'w').close()
+
+        with patch('ui.index.INDEX_SHARDS', shard_dir):
+            shards = get_shards()
+            generation = get_index_generation()
+            self.assertListEqual(['bitbucket/org1.index', 'github/org1.index', 'github/org2.index'],
+                                 [os.path.relpath(shard, shard_dir) for shard in shards])
+
+            os.remove(shards[0])
+            self.assertNotEqual(generation, get_index_generation())
+
+    def test_shards_of_the_current_generation_are_searched(self):
+        shard_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shard_dir)
+        for name in ('github/old.index', 'generations/gen-2/github/org1.index'):
+            os.makedirs(os.path.dirname(os.path.join(shard_dir, name)), exist_ok=True)
+            open(os.path.join(shard_dir, name), 'w').close()
+        with open(os.path.join(shard_dir, 'generations/gen-2/generation.json'), 'w') as f:
+            json.dump({'id': 'gen-2', 'built_at': '2024-05-01T10:00:00Z', 'checked_at': '2024-05-02T10:00:00Z'}, f)
+        os.symlink('generations/gen-2', os.path.join(shard_dir, 'current'))
+
+        with patch('ui.index.INDEX_SHARDS', shard_dir):
+            self.assertListEqual([os.path.join(shard_dir, 'generations/gen-2/github/org1.index')], get_shards())
+            self.assertEqual('gen-2', get_index_generation())
+            self.assertEqual(datetime(2024, 5, 1, 10, tzinfo=timezone.utc), get_last_indexed())
@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import tempfile
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui import engine
+from ui.views import RegexError
+from ui.views import do_search
+from ui.views import group_search_results
+from ui.views import iter_search_results
+
+
+def uvarint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def write_index(filename, root, names):
+    """
+    Writes a codesearch index of the files in names, the same way cindex
+    would, so the tests don't depend on the cindex binary.
+    """
+    names = sorted(names)
+    postings = {}
+    for fileid, name in enumerate(names):
+        with open(name, 'rb') as f:
+            data = f.read()
+        for i in range(len(data) - 2):
+            postings.setdefault(data[i:i + 3], set()).add(fileid)
+
+    out = bytearray(engine.MAGIC)
+    path_data = len(out)
+    out += root.encode('utf-8') + b'\0\0'
+
+    name_data = len(out)
+    name_offsets = []
+    for name in names:
+        name_offsets.append(len(out) - name_data)
+        out += name.encode('utf-8') + b'\0'
+    name_offsets.append(len(out) - name_data)
+    out += b'\0'
+
+    post_data = len(out)
+    post_entries = []
+    for trigram in sorted(postings):
+        post_entries.append((trigram, len(postings[trigram]), len(out) - post_data))
+        out += trigram
+        prev = -1
+        for fileid in sorted(postings[trigram]):
+            out += uvarint(fileid - prev)
+            prev = fileid
+        out += uvarint(0)
+
+    name_index = len(out)
+    for offset in name_offsets:
+        out += struct.pack('>I', offset)
+
+    post_index = len(out)
+    for trigram, count, offset in post_entries:
+        out += trigram + struct.pack('>II', count, offset)
+
+    out += struct.pack('>5I', path_data, name_data, post_data, name_index, post_index)
+    out += engine.TRAILER_MAGIC
+    with open(filename, 'wb') as f:
+        f.write(out)
+
+
+class IndexMixin(object):
+    FILES = {
+        'github/org1/repo1/src/app.py': 'import os\nimport sys\n\ndef get_thing():\n    return Thing()\n',
+        'github/org1/repo1/README.md': 'This is the README\nthing things THINGS\n',
+        'github/org2/repo2/lib.js': 'const thing = require("thing");\nmodule.exports = thing;\n',
+    }
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        names = []
+        for relpath, content in self.FILES.items():
+            name = os.path.join(self.root, relpath)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'w') as f:
+                f.write(content)
+            names.append(name)
+        self.index = os.path.join(self.root, '.csearchindex')
+        write_index(self.index, self.root, names)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def search(self, query, case_sensitive=True):
+        lines = engine.search(self.index, query, case_sensitive)
+        return [line[len(self.root) + 1:] for line in lines]
+
+
+class Plan(TestCase):
+
+    def test_literal(self):
+        self.assertEqual(engine.q_string('import'), engine.plan('import'))
+
+    def test_short_literal_matches_everything(self):
+        self.assertEqual(engine.ALL, engine.plan('ab'))
+
+    def test_alternation(self):
+        self.assertEqual(engine.q_strings({'foo', 'bar'}), engine.plan('foo|bar'))
+
+    def test_wildcards_only_require_the_literal_parts(self):
+        self.assertEqual(engine.q_and(engine.q_string('def '), engine.q_string('(self')), engine.plan(r'def .*\(self'))
+
+    def test_case_insensitive(self):
+        self.assertEqual(engine.plan('(?i)abc'), engine.plan('abc', case_sensitive=False))
+        self.assertIn(engine.q_string('AbC'), engine.plan('abc', case_sensitive=False)[1])
+
+
+class Search(IndexMixin, TestCase):
+
+    def test_literal(self):
+        self.assertListEqual(['github/org1/repo1/src/app.py:0:import os', 'github/org1/repo1/src/app.py:1:import sys'],
+                             self.search('import'))
+
+    def test_regex(self):
+        self.assertListEqual(['github/org1/repo1/src/app.py:3:def get_thing():',
+                              'github/org2/repo2/lib.js:0:const thing = require("thing");'],
+                             self.search(r'(def|const) \w*thing'))
+
+    def test_case_insensitive(self):
+        self.assertListEqual(['github/org1/repo1/README.md:1:thing things THINGS'], self.search('things', case_sensitive=True))
+        self.assertEqual(5, len(self.search('THING', case_sensitive=False)))
+
+    def test_no_candidate_files(self):
+        self.assertListEqual([], self.search('zzzyyyxxx'))
+
+    def test_matches_do_not_span_lines(self):
+        self.assertListEqual([], self.search(r'os\simport'))
+
+    def test_index_is_only_opened_once(self):
+        self.assertIs(engine.get_index(self.index), engine.get_index(self.index))
+
+
+class IndexBackend(IndexMixin, TestCase):
+
+    def test_do_search_uses_the_index(self):
+        with patch('ui.views.SEARCH_BACKEND', 'index'), patch('ui.views.get_shards', lambda scope=None: [self.index]), \
+                patch('ui.views.CODE_ROOT', self.root):
+            matches = iter_search_results(do_search('thing'), 'thing')
+            results, count, truncated = group_search_results(matches)
+
+        self.assertEqual(4, count)
+        self.assertListEqual(['org1/repo1', 'org2/repo2'], list(results.keys()))
+        self.assertEqual(4, results['org1/repo1']['github']['files']['src/app.py'][0]['lineno'])
+
+    def test_invalid_regex(self):
+        with patch('ui.views.SEARCH_BACKEND', 'index'), patch('ui.views.get_shards', lambda scope=None: [self.index]):
+            with self.assertRaises(RegexError):
+                list(do_search('(unbalanced'))
@@ -38,7 +38,9 @@ class GetRepoAndFilepath(TestMixin, TestCase):
 
     def test_get_repo_and_filepath(self):
         filename = os.path.join(CODE_ROOT, 'bitbucket', 'org-name', 'git-repo-name', 'somedir', 'sourcefile.py')
-        result_tuple = get_repo_and_filepath(filename)
+        # the repo type comes from the metadata written at fetch time
+        with patch('ui.views.repo_metadata.get', lambda vcs_loc, repo: {'repo_type': 'git', 'default_branch': 'main'}):
+            result_tuple = get_repo_and_filepath(filename)
         self.assertEqual(('bitbucket', 'org-name/git-repo-name', 'somedir/sourcefile.py', 'git'), result_tuple)
 
 
@@ -0,0 +1,197 @@
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from django.test import TestCase
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+GITHUB_BACKUP = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'packages', 'github_backup.py')
+
+
+def load_github_backup():
+    spec = importlib.util.spec_from_file_location('github_backup', GITHUB_BACKUP)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeGitHub(object):
+    """
+    Serves an org's repository listing the way github's api does: in pages
+    linked by the Link header, with ETags, answering 304 to conditional
+    requests for pages that haven't changed.
+    """
+    def __init__(self, repos, per_page=2):
+        self.repos = repos
+        self.per_page = per_page
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append((self.path, self.headers.get('If-None-Match')))
+                page = int(parse_qs(urlparse(self.path).query).get('page', ['1'])[0])
+                body = json.dumps(fake.page(page)).encode('utf-8')
+                etag = '"%d-%d"' % (page, hash(body) & 0xffffffff)
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                if page * fake.per_page < len(fake.repos):
+                    self.send_header('Link', '<%s/orgs/org/repos?page=%d>; rel="next"' % (fake.url, page + 1))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def page(self, n):
+        return self.repos[(n - 1) * self.per_page:n * self.per_page]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GitHubBackupMixin(object):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.repos = []
+        for name in ('repo1', 'repo2', 'repo3'):
+            origin = os.path.join(self.origin, name)
+            self.git('init', '-q', '-b', 'main', origin)
+            self.commit(origin, 'first')
+            self.commit(origin, 'second')
+            self.repos.append({
+                'name': name, 'full_name': 'org/' + name, 'fork': False, 'archived': False, 'default_branch': 'main',
+                # a file:// url, since git ignores --depth for plain local paths
+                'ssh_url': 'file://' + origin, 'clone_url': 'https://example.com/' + name, 'pushed_at': '2024-01-01T00:00:00Z',
+                'description': 'left out of the state',
+            })
+        self.github = FakeGitHub(self.repos)
+
+    def tearDown(self):
+        self.github.stop()
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        subprocess.run(['git', '-c', 'user.email=test@example.com', '-c', 'user.name=test'] + list(args),
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def commit(self, repo_dir, message):
+        self.git('-C', repo_dir, 'commit', '-q', '--allow-empty', '-m', message)
+
+    def rev_parse(self, repo_dir, *args):
+        return subprocess.check_output(['git', '-C', repo_dir, 'rev-parse'] + list(args), encoding='utf-8').strip()
+
+
+class GetRepos(GitHubBackupMixin, TestCase):
+
+    def test_unchanged_pages_are_requested_conditionally(self):
+        gb = load_github_backup()
+        state = gb.FetchState(os.path.join(self.tmp, 'state.json'))
+        repos = list(gb.get_repos('org', 'all', 'token', api_base=self.github.url + '/', state=state))
+        state.save()
+
+        self.assertListEqual(['repo1', 'repo2', 'repo3'], [r['name'] for r in repos])
+        self.assertNotIn('description', repos[0])
+        self.assertIn('per_page=100', self.github.requests[0][0])
+        self.assertEqual(2, len(self.github.requests))
+
+        self.github.requests.clear()
+        state = gb.FetchState(os.path.join(self.tmp, 'state.json'))
+        self.assertListEqual(repos, list(gb.get_repos('org', 'all', 'token', api_base=self.github.url + '/', state=state)))
+        self.assertTrue(all(etag is not None for _, etag in self.github.requests))
+        self.assertEqual(2, len(state.pages))
+
+
+class Fetch(GitHubBackupMixin, TestCase):
+
+    def fetch(self, *args):
+        return subprocess.run(
+            [sys.executable, GITHUB_BACKUP, 'ssh', '-d', os.path.join(self.tmp, 'repos'), '-o', 'org', '-a', 'token',
+             '--api-base', self.github.url + '/', '-s', os.path.join(self.tmp, 'state.json')] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', env=dict(os.environ, LOG_LEVEL='INFO'),
+        ).stdout
+
+    def test_unchanged_repositories_are_skipped(self):
+        output = self.fetch()
+        self.assertIn('3 clone, 0 skipped as unchanged', output)
+
+        self.commit(os.path.join(self.origin, 'repo2'), 'third')
+        self.repos[1]['pushed_at'] = '2024-01-02T00:00:00Z'
+        output = self.fetch()
+
+        self.assertIn('1 pull, 2 skipped as unchanged', output)
+        self.assertNotIn('git clone', output)
+        with open(os.path.join(self.tmp, 'state.json')) as f:
+            state = json.load(f)
+        self.assertEqual('2024-01-02T00:00:00Z', state['repos']['org/repo2']['pushed_at'])
+
+    def test_shallow_clones_are_reset_to_the_remote_tip(self):
+        self.fetch('--clone-mode', 'shallow')
+        backup = os.path.join(self.tmp, 'repos', 'repo2')
+        self.assertEqual('true', self.rev_parse(backup, '--is-shallow-repository'))
+
+        origin = os.path.join(self.origin, 'repo2')
+        self.commit(origin, 'third')
+        self.repos[1]['pushed_at'] = '2024-01-02T00:00:00Z'
+        output = self.fetch('--clone-mode', 'shallow')
+
+        self.assertIn('fetch --depth 1 --no-tags origin main', output)
+        self.assertEqual(self.rev_parse(origin, 'HEAD'), self.rev_parse(backup, 'HEAD'))
+        count = subprocess.check_output(['git', '-C', backup, 'rev-list', '--count', 'HEAD'], encoding='utf-8')
+        self.assertEqual('1', count.strip())
+
+    def test_shallow_clones_get_their_history_back(self):
+        self.fetch('--clone-mode', 'shallow')
+        output = self.fetch('--clone-mode', 'partial')
+
+        self.assertIn('3 clone, 0 skipped as unchanged', output)
+        backup = os.path.join(self.tmp, 'repos', 'repo2')
+        self.assertEqual('false', self.rev_parse(backup, '--is-shallow-repository'))
+        count = subprocess.check_output(['git', '-C', backup, 'rev-list', '--count', 'HEAD'], encoding='utf-8')
+        self.assertEqual('2', count.strip())
+
+
+class RecordRepos(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.gb = load_github_backup()
+        self.org = os.path.join(self.tmp, 'bitbucket', 'org')
+        subprocess.run(['git', 'init', '-q', '-b', 'trunk', os.path.join(self.org, 'gitrepo')], check=True)
+        os.makedirs(os.path.join(self.org, 'hgrepo', '.hg'))
+
+    def record(self):
+        metadata = self.gb.RepoMetadata(os.path.join(self.tmp, 'metadata.json'))
+        self.gb.record_repos(self.org, metadata)
+        metadata.save()
+        with open(metadata.filename) as f:
+            return json.load(f)['repos']
+
+    def test_repos_are_recorded_and_forgotten(self):
+        repos = self.record()
+        self.assertEqual(('git', 'trunk'), (repos['bitbucket/org/gitrepo']['repo_type'],
+                                            repos['bitbucket/org/gitrepo']['default_branch']))
+        self.assertEqual(('hg', 'default'), (repos['bitbucket/org/hgrepo']['repo_type'],
+                                             repos['bitbucket/org/hgrepo']['default_branch']))
+
+        shutil.rmtree(os.path.join(self.org, 'hgrepo'))
+        self.assertEqual(['bitbucket/org/gitrepo'], list(self.record()))
@@ -0,0 +1,51 @@
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_do_search
+
+LINES = [
+    '/botanist/repos/github/org1/repo1/src/a.py:0:import os',
+    '/botanist/repos/github/org2/repo1/c.py:9:import re',
+]
+
+
+@patch('ui.views.do_search', fake_do_search(LINES))
+@patch('ui.views.get_index_generation', lambda: 'gen-1')
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+@patch('ui.metrics.statsd')
+class SearchMetrics(SearchStateMixin, TestCase):
+
+    def histograms(self, statsd):
+        return {args[0]: (args[1], kwargs['tags']) for args, kwargs in statsd.histogram.call_args_list}
+
+    def test_stages_are_timed_and_tagged(self, statsd):
+        self.assertEqual(200, self.client.get('/search/results.json', {'q': 'import', 'case': 'insensitive'}).status_code)
+
+        histograms = self.histograms(statsd)
+        for stage in ('parse', 'metadata', 'render'):
+            self.assertIn('spt.codesearcher.search.%s.duration' % stage, histograms)
+        self.assertEqual(2, histograms['spt.codesearcher.search.results'][0])
+        self.assertEqual(sum(len(line) + 1 for line in LINES), histograms['spt.codesearcher.search.csearch.bytes'][0])
+        self.assertEqual(['endpoint:search_json', 'case:insensitive', 'outcome:ok', 'cached:false'],
+                         histograms['spt.codesearcher.search.duration'][1])
+
+    def test_cached_searches_are_tagged(self, statsd):
+        self.client.get('/search/results.json', {'q': 'import'})
+        statsd.reset_mock()
+        self.client.get('/search/results.json', {'q': 'import'})
+
+        histograms = self.histograms(statsd)
+        self.assertIn('cached:true', histograms['spt.codesearcher.search.duration'][1])
+        self.assertNotIn('spt.codesearcher.search.parse.duration', histograms)
+
+    def test_streamed_searches_are_sent_when_the_stream_ends(self, statsd):
+        response = self.client.get('/search/results.ndjson', {'q': 'import', 'max_count': '1'})
+        statsd.histogram.assert_not_called()
+        b''.join(response.streaming_content)
+
+        histograms = self.histograms(statsd)
+        self.assertEqual(1, histograms['spt.codesearcher.search.results'][0])
+        self.assertIn('endpoint:search_ndjson', histograms['spt.codesearcher.search.duration'][1])
+        statsd.increment.assert_any_call('spt.codesearcher.search.truncated',
+                                         tags=histograms['spt.codesearcher.search.duration'][1])
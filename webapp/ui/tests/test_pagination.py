@@ -0,0 +1,71 @@
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.pagination import CursorError
+from ui.pagination import decode_cursor
+from ui.pagination import encode_cursor
+from ui.tests.test_do_search import SearchStateMixin
+from ui.views import group_search_results
+from ui.views import paginate_search
+
+
+def make_results(n_repos, n_files, n_lines):
+    matches = []
+    # deliberately out of order, pages should still be ordered by repo/file/line
+    for r in reversed(range(n_repos)):
+        for f in reversed(range(n_files)):
+            for l in reversed(range(n_lines)):
+                result = {'filename': 'file%d.py' % f, 'lineno': l + 1, 'srcline': 'x', 'deeplink': '', 'count': 0}
+                matches.append(('org/repo%d' % r, 'github', 'file%d.py' % f, result))
+    return group_search_results(iter(matches))
+
+
+class Cursor(TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(('1-2-3', 1500), decode_cursor(encode_cursor('1-2-3', 1500)))
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', encode_cursor('gen', -1), encode_cursor('gen', 'x')):
+            with self.assertRaises(CursorError):
+                decode_cursor(cursor)
+
+
+@patch('ui.views.get_index_generation', lambda: 'gen-1')
+class PaginateSearch(SearchStateMixin, TestCase):
+
+    def all_pages(self, page_size):
+        pages, cursor = [], None
+        while True:
+            page = paginate_search('query', True, cursor, page_size)
+            pages.append(page)
+            if page.next_cursor is None:
+                return pages
+            cursor = page.next_cursor
+
+    @patch('ui.views.search_and_group')
+    def test_pages_cover_all_results_in_order(self, search_and_group):
+        search_and_group.return_value = make_results(3, 4, 250)
+        pages = self.all_pages(page_size=700)
+
+        self.assertEqual(5, len(pages))
+        self.assertEqual([0, 700, 1400, 2100, 2800], [p.offset for p in pages])
+        self.assertEqual(3000, sum(p.size for p in pages))
+        self.assertTrue(all(p.count == 3000 for p in pages))
+
+        seen = []
+        for page in pages:
+            for repo, vcs_dict in page.results.items():
+                for filename, matches in vcs_dict['github']['files'].items():
+                    seen.extend((repo, filename, m['lineno']) for m in matches)
+        self.assertListEqual(sorted(seen), seen)
+        self.assertEqual(3000, len(set(seen)))
+
+        # the search only ran once, later pages were read from the spool
+        self.assertEqual(1, search_and_group.call_count)
+
+    @patch('ui.views.search_and_group')
+    def test_cursor_from_an_older_index_generation(self, search_and_group):
+        search_and_group.return_value = make_results(1, 1, 10)
+        with self.assertRaises(CursorError):
+            paginate_search('query', True, encode_cursor('gen-0', 5), 5)
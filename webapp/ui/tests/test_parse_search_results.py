@@ -10,10 +10,11 @@ FIXTURES_ROOT = os.path.join(os.path.dirname(__file__), 'fixtures')
 FX = lambda *relpath: os.path.join(FIXTURES_ROOT, *relpath)
 
 
-@patch('ui.views.get_repo_type')
+@patch('ui.views.get_repo_metadata')
 @patch('ui.views.CODE_ROOT', '/botanist/repos')
 class ParseSearchResults(TestCase):
-    def test_basic_parse_search_results(self, get_repo_type):
+    def test_basic_parse_search_results(self, get_repo_metadata):
+        get_repo_metadata.return_value = {'repo_type': 'git', 'default_branch': None}
         with open(FX('basic_parse_search_results.txt')) as f:
             output = f.read()
 
@@ -26,22 +27,22 @@ class ParseSearchResults(TestCase):
         self.assertEqual(1, len(results['org2/repo1']['github']['files']))
         self.assertEqual(1, len(results['org2/repo2']['github']['files']))
 
-    def test_duplicate_repositories_in_github_and_bitbucket(self, get_repo_type):
-        def se(filepath):
-            if 'bitbucket' in filepath:
-                return 'hg'
-            elif 'github' in filepath:
-                return 'git'
+    def test_duplicate_repositories_in_github_and_bitbucket(self, get_repo_metadata):
+        def se(vcs_loc, fully_qualified_repo_name):
+            if vcs_loc == 'bitbucket':
+                return {'repo_type': 'hg', 'default_branch': 'default'}
+            elif vcs_loc == 'github':
+                return {'repo_type': 'git', 'default_branch': 'main'}
             else:
                 raise Exception('thats odd')
 
-        get_repo_type.side_effect = se
+        get_repo_metadata.side_effect = se
         with open(FX('duplicate_repositories_in_github_and_bitbucket.results.txt')) as f:
              output = f.read()
 
         results, count = parse_search_results(output, 'AbstractSendTimeJob', True)
 
         self.assertEqual(2, count)
-        self.assertListEqual(['bitbucket', 'github'], results['org1/sproutjobs'].keys())
+        self.assertListEqual(['bitbucket', 'github'], list(results['org1/sproutjobs'].keys()))
         self.assertEqual('public abstract class AbstractJob implements Job {', results['org1/sproutjobs']['bitbucket']['files']['src/main/java/com/sproutsocial/AbstractJob.java'][0]['srcline'])
         self.assertEqual('public abstract class AbstractJob implements Job {', results['org1/sproutjobs']['github']['files']['src/main/java/com/sproutsocial/AbstractJob.java'][0]['srcline'])
@@ -1,6 +1,7 @@
 from django.test import TestCase
 
 from ui.views import get_query_re
+from ui.views import match_spans
 from ui.views import prepare_source_line
 
 
@@ -45,4 +46,17 @@ class PrepareSourceLine(TestCase):
         query_re = get_query_re(query, case_sensitive=False)
         for source_line, expected in test_cases:
             result = prepare_source_line(query_re, source_line, html=False)
-            self.assertEquals(expected, result)
\ No newline at end of file
+            self.assertEquals(expected, result)
+
+    def test_match_spans_use_the_query_as_a_regex(self):
+        query_re = get_query_re(r'fo+|ba[rz]')
+        self.assertEqual([[0, 3], [4, 7], [8, 12]], match_spans(query_re, 'foo bar fooo qux'))
+
+    def test_empty_matches_are_not_highlighted(self):
+        query_re = get_query_re(r'x*')
+        self.assertEqual('a&lt;b', prepare_source_line(query_re, 'a<b'))
+        self.assertEqual([], match_spans(query_re, 'a<b'))
+
+    def test_queries_python_cannot_compile_are_highlighted_as_plain_text(self):
+        query_re = get_query_re(r'\pL(')
+        self.assertEqual([[2, 6]], match_spans(query_re, r'a \pL( b'))
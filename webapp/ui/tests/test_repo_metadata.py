@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.metadata import RepoMetadata
+from ui.views import parse_search_results
+
+FIXTURES_ROOT = os.path.join(os.path.dirname(__file__), 'fixtures')
+FX = lambda *relpath: os.path.join(FIXTURES_ROOT, *relpath)
+
+
+class RepoMetadataMixin(object):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write_metadata(self, repos):
+        with open(self.filename, 'w') as f:
+            json.dump({'repos': repos}, f)
+
+
+class RepoMetadataStore(RepoMetadataMixin, TestCase):
+
+    def test_get(self):
+        self.write_metadata({'github/org1/repo1': {'repo_type': 'git', 'default_branch': 'develop'}})
+        metadata = RepoMetadata(self.filename)
+        metadata.refresh()
+
+        self.assertEqual('develop', metadata.get('github', 'org1/repo1')['default_branch'])
+        self.assertIsNone(metadata.get('bitbucket', 'org1/repo1'))
+
+    def test_reloaded_when_file_changes(self):
+        self.write_metadata({'github/org1/repo1': {'repo_type': 'git', 'default_branch': 'develop'}})
+        metadata = RepoMetadata(self.filename)
+        metadata.refresh()
+
+        self.write_metadata({'github/org1/repo1': {'repo_type': 'git', 'default_branch': 'trunk'}})
+        metadata.refresh()
+        self.assertEqual('trunk', metadata.get('github', 'org1/repo1')['default_branch'])
+
+    def test_missing_file(self):
+        metadata = RepoMetadata(os.path.join(tempfile.gettempdir(), 'does-not-exist.json'))
+        metadata.refresh()
+        self.assertIsNone(metadata.get('github', 'org1/repo1'))
+
+
+@patch('ui.views.Popen')
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class ParseSearchResultsWithMetadata(RepoMetadataMixin, TestCase):
+
+    def test_metadata_is_used_instead_of_inspecting_repos(self, popen):
+        self.write_metadata({
+            'github/org1/repo1': {'repo_type': 'git', 'default_branch': 'develop'},
+            'github/org2/repo1': {'repo_type': 'git', 'default_branch': 'main'},
+            'github/org2/repo2': {'repo_type': 'git', 'default_branch': 'main'},
+        })
+        with open(FX('basic_parse_search_results.txt')) as f:
+            output = f.read()
+
+        with patch('ui.views.repo_metadata', RepoMetadata(self.filename)):
+            results, count = parse_search_results(output, 'facebook_comment', True)
+
+        popen.assert_not_called()
+        self.assertEqual(4, count)
+        self.assertEqual('https://github.com/org1/repo1/blob/develop/src/main/java/com/sproutsocial/SomeClass.java#L148',
+                         results['org1/repo1']['github']['files']['src/main/java/com/sproutsocial/SomeClass.java'][0]['deeplink'])
+
+    def test_repos_without_metadata_get_the_default_branch(self, popen):
+        self.write_metadata({'github/org1/repo1': {'repo_type': 'git', 'default_branch': 'develop'}})
+        with open(FX('basic_parse_search_results.txt')) as f:
+            output = f.read()
+
+        with patch('ui.views.repo_metadata', RepoMetadata(self.filename)):
+            results, count = parse_search_results(output, 'facebook_comment', True)
+
+        popen.assert_not_called()
+        self.assertEqual('https://github.com/org2/repo1/blob/main/config.yml#L632',
+                         results['org2/repo1']['github']['files']['config.yml'][0]['deeplink'])
@@ -0,0 +1,49 @@
+import json
+import pickle
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.results import Match
+from ui.results import SourceFile
+from ui.results import encode_json
+from ui.views import iter_search_results
+
+
+class CompactMatch(TestCase):
+
+    def make_match(self, **kwargs):
+        source = SourceFile('github', 'org1/repo1', 'src/a.py', 'https://github.com/org1/repo1/blob/main/src/a.py', 'L')
+        return Match(source, 3, 'import os', 1, **kwargs)
+
+    def test_looks_like_a_dict(self):
+        match = self.make_match(spans=[[0, 6]])
+
+        self.assertEqual({'filename': 'src/a.py', 'lineno': 3, 'srcline': 'import os', 'count': 1, 'spans': [[0, 6]],
+                          'deeplink': 'https://github.com/org1/repo1/blob/main/src/a.py#L3'}, match)
+        self.assertEqual('src/a.py', match['filename'])
+        self.assertNotIn('before', match)
+        match['before'] = [{'lineno': 2, 'srcline': ''}]
+        self.assertIn('before', match)
+        with self.assertRaises(KeyError):
+            match['lineno'] = 4
+
+    def test_optional_fields_are_left_out_until_set(self):
+        self.assertEqual(['filename', 'lineno', 'srcline', 'deeplink', 'count'], list(self.make_match().keys()))
+        with self.assertRaises(KeyError):
+            self.make_match()['spans']
+
+    def test_json_and_pickle(self):
+        match = self.make_match(spans=[[0, 6]])
+
+        self.assertEqual(match.to_dict(), json.loads(json.dumps(match, default=encode_json)))
+        self.assertEqual(match, pickle.loads(pickle.dumps(match)))
+
+    @patch('ui.views.CODE_ROOT', '/botanist/repos')
+    @patch('ui.views.get_repo_metadata', lambda vcs_loc, repo: {'repo_type': 'git', 'default_branch': 'main'})
+    def test_matches_in_a_file_share_it(self):
+        lines = ['/botanist/repos/github/org1/repo1/src/a.py:%d:import os' % i for i in range(3)]
+        matches = [result for _, _, _, result in iter_search_results(lines, 'import')]
+
+        self.assertIs(matches[0].file, matches[2].file)
+        self.assertEqual('https://github.com/org1/repo1/blob/main/src/a.py#L3', matches[2]['deeplink'])
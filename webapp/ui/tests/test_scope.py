@@ -0,0 +1,89 @@
+import re
+
+from django.http import QueryDict
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.scope import Scope
+from ui.scope import ScopeError
+from ui.scope import file_regex
+from ui.scope import get_scope
+from ui.scope import select_shards
+from ui.tests.test_do_search import FakeCSearchMixin
+from ui.views import do_search
+
+SHARDS = [
+    '/shards/bitbucket/org1.index',
+    '/shards/github/org1.index',
+    '/shards/github/org2.0.index',
+    '/shards/github/org2.1.index',
+    '/shards/github/org3.index',
+]
+
+
+class GetScope(TestCase):
+
+    def test_no_scope(self):
+        self.assertIsNone(get_scope(QueryDict('q=foo')))
+
+    def test_repos_and_orgs(self):
+        scope = get_scope(QueryDict('repo=org1/b&repo=org1/a&org=org2&vcs=github'))
+        self.assertEqual(Scope(('github',), ('org2',), ('org1/a', 'org1/b'), None), scope)
+
+    def test_invalid_repo(self):
+        with self.assertRaises(ScopeError):
+            get_scope(QueryDict('repo=org1'))
+
+
+class FileRegex(TestCase):
+
+    def matches(self, scope, relpath):
+        return re.search(file_regex(scope, '/botanist/repos'), '/botanist/repos/' + relpath) is not None
+
+    def test_repos_and_orgs(self):
+        scope = Scope((), ('org2',), ('org1/repo.x',), None)
+        self.assertTrue(self.matches(scope, 'github/org1/repo.x/a.py'))
+        self.assertTrue(self.matches(scope, 'bitbucket/org2/anything/a.py'))
+        self.assertFalse(self.matches(scope, 'github/org1/repo_x/a.py'))
+        self.assertFalse(self.matches(scope, 'github/org1/repo.x2/a.py'))
+
+    def test_path_globs(self):
+        self.assertTrue(self.matches(Scope((), (), (), '*.py'), 'github/org1/repo/src/deep/a.py'))
+        self.assertFalse(self.matches(Scope((), (), (), '*.py'), 'github/org1/repo/a.pyc'))
+        self.assertTrue(self.matches(Scope((), (), (), 'src/*.py'), 'github/org1/repo/src/a.py'))
+        self.assertFalse(self.matches(Scope((), (), (), 'src/*.py'), 'github/org1/repo/src/deep/a.py'))
+        self.assertTrue(self.matches(Scope((), (), (), 'src/**.py'), 'github/org1/repo/src/deep/a.py'))
+        self.assertTrue(self.matches(Scope((), (), (), 'src/**/a.py'), 'github/org1/repo/src/a.py'))
+        self.assertTrue(self.matches(Scope((), (), (), 'src/**/a.py'), 'github/org1/repo/src/deep/er/a.py'))
+        self.assertFalse(self.matches(Scope((), (), (), 'src/**/a.py'), 'github/org1/repo/src/ba.py'))
+        self.assertTrue(self.matches(Scope((), (), (), '**/test/*.py'), 'github/org1/repo/test/a.py'))
+
+    def test_vcs_location(self):
+        scope = Scope(('bitbucket',), (), (), None)
+        self.assertTrue(self.matches(scope, 'bitbucket/org1/repo/a.py'))
+        self.assertFalse(self.matches(scope, 'github/org1/repo/a.py'))
+
+
+class SelectShards(TestCase):
+
+    def test_only_shards_of_the_selected_orgs(self):
+        scope = Scope(('github',), ('org1',), ('org2/repo',), None)
+        self.assertListEqual(SHARDS[1:4], select_shards(SHARDS, '/shards', scope))
+
+    def test_single_index(self):
+        scope = Scope((), ('org1',), (), None)
+        self.assertListEqual(['/home/botanist/.csearchindex'], select_shards(['/home/botanist/.csearchindex'], '/shards', scope))
+
+
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class ScopedSearch(FakeCSearchMixin, TestCase):
+
+    def test_scope_is_passed_to_csearch(self):
+        # prints the arguments it was given, one per line
+        self.install_csearch('#!/bin/sh\nprintf "%s\\n" "$@"\n')
+        shards = ['/shards/github/org1.index', '/shards/github/org2.index']
+        with patch('ui.views.BIN_PATH', self.bin_path), patch('ui.index.INDEX_SHARDS', '/shards'), \
+                patch('ui.index.glob.glob', lambda pattern: shards):
+            args = list(do_search('foo', scope=Scope((), (), ('org2/repo',), None)))
+
+        self.assertListEqual(['-n', '-f', '^/botanist/repos/[^/]+/(?:org2/repo)/', '--', 'foo'], args)
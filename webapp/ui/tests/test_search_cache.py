@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.cache import SQLiteLRUCache
+from ui.deadline import Deadline
+from ui.tests.test_do_search import SearchStateMixin
+from ui.views import cached_search
+from ui.views import paginate_search
+
+
+# a search with one match, as search_and_group() returns it
+RESULTS = ({'org1/repo1': {'github': {'files': {'a.py': [{'lineno': 1, 'line': 'query'}]}}}}, 1, False)
+
+
+class SearchCacheMixin(object):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.cache_dir, 'cache.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class SQLiteLRUCacheBackend(SearchCacheMixin, TestCase):
+
+    def make_cache(self, max_bytes, **options):
+        return SQLiteLRUCache(self.location, {'OPTIONS': dict(options, MAX_BYTES=max_bytes)})
+
+    def accessed(self, cache, key):
+        return cache._db.execute('SELECT accessed FROM cache WHERE key = ?', (cache.make_key(key),)).fetchone()[0]
+
+    def test_get_and_set(self):
+        cache = self.make_cache(1024 * 1024)
+        cache.set('key', {'results': [1, 2, 3]})
+        self.assertEqual({'results': [1, 2, 3]}, cache.get('key'))
+        self.assertIsNone(cache.get('missing'))
+
+    def test_shared_between_instances(self):
+        self.make_cache(1024 * 1024).set('key', 'value')
+        self.assertEqual('value', self.make_cache(1024 * 1024).get('key'))
+
+    def test_least_recently_used_entries_are_evicted_to_fit_max_bytes(self):
+        cache = self.make_cache(2500)
+        cache.set('a', 'a' * 1000)
+        cache.set('b', 'b' * 1000)
+        cache.get('a')
+        cache.set('c', 'c' * 1000)
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertLessEqual(cache.total_size(), 2500)
+
+    def test_values_bigger_than_the_cache_are_not_stored(self):
+        cache = self.make_cache(100)
+        cache.set('a', 'a' * 1000)
+        self.assertIsNone(cache.get('a'))
+
+    def test_access_times_are_written_in_batches(self):
+        cache = self.make_cache(1024 * 1024, ACCESS_BATCH=2)
+        cache.set('a', 'a')
+        cache.set('b', 'b')
+        set_at = self.accessed(cache, 'a')
+
+        cache.get('a')
+        self.assertEqual(set_at, self.accessed(cache, 'a'))
+        cache.get('b')
+        self.assertGreater(self.accessed(cache, 'a'), set_at)
+        self.assertGreater(self.accessed(cache, 'b'), set_at)
+
+    def test_total_size_is_kept_up_to_date(self):
+        cache = self.make_cache(1024 * 1024)
+        cache.set('a', 'a' * 1000)
+        cache.set('a', 'a' * 2000)
+        cache.set_many({'b': 'b' * 1000, 'c': 'c' * 1000})
+        cache.delete('b')
+        expected = cache._db.execute('SELECT SUM(size) FROM cache').fetchone()[0]
+        self.assertEqual(expected, cache.total_size())
+        self.assertGreater(cache.total_size(), 3000)
+
+    def test_culled_only_over_max_bytes_and_once_per_set_many(self):
+        cache = self.make_cache(2500)
+        with patch.object(cache, '_cull', wraps=cache._cull) as cull:
+            cache.set('a', 'a' * 1000)
+            cache.set('b', 'b' * 1000)
+            self.assertEqual(0, cull.call_count)
+            self.assertEqual([], cache.set_many({'c': 'c' * 1000, 'd': 'd' * 1000, 'e': 'e' * 1000}))
+            self.assertEqual(1, cull.call_count)
+        self.assertLessEqual(cache.total_size(), 2500)
+
+    def test_expired_entries_are_not_returned(self):
+        cache = self.make_cache(1024 * 1024)
+        cache.set('a', 'value', timeout=-1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_add_replaces_expired_entries(self):
+        cache = self.make_cache(1024 * 1024)
+        cache.set('a', 'old', timeout=-1)
+        self.assertTrue(cache.add('a', 'new'))
+        self.assertEqual('new', cache.get('a'))
+        self.assertFalse(cache.add('a', 'newer'))
+        self.assertEqual('new', cache.get('a'))
+        self.assertEqual(cache._db.execute('SELECT SUM(size) FROM cache').fetchone()[0], cache.total_size())
+
+
+class CachedSearch(SearchStateMixin, TestCase):
+
+    @patch('ui.views.search_and_group')
+    def test_repeat_searches_are_served_from_the_cache(self, search_and_group):
+        search_and_group.return_value = RESULTS
+        with patch('ui.views.get_index_generation', lambda: 'gen-1'):
+            self.assertEqual(RESULTS, cached_search('query'))
+            self.assertEqual(RESULTS, cached_search('query'))
+            cached_search('query', case_sensitive=False)
+            cached_search('query', html=False)
+
+        self.assertEqual(3, search_and_group.call_count)
+
+    @patch('ui.views.search_and_group')
+    def test_searches_are_only_stored_spooled(self, search_and_group):
+        search_and_group.return_value = RESULTS
+        with patch('ui.views.get_index_generation', lambda: 'gen-1'):
+            cached_search('query')
+            page = paginate_search('query', True, None, 10)
+
+        self.assertEqual(1, search_and_group.call_count)
+        self.assertEqual(1, page.count)
+        # the spool's header and its one chunk
+        cache = SQLiteLRUCache(os.path.join(self.search_state_dir, 'cache.sqlite3'), {})
+        self.assertEqual(2, cache._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0])
+
+    @patch('ui.views.search_and_group')
+    def test_new_index_generation_invalidates_results(self, search_and_group):
+        search_and_group.return_value = ({}, 0, False)
+        with patch('ui.views.get_index_generation', lambda: 'gen-1'):
+            cached_search('query')
+        with patch('ui.views.get_index_generation', lambda: 'gen-2'):
+            cached_search('query')
+
+        self.assertEqual(2, search_and_group.call_count)
+
+    @patch('ui.views.search_and_group')
+    def test_timed_out_searches_are_not_cached(self, search_and_group):
+        def timed_out_search(*args, deadline=None, **kwargs):
+            deadline.expired = True
+            return RESULTS
+        search_and_group.side_effect = timed_out_search
+        with patch('ui.views.get_index_generation', lambda: 'gen-1'):
+            self.assertEqual(RESULTS, cached_search('query', deadline=Deadline(30)))
+            cached_search('query', deadline=Deadline(30))
+
+        self.assertEqual(2, search_and_group.call_count)
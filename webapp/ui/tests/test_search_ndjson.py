@@ -0,0 +1,39 @@
+import json
+
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_do_search
+
+LINES = [
+    '/botanist/repos/github/org1/repo1/src/a.py:0:import os',
+    '/botanist/repos/github/org1/repo1/src/b.py:4:    import sys',
+    '/botanist/repos/github/org2/repo1/c.py:9:import re',
+]
+
+
+@patch('ui.views.do_search', fake_do_search(LINES))
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class SearchNDJSON(SearchStateMixin, TestCase):
+
+    def get_matches(self, params):
+        response = self.client.get('/search/results.ndjson', params)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        body = b''.join(response.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_one_object_per_match(self):
+        matches = self.get_matches({'q': 'import'})
+
+        self.assertEqual(3, len(matches))
+        self.assertEqual({'repo': 'org1/repo1', 'vcs_loc': 'github', 'filename': 'src/b.py', 'lineno': 5,
+                          'srcline': '    import sys', 'spans': [[4, 10]]}, matches[1])
+
+    def test_max_count(self):
+        matches = self.get_matches({'q': 'import', 'max_count': '2'})
+        self.assertEqual(['src/a.py', 'src/b.py'], [m['filename'] for m in matches])
+
+    def test_missing_query(self):
+        self.assertEqual(400, self.client.get('/search/results.ndjson').status_code)
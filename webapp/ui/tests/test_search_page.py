@@ -0,0 +1,47 @@
+from django.test import TestCase
+from unittest.mock import patch
+
+from ui.admission import SearchBusyError
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_do_search
+
+LINES = [
+    '/botanist/repos/github/org1/repo1/src/a.py:0:import os',
+    '/botanist/repos/github/org2/repo1/c.py:9:import re',
+]
+
+
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+class SearchPage(SearchStateMixin, TestCase):
+
+    def test_header_is_sent_before_searching(self):
+        with patch('ui.views.do_search', side_effect=fake_do_search(LINES)) as do_search:
+            response = self.client.get('/search/', {'q': 'import'})
+            chunks = iter(response.streaming_content)
+            header = next(chunks).decode('utf-8')
+            self.assertFalse(do_search.called)
+            rest = b''.join(chunks).decode('utf-8')
+
+        self.assertEqual(200, response.status_code)
+        self.assertIn('id="search-box"', header)
+        self.assertEqual('import', do_search.call_args[0][0])
+        self.assertIn('id="org1/repo1_github"', rest)
+        self.assertIn('id="org2/repo1_github"', rest)
+        self.assertIn('2 results found', rest)
+
+    @patch('ui.views.spooled_search')
+    def test_busy_search_is_shown_on_the_page(self, spooled_search):
+        spooled_search.side_effect = SearchBusyError('too many searches')
+        response = self.client.get('/search/', {'q': 'import'})
+        content = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertIn('error: too many searches', content)
+
+    def test_scope_links_keep_the_case(self):
+        with patch('ui.views.do_search', fake_do_search(LINES)):
+            response = self.client.get('/search/', {'q': 'import', 'case': 'insensitive', 'org': 'org1'})
+            content = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertIn('<a href="?q=import&amp;case=insensitive">search everything</a>', content)
+        self.assertIn('href="?q=import&amp;case=insensitive&amp;vcs=github&amp;repo=org1/repo1"', content)
+        self.assertIn('value="insensitive" checked>', content)
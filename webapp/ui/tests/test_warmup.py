@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+from unittest.mock import patch
+
+from ui import querylog
+from ui import warmup
+from ui.admission import SearchBusyError
+from ui.models import QueryLog
+from ui.scope import Scope
+from ui.tests.test_do_search import SearchStateMixin
+from ui.tests.test_do_search import fake_do_search
+from ui.views import RegexError
+
+
+LINES = ['/botanist/repos/github/org1/repo1/src/a.py:0:import os']
+
+
+@patch('ui.views.do_search', fake_do_search(LINES))
+@patch('ui.views.get_index_generation', lambda: 'gen-1')
+@patch('ui.views.CODE_ROOT', '/botanist/repos')
+@patch('ui.metrics.statsd')
+class QueryLogging(SearchStateMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # searches of other tests still waiting to be written
+        del querylog.buffer[:]
+
+    def test_searches_are_recorded(self, statsd):
+        self.client.get('/search/results.json', {'q': 'import', 'case': 'insensitive', 'org': 'org1', 'path': '*.py'})
+        # buffered, rather than written while the search is served
+        self.assertFalse(QueryLog.objects.exists())
+
+        self.assertEqual(1, querylog.flush())
+        entry = QueryLog.objects.get()
+        self.assertEqual(('search_json', 'import', False, 'ok', 1, False),
+                         (entry.endpoint, entry.query, entry.case_sensitive, entry.outcome, entry.results,
+                          entry.cached))
+        self.assertEqual('org=org1&path=%2A.py', entry.scope)
+
+    @patch('ui.querylog.QUERY_LOG', False)
+    def test_recording_can_be_turned_off(self, statsd):
+        self.client.get('/search/results.json', {'q': 'import'})
+        self.assertEqual(0, querylog.flush())
+
+
+class PopularSearches(TestCase):
+
+    def log(self, query, endpoint='search', outcome='ok', scope='', age=None):
+        entry = QueryLog.objects.create(endpoint=endpoint, query=query, scope=scope, outcome=outcome, duration=0.1)
+        if age is not None:
+            QueryLog.objects.filter(pk=entry.pk).update(created_at=timezone.now() - age)
+
+    def test_most_popular_first(self):
+        for query, n in [('foo', 1), ('bar', 3), ('baz', 2)]:
+            for _ in range(n):
+                self.log(query)
+        self.assertEqual(['bar', 'baz'], [s['query'] for s in querylog.popular_searches(2, 7)])
+
+    def test_failed_and_old_searches_are_left_out(self):
+        self.log('foo')
+        self.log('timed', outcome='timed_out')
+        self.log('old', age=timedelta(days=8))
+        self.assertEqual(['foo'], [s['query'] for s in querylog.popular_searches(10, 7)])
+
+    def test_json_and_ndjson_searches_are_replayed_as_json(self):
+        self.log('foo', endpoint='search_json')
+        self.log('foo', endpoint='search_ndjson')
+        self.log('foo', scope='org=org1')
+        self.assertEqual([{'query': 'foo', 'case_sensitive': True, 'scope': '', 'html': False, 'count': 2},
+                          {'query': 'foo', 'case_sensitive': True, 'scope': 'org=org1', 'html': True, 'count': 1}],
+                         querylog.popular_searches(10, 7))
+
+    def test_prune(self):
+        self.log('new')
+        self.log('old', age=timedelta(days=31))
+        self.assertEqual(1, querylog.prune(30))
+        self.assertEqual(['new'], list(QueryLog.objects.values_list('query', flat=True)))
+
+
+class Prefault(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reads_every_file(self):
+        files = []
+        for i, size in enumerate([0, 10, 2500]):
+            files.append(os.path.join(self.dir, '%d.index' % i))
+            with open(files[-1], 'wb') as f:
+                f.write(b'x' * size)
+        files.append(os.path.join(self.dir, 'missing.index'))
+        self.assertEqual(2510, warmup.prefault(files, chunk_size=1000))
+
+
+@patch('ui.warmup.get_index_generation', lambda: 'gen-2')
+class Replay(TestCase):
+
+    def search(self, query, scope='', html=True):
+        return {'query': query, 'case_sensitive': True, 'scope': scope, 'html': html, 'count': 1}
+
+    def test_searches_are_run_without_waiting(self):
+        with patch('ui.views.cached_search') as cached_search:
+            self.assertEqual(2, warmup.replay([self.search('foo', 'org=org1&path=%2A.py'),
+                                               self.search('bar', html=False)]))
+
+        args, kwargs = cached_search.call_args_list[0]
+        self.assertEqual(('foo', True, True, 'gen-2', Scope((), ('org1',), (), '*.py')), args[:5])
+        self.assertEqual({'wait': False}, kwargs)
+        self.assertEqual(('bar', True, False, 'gen-2', None), cached_search.call_args_list[1][0][:5])
+
+    def test_busy_and_invalid_searches_are_skipped(self):
+        errors = [SearchBusyError('busy'), RegexError('bad'), None]
+        with patch('ui.views.cached_search', side_effect=errors):
+            self.assertEqual(1, warmup.replay([self.search('a'), self.search('('), self.search('c')]))
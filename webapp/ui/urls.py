@@ -1,9 +1,16 @@
 from django.urls import path
 
+from codesearch.settings import ASYNC_SEARCH
+from . import aio
 from . import views
 
+search_views = aio if ASYNC_SEARCH else views
+
 urlpatterns = [
     path("", views.index),
-    path("search/", views.search),
-    path("search/results.json", views.search_json),
+    path("search/", search_views.search),
+    path("search/results.json", search_views.search_json),
+    path("search/results.ndjson", search_views.search_ndjson),
+    path("search/commits/", views.commit_search),
+    path("search/commits.json", views.commit_search_json),
 ]
@@ -1,214 +1,1000 @@
+import hashlib
+import heapq
 import json
 import logging
-import pipes
+import os
 import re
+import signal
 import time
 
-from collections import OrderedDict
+from contextlib import nullcontext
+from functools import lru_cache
 from subprocess import Popen
 from subprocess import PIPE
 from os import path
+from urllib.parse import urlencode
 
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
 from django.http import HttpResponseServerError
+from django.http import StreamingHttpResponse
 from django.utils.html import escape
 
 from django.shortcuts import render
+from django.template.loader import get_template
+from django.template.loader import render_to_string
 
 from codesearch.settings import BIN_PATH
 from codesearch.settings import CODE_ROOT
-from ui.util import get_repo_type
-
-HIGHLIGHT_QUERY_TEMPLATE = r'<span class="highlighted-search-query">\1</span>'
+from codesearch.settings import MAX_PAGE_SIZE
+from codesearch.settings import MAX_RESULTS
+from codesearch.settings import MAX_SEARCH_TIMEOUT
+from codesearch.settings import PAGE_SIZE
+from codesearch.settings import REPO_METADATA
+from codesearch.settings import SEARCH_BACKEND
+from codesearch.settings import SEARCH_CURSOR_TIMEOUT
+from codesearch.settings import SEARCH_TIMEOUT
+from ui.admission import SearchBusyError
+from ui.admission import acquire_slot
+from ui.admission import search_slot
+from ui.admission import singleflight
+from ui.commits import CommitIndexMissingError
+from ui.commits import get_commit_shards
+from ui.commits import CommitSearchError
+from ui.commits import search_commits
+from ui.context import MAX_CONTEXT_LINES
+from ui.context import add_context
+from ui.context import add_repo_context
+from ui.deadline import Deadline
+from ui.index import get_index_generation
+from ui.index import get_last_indexed
+from ui.index import get_shards
+from ui.metadata import RepoMetadata
+from ui.metrics import SearchStats
+from ui.pagination import CursorError
+from ui.pagination import Page
+from ui.pagination import decode_cursor
+from ui.pagination import encode_cursor
+from ui.pagination import read_spool
+from ui.pagination import write_spool
+from ui.results import Match
+from ui.results import SourceFile
+from ui.results import encode_json
+from ui.scope import ScopeError
+from ui.scope import file_regex
+from ui.scope import get_scope
+from ui.scope import scope_params
+from ui import engine
+
+HIGHLIGHT_QUERY_TEMPLATE = '<span class="highlighted-search-query">%s</span>'
 DEEP_LINK_TEMPLATES = {
     'bitbucket': 'https://bitbucket.org/%(fully_qualified_repo_name)s/src/%(branch)s/%(fpath)s',
     'github': 'https://github.com/%(fully_qualified_repo_name)s/blob/%(branch)s/%(fpath)s',
 }
-LINENO_TEMPLATES = {
-    'bitbucket': '%s-%s',
-    'github': 'L%s',
+LINE_ANCHOR_TEMPLATES = {
+    'bitbucket': '%(src_file)s-',
+    'github': 'L',
 }
 
 E_UNABLE_TO_SEARCH = 'unable to search.'
+# compiled query regexes kept per process, popular queries are searched
+# (and paged through) over and over
+QUERY_RE_CACHE_SIZE = 256
+# part of the search cache key, bump it when the results format changes
+RESULTS_VERSION = 4
+# seconds busy clients are asked to wait before trying again
+BUSY_RETRY_AFTER = 5
 
 log = logging.getLogger(__name__)
 
+repo_metadata = RepoMetadata(REPO_METADATA)
+
 class RegexError(Exception):
     pass
 
 class CSearchMissingError(Exception):
     pass
 
+# what a search can fail with once its parameters have been checked
+SEARCH_ERRORS = (CSearchMissingError, SearchBusyError, RegexError, CursorError)
+COMMIT_SEARCH_ERRORS = (CommitIndexMissingError, CommitSearchError, SearchBusyError)
+
 def index(request):
-    return render(request, 'index.html')
+    return render(request, 'index.html', {'last_indexed': get_last_indexed()})
 
 def search(request):
+    """
+    Streams the search page: the header and search form are sent before
+    searching, then each repo's results as they are rendered, so the browser
+    starts drawing right away and the page is never held whole in memory.
+    """
     query = request.GET.get('q')
     case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    cursor = request.GET.get('cursor')
     if query is None:
         return HttpResponseBadRequest()
-
-    s = time.time()
     try:
-        output = do_search(query, case_sensitive)
-    except CSearchMissingError as e:
-        log.error('problem executing csearch: %s', e)
-        return HttpResponseServerError(E_UNABLE_TO_SEARCH)
+        page_size = get_page_size(request)
+        before, after = get_context_size(request)
+        scope = get_scope(request.GET)
+        deadline = Deadline(get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
 
-    results, count, error = None, None, None
+    page_params = {'q': query, 'case': 'sensitive' if case_sensitive else 'insensitive', 'page_size': page_size,
+                   'before': before, 'after': after}
+    page_params.update(scope_params(scope))
+    if request.GET.get('timeout'):
+        page_params['timeout'] = request.GET['timeout']
+    stats = SearchStats('search', case_sensitive, query, scope)
+    response = StreamingHttpResponse(search_page(request, query, case_sensitive, cursor, page_size, before, after,
+                                                 scope, deadline, stats, page_params),
+                                     content_type='text/html; charset=utf-8')
+    # ask nginx to pass the page through as it is written instead of buffering
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def search_page(request, query, case_sensitive, cursor, page_size, before, after, scope, deadline, stats,
+                page_params):
+    """
+    Yields the html of the search page in pieces. The status has been sent
+    by the time anything goes wrong, so errors (busy included) are shown on
+    the page.
+    """
+    context = {'query': query, 'case': page_params['case'], 'before': before, 'after': after, 'scope': scope}
+    outcome = 'disconnected'
     try:
-        results, count = parse_search_results(output, query, case_sensitive)
-    except RegexError as e:
-        error = e.message
-    ts = "%.2f seconds" % (time.time() - s)
-    log.info('search time=%s', ts)
+        with stats.timed('render'):
+            header = render_to_string('search_header.html', context, request)
+        yield header
+
+        s = time.time()
+        page, error, page_outcome = None, None, 'ok'
+        try:
+            page = paginate_search(query, case_sensitive, cursor, page_size, scope=scope, deadline=deadline,
+                                   stats=stats)
+        except SEARCH_ERRORS as e:
+            error, page_outcome = page_error(e)
+        ts = "%.2f seconds" % (time.time() - s)
+        log.info('search time=%s', ts)
+
+        context.update({'time': ts, 'error': error})
+        if page is not None:
+            page_outcome = page_stats(stats, page)
+            yield from render_search_results(page.results, before, after, stats)
+            add_page_context(context, page, page_params)
+        context['last_indexed'] = get_last_indexed()
+        with stats.timed('render'):
+            footer = render_to_string('search_footer.html', context, request)
+        yield footer
+        outcome = page_outcome
+    finally:
+        # also runs when the client disconnects part way through the page
+        stats.send(outcome)
+
+
+def page_error(e):
+    """
+    Returns the message and outcome to show for one of SEARCH_ERRORS.
+    """
+    if isinstance(e, CSearchMissingError):
+        log.error('problem executing csearch: %s', e)
+        return E_UNABLE_TO_SEARCH, 'error'
+    if isinstance(e, SearchBusyError):
+        return str(e), 'busy'
+    return str(e), 'invalid'
+
+
+def add_page_context(context, page, page_params):
+    context.update({
+        'result_count': page.count, 'results': page.results, 'truncated': page.truncated,
+        'timed_out': page.timed_out, 'page_start': page.offset + 1, 'page_end': page.offset + page.size,
+    })
+    if page.next_cursor:
+        context['next_page_url'] = '?' + urlencode(dict(page_params, cursor=page.next_cursor), doseq=True)
+
+
+def render_search_results(results, before=0, after=0, stats=None):
+    """
+    Yields the html of each repo's results in turn. Context is read just
+    before a repo is rendered, and nothing rendered is kept.
+    """
+    template = get_template('search_repo.html')
+    for fully_qualified_repo_name, vcs_results in results.items():
+        for vcs_loc, repo_results in vcs_results.items():
+            if before or after:
+                s = time.perf_counter()
+                add_repo_context(fully_qualified_repo_name, vcs_loc, repo_results, CODE_ROOT, before, after)
+                if stats is not None:
+                    stats.add('context', time.perf_counter() - s)
+            s = time.perf_counter()
+            html = template.render({'reponame': fully_qualified_repo_name, 'vcs_loc': vcs_loc,
+                                    'repo_result_data': repo_results})
+            if stats is not None:
+                stats.add('render', time.perf_counter() - s)
+            yield html
 
-    context = {'query': query, 'result_count': count, 'results': results, 'time': ts, 'error': error}
-    return render(request, 'search.html', context)
 
 def search_json(request):
     query = request.GET.get('q')
     case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    cursor = request.GET.get('cursor')
     if query is None:
         return HttpResponseBadRequest()
+    try:
+        page_size = get_page_size(request)
+        before, after = get_context_size(request)
+        scope = get_scope(request.GET)
+        deadline = Deadline(get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
 
+    stats = SearchStats('search_json', case_sensitive, query, scope)
     try:
-        output = do_search(query, case_sensitive)
+        page = paginate_search(query, case_sensitive, cursor, page_size, html=False, scope=scope, deadline=deadline,
+                               stats=stats)
+        if before or after:
+            with stats.timed('context'):
+                add_context(page.results, CODE_ROOT, before, after, html=False)
     except CSearchMissingError as e:
         log.error('problem executing csearch: %s', e)
+        stats.send('error')
         return render_json({'error': E_UNABLE_TO_SEARCH}, status_code=500)
+    except SearchBusyError as e:
+        stats.send('busy')
+        return render_busy_json(e)
+    except (RegexError, CursorError) as e:
+        stats.send('invalid')
+        return render_json({'results': None, 'count': None, 'truncated': False, 'timed_out': False,
+                            'next_cursor': None, 'error': str(e)})
+
+    outcome = page_stats(stats, page)
+    with stats.timed('render'):
+        response = render_json({'results': page.results, 'count': page.count, 'truncated': page.truncated,
+                                'timed_out': page.timed_out, 'offset': page.offset, 'next_cursor': page.next_cursor,
+                                'error': None})
+    stats.send(outcome)
+    return response
+
+
+def page_stats(stats, page):
+    """
+    Records the result counts of a page of results. Returns the outcome of
+    its search.
+    """
+    stats.results = page.count
+    stats.truncated = page.truncated
+    return 'timed_out' if page.timed_out else 'ok'
+
+
+def search_ndjson(request):
+    """
+    Streams newline delimited JSON, one object per match, as csearch finds
+    them. Unlike results.json nothing is grouped, cached or held in memory, so
+    clients can start printing right away and hang up once they have enough.
+    A search that runs out of time ends with a {"timed_out": true} line.
+    """
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    if query is None:
+        return HttpResponseBadRequest()
+    try:
+        max_count = min(int(request.GET.get('max_count', MAX_RESULTS)), MAX_RESULTS)
+        scope = get_scope(request.GET)
+        deadline = Deadline(get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
+
+    stats = SearchStats('search_ndjson', case_sensitive, query, scope)
+    try:
+        slot = acquire_slot(count=search_processes(scope))
+    except SearchBusyError as e:
+        stats.send('busy')
+        return render_busy_json(e)
+
+    lines = do_search(query, case_sensitive, scope, deadline, stats=stats)
+    matches = iter_search_results(lines, query, case_sensitive, html=False, stats=stats)
+    response = StreamingHttpResponse(ndjson_matches(matches, max_count, slot, deadline, stats),
+                                     content_type='application/x-ndjson')
+    # ask nginx to pass lines through as they are written instead of buffering
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def ndjson_matches(matches, max_count, slot=None, deadline=None, stats=None):
+    count, truncated, outcome = 0, False, 'disconnected'
+    try:
+        for fully_qualified_repo_name, vcs_loc, filename, result in matches:
+            if count >= max_count:
+                truncated = True
+                break
+            count += 1
+            s = time.perf_counter()
+            line = ndjson_line(fully_qualified_repo_name, vcs_loc, filename, result)
+            if stats is not None:
+                stats.add('render', time.perf_counter() - s)
+            yield line
+        outcome = 'ok'
+        if deadline is not None and deadline.expired:
+            outcome = 'timed_out'
+            yield json.dumps({'timed_out': True}) + '\n'
+    except (CSearchMissingError, RegexError) as e:
+        # errors can't be reported once streaming has started
+        log.error('problem executing csearch: %s', e)
+        outcome = 'error'
+    finally:
+        # also runs when the client disconnects, which stops csearch
+        close_iter(matches)
+        if slot is not None:
+            slot.release()
+        if stats is not None:
+            stats.results, stats.truncated = count, truncated
+            stats.send(outcome)
+
+
+def ndjson_line(fully_qualified_repo_name, vcs_loc, filename, result):
+    return json.dumps({
+        'repo': fully_qualified_repo_name,
+        'vcs_loc': vcs_loc,
+        'filename': filename,
+        'lineno': result['lineno'],
+        'srcline': result['srcline'],
+        'spans': result['spans'],
+    }) + '\n'
+
+
+def commit_search(request):
+    """
+    The commit search page: the commits whose message, author or SHA match
+    the query, newest first. See ui.commits.
+    """
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    if query is None:
+        return HttpResponseBadRequest()
+    try:
+        scope = get_scope(request.GET)
+        deadline = Deadline(get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
 
-    results, count, error = None, None, None
+    stats = SearchStats('commits', case_sensitive, query, scope)
+    context = {'query': query, 'case': 'sensitive' if case_sensitive else 'insensitive', 'scope': scope}
+    s = time.time()
+    try:
+        commits, count, truncated = run_commit_search(query, case_sensitive, scope, deadline, stats)
+    except COMMIT_SEARCH_ERRORS as e:
+        context['error'], outcome = commit_search_error(e)
+    else:
+        query_re = get_query_re(query, case_sensitive)
+        with stats.timed('parse'):
+            for commit in commits:
+                commit['subject_html'] = prepare_source_line(query_re, commit['subject'])
+        stats.results, stats.truncated = count, truncated
+        outcome = 'timed_out' if deadline.expired else 'ok'
+        context.update({'commits': commits, 'result_count': count, 'truncated': truncated,
+                        'timed_out': deadline.expired})
+    context['time'] = "%.2f seconds" % (time.time() - s)
+    with stats.timed('render'):
+        response = render(request, 'commits.html', context)
+    stats.send(outcome)
+    return response
+
+
+def commit_search_json(request):
+    query = request.GET.get('q')
+    case_sensitive = request.GET.get('case', '').lower() != 'insensitive'
+    if query is None:
+        return HttpResponseBadRequest()
     try:
-        results, count = parse_search_results(output, query, case_sensitive, html=False)
-    except RegexError as e:
-        error = e.message
+        scope = get_scope(request.GET)
+        deadline = Deadline(get_search_timeout(request))
+    except (ValueError, ScopeError):
+        return HttpResponseBadRequest()
+
+    stats = SearchStats('commits_json', case_sensitive, query, scope)
+    try:
+        commits, count, truncated = run_commit_search(query, case_sensitive, scope, deadline, stats)
+    except SearchBusyError as e:
+        stats.send('busy')
+        return render_busy_json(e)
+    except COMMIT_SEARCH_ERRORS as e:
+        error, outcome = commit_search_error(e)
+        stats.send(outcome)
+        return render_json({'error': error}, status_code=500)
+
+    stats.results, stats.truncated = count, truncated
+    with stats.timed('render'):
+        response = render_json({'results': commits, 'count': count, 'truncated': truncated,
+                                'timed_out': deadline.expired, 'error': None})
+    stats.send('timed_out' if deadline.expired else 'ok')
+    return response
+
+
+def run_commit_search(query, case_sensitive, scope, deadline, stats):
+    # a slot per shard's csearch, like code searches
+    with search_slot(count=len(get_commit_shards(scope))):
+        return search_commits(query, case_sensitive, scope, deadline, stats=stats)
+
+
+def commit_search_error(e):
+    """
+    Returns the message and outcome to show for one of COMMIT_SEARCH_ERRORS.
+    """
+    if isinstance(e, CommitSearchError):
+        log.error('problem executing csearch: %s', e)
+        return E_UNABLE_TO_SEARCH, 'error'
+    if isinstance(e, SearchBusyError):
+        return str(e), 'busy'
+    return str(e), 'error'
 
-    return render_json({'results': results, 'count': count, 'error': error})
+
+def get_page_size(request):
+    page_size = int(request.GET.get('page_size', PAGE_SIZE))
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def get_context_size(request):
+    """
+    Returns how many lines of context to show before and after each match,
+    from the grep-like context, before and after parameters.
+    """
+    context = int(request.GET.get('context') or 0)
+    before = int(request.GET.get('before') or context)
+    after = int(request.GET.get('after') or context)
+    return max(0, min(before, MAX_CONTEXT_LINES)), max(0, min(after, MAX_CONTEXT_LINES))
+
+
+def get_search_timeout(request):
+    """
+    Returns how many seconds a search may run for, from the timeout parameter.
+    """
+    timeout = float(request.GET.get('timeout') or SEARCH_TIMEOUT)
+    if not timeout > 0:
+        raise ValueError('invalid timeout: %s' % timeout)
+    return min(timeout, MAX_SEARCH_TIMEOUT)
 
 
 def render_json(data, status_code=200):
-    return HttpResponse(json.dumps({'data': data}), content_type="application/json", status=status_code)
+    return HttpResponse(json.dumps({'data': data}, default=encode_json), content_type="application/json",
+                        status=status_code)
+
+
+def render_busy_json(e):
+    response = render_json({'error': str(e), 'busy': True}, status_code=503)
+    response['Retry-After'] = BUSY_RETRY_AFTER
+    return response
+
+
+def paginate_search(query, case_sensitive, cursor, page_size, html=True, scope=None, deadline=None, stats=None):
+    """
+    Returns a Page of page_size results, starting at cursor (or at the first
+    result when cursor is None). See ui.pagination.
+
+    The partial results of a search that timed out are spooled too, so that
+    its pages stay consistent, but a new search runs it again.
+    """
+    generation, offset, key, spool, matches = lookup_page(query, case_sensitive, cursor, page_size, html, scope, stats)
+    if matches is None:
+        spool, matches = spooled_search(query, case_sensitive, html, generation, scope, deadline, stats)
+        matches = matches[offset:offset + page_size]
+    return make_page(generation, offset, spool, matches)
+
+
+def lookup_page(query, case_sensitive, cursor, page_size, html=True, scope=None, stats=None):
+    """
+    Looks for a page of results in the spool of an earlier search. Returns
+    (generation, offset, spool key, spool, matches), where matches is None
+    if the search has to be run (again).
+    """
+    generation = get_index_generation()
+    offset = 0
+    if cursor:
+        cursor_generation, offset = decode_cursor(cursor)
+        if cursor_generation != generation:
+            raise CursorError('the code was re-indexed since this search started, please search again.')
+
+    cache = caches['search']
+    key = search_cache_key(query, case_sensitive, 'html' if html else 'json', generation, scope)
+    spool = cache.get(key)
+    if spool is not None and spool.get('timed_out') and not cursor:
+        spool = None
+    matches = read_spool(cache, key, spool, offset, page_size) if spool is not None else None
+    if matches is not None and stats is not None:
+        stats.cached = True
+    return generation, offset, key, spool, matches
+
+
+def read_search(cache, key):
+    """
+    Returns the spool and every match of a search from the search cache, or
+    None if it isn't there, timed out or had chunks evicted.
+    """
+    spool = cache.get(key)
+    if spool is None or spool.get('timed_out'):
+        return None
+    matches = read_spool(cache, key, spool, 0, spool['count'])
+    return None if matches is None else (spool, matches)
+
+
+def write_search(cache, key, results, truncated, deadline):
+    """
+    Spools the results of a search into the search cache. The partial
+    results of one that ran past its deadline are only kept for as long as
+    cursors need them.
+    """
+    timed_out = deadline is not None and deadline.expired
+    if timed_out:
+        log.info('search timed out after %.1f seconds, returning partial results', deadline.timeout)
+    timeout = SEARCH_CURSOR_TIMEOUT if timed_out else DEFAULT_TIMEOUT
+    return write_spool(cache, key, results, truncated, timeout, timed_out)
+
+
+def make_page(generation, offset, spool, matches):
+    results, _, _ = group_search_results(matches)
+    next_offset = offset + len(matches)
+    next_cursor = encode_cursor(generation, next_offset) if next_offset < spool['count'] else None
+    return Page(results, spool['count'], spool['truncated'], offset, len(matches), next_cursor,
+                spool.get('timed_out', False))
+
+
+def cached_search(query, case_sensitive=True, html=True, generation=None, scope=None, deadline=None, stats=None,
+                  wait=True):
+    """
+    search_and_group() behind the search cache. Returns
+    (results, count, truncated). See spooled_search().
+    """
+    spool, matches = spooled_search(query, case_sensitive, html, generation, scope, deadline, stats, wait)
+    results, count, _ = group_search_results(matches)
+    return results, count, spool['truncated']
+
+
+def spooled_search(query, case_sensitive=True, html=True, generation=None, scope=None, deadline=None, stats=None,
+                   wait=True):
+    """
+    Runs a search unless it's in the search cache, which is shared by all of
+    the webapp's processes. Searches are only stored spooled (see
+    ui.pagination), and keyed by the index generation, so they are never
+    served once cron/index.sh has built a new index. Returns the spool and
+    every match in order.
+
+    On a miss, the search waits for the same search if it is already running
+    anywhere (and then uses its cached results), and for a free search slot
+    otherwise. Raises SearchBusyError if either takes too long, or right
+    away if wait is False.
+
+    The partial results of a search that ran past its deadline are returned
+    but not served to later searches.
+    """
+    if generation is None:
+        generation = get_index_generation()
+    key = search_cache_key(query, case_sensitive, 'html' if html else 'json', generation, scope)
+    cache = caches['search']
+    found = read_search(cache, key)
+    if found is not None:
+        log.info('search cache hit')
+        if stats is not None:
+            stats.cached = True
+        return found
+
+    timeout = None if wait else 0
+    with singleflight(key, timeout):
+        found = read_search(cache, key)
+        if found is not None:
+            log.info('search coalesced with an identical one')
+            if stats is not None:
+                stats.cached = True
+            return found
+        with search_slot(timeout=timeout, count=search_processes(scope)):
+            results, _, truncated = search_and_group(query, case_sensitive, html, scope=scope, deadline=deadline,
+                                                     stats=stats)
+        return write_search(cache, key, results, truncated, deadline)
+
+
+def search_cache_key(query, case_sensitive, fmt, generation, scope=None):
+    params = json.dumps([RESULTS_VERSION, query, case_sensitive, fmt, generation, MAX_RESULTS, SEARCH_BACKEND, scope])
+    return 'search:' + hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+
+def search_processes(scope=None):
+    """
+    Returns how many search slots (see ui.admission) a search takes: one
+    per csearch process, i.e. per shard it searches. The in-process index
+    searches its shards in the thread that iterates its results.
+    """
+    if SEARCH_BACKEND == 'index':
+        return 1
+    return len(get_shards(scope))
+
+
+def search_and_group(query, case_sensitive=True, html=True, max_results=MAX_RESULTS, scope=None, deadline=None,
+                     stats=None):
+    """
+    Runs the whole search pipeline: csearch output is parsed and grouped as
+    it is read, and csearch is killed as soon as max_results is reached.
+    Returns (results, count, truncated).
+    """
+    lines = do_search(query, case_sensitive, scope, deadline, stats=stats)
+    return group_search_results(iter_search_results(lines, query, case_sensitive, html, stats), max_results)
+
+
+def do_search(query: str, case_sensitive=True, scope=None, deadline=None, stats=None):
+    """
+    Runs csearch against every index shard concurrently and yields the
+    output one line at a time, as it is produced, merged so that lines stay
+    in repo order across shards. If the caller stops iterating early (e.g.
+    because it has enough results) the csearch processes are killed rather
+    than left to run to completion.
+
+    A scope (see ui.scope) limits the search to the shards it covers, and
+    to the files in it within those shards.
+
+    With a deadline (see ui.deadline) the csearch processes are killed when
+    it passes, and the lines read until then are all that's yielded.
+
+    The time spent waiting for output and its size are added to stats (see
+    ui.metrics).
+
+    With SEARCH_BACKEND = 'index' the shards are searched in-process instead
+    (see ui.engine), which yields lines in the same format.
+    """
+    shards = get_shards(scope)
+    file_re = file_regex(scope, CODE_ROOT)
+    if SEARCH_BACKEND == 'index':
+        shard_lines = [do_index_search(shard, query, case_sensitive, file_re, deadline) for shard in shards]
+        yield from merge_shard_lines([timed_lines(lines, stats) for lines in shard_lines])
+        return
+
+    if deadline is not None and deadline.check():
+        # e.g. it ran out waiting for a search slot
+        return
+
+    cmd = csearch_command(query, case_sensitive, file_re)
+    log.info('cmd = %s, shards = %d', cmd, len(shards))
+
+    # every process is started before any output is read so the shards are
+    # all searched at the same time. each gets its own process group, so
+    # that stopping it stops anything it runs too
+    procs = []
+    try:
+        for shard in shards:
+            procs.append(Popen(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8', errors='replace',
+                               env=dict(os.environ, CSEARCHINDEX=shard), start_new_session=True))
+    except OSError as e:
+        stop_csearch(procs)
+        raise CSearchMissingError(e)
+
+    # killing csearch at the deadline ends its output, which ends the merge
+    watch = deadline.watch(lambda: kill_csearch(procs)) if deadline is not None else nullcontext()
+    try:
+        with watch:
+            yield from merge_shard_lines([timed_lines(read_lines(p), stats) for p in procs])
+    finally:
+        errors = stop_csearch(procs)
 
+    if deadline is not None and deadline.expired:
+        log.info('csearch stopped at the search deadline')
+        return
 
-def do_search(query: str, case_sensitive=True) -> str:
-    # this is extremely important security code here, this
-    # prevents shell code injection
-    safe_query = pipes.quote(query)
+    for p, err in zip(procs, errors):
+        log.info('csearch return code = %d', p.returncode)
+        if p.returncode > 1: # not zero, see the source for csearch
+            raise CSearchMissingError(err)
 
-    case_arg = '' if case_sensitive else '-i'
-    executable = path.join(BIN_PATH, 'csearch')
-    cmd = '%s -n %s %s' % (executable, case_arg, safe_query)
-    log.info('cmd = %s', cmd)
 
-    p = Popen([cmd], stdout=PIPE, stderr=PIPE, shell=True, encoding='utf-8')
-    out, err = p.communicate()
-    log.info('csearch return code = %d', p.returncode)
-    if p.returncode > 1: # not zero, see the source for csearch
-        raise CSearchMissingError(err)
+def csearch_command(query, case_sensitive=True, file_re=None):
+    # the query is passed as a single argument and no shell is involved,
+    # which is what prevents shell code injection here. '--' keeps
+    # queries that start with a dash from being read as flags.
+    case_args = [] if case_sensitive else ['-i']
+    file_args = [] if file_re is None else ['-f', file_re]
+    return [path.join(BIN_PATH, 'csearch'), '-n'] + case_args + file_args + ['--', query]
 
-    return out
 
+def read_lines(p):
+    for line in p.stdout:
+        yield line.rstrip('\n')
 
-def prepare_source_line(query_re, srcline, html=True):
-    if html:
-        # important!!! escape src manually here to avoid our own markup we
-        # might have in source code from not showing up properly in code
-        # search reuslts. in the django template we mark this value as
-        # safe, which disables escaping to allow us to render the searched
-        # term as highlighted in the search results.
-        srcline = escape(srcline)
-        # highlight the text that we matched on to make it easy to see in the UI
-        srcline = query_re.sub(HIGHLIGHT_QUERY_TEMPLATE, srcline)
 
-    return srcline
+def timed_lines(lines, stats=None):
+    if stats is None:
+        return lines
+    return _timed_lines(lines, stats)
 
 
-def get_query_re(query, case_sensitive=True):
+def _timed_lines(lines, stats):
     try:
-        if case_sensitive:
-            return re.compile(r'(' + re.escape(query) + r')')
-        else:
-            return re.compile(r'(' + re.escape(query) + r')', flags=re.IGNORECASE)
-    except Exception as e:
+        while True:
+            s = time.perf_counter()
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            finally:
+                stats.add('csearch', time.perf_counter() - s)
+            stats.bytes += len(line) + 1
+            yield line
+    finally:
+        close_iter(lines)
+
+
+def stop_csearch(procs):
+    if any(p.poll() is None for p in procs):
+        log.info('stopping csearch early')
+        kill_csearch(procs)
+    return [p.communicate()[1] for p in procs]
+
+
+def kill_csearch(procs):
+    for p in procs:
+        if p.poll() is None:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # exited in the meantime
+                pass
+
+
+def merge_shard_lines(shard_lines):
+    """
+    Merges the output of several shards into one stream ordered by repo.
+    Each shard's lines are already ordered by path, and shards hold whole
+    orgs (or groups of repos within one), so an n-way merge on the repo
+    keeps each repo's lines together and in the order a single index would
+    have produced them.
+    """
+    if len(shard_lines) == 1:
+        return shard_lines[0]
+    return heapq.merge(*shard_lines, key=shard_line_key)
+
+
+def shard_line_key(line):
+    fully_qualified_filename = line.split(':', 1)[0]
+    parts = fully_qualified_filename[len(CODE_ROOT):].lstrip('/').split('/', 3)
+    if len(parts) < 4:
+        return '', '', fully_qualified_filename
+    vcs_loc, orgname, reponame, rel_file_path = parts
+    # with the trailing slash, repos compare the same way their paths do,
+    # e.g. 'org/repo-x/' before 'org/repo/'
+    return '%s/%s/' % (orgname, reponame), vcs_loc, rel_file_path
+
+
+def do_index_search(index_file, query, case_sensitive=True, file_re=None, deadline=None):
+    try:
+        yield from engine.search(index_file, query, case_sensitive, file_re, deadline)
+    except re.error as e:
         raise RegexError(e)
+    except OSError as e:
+        # no index to search
+        raise CSearchMissingError(e)
+
+
+def prepare_source_line(query_re, srcline, html=True):
+    if html:
+        return highlight(srcline, match_spans(query_re, srcline))
+    return srcline
 
 
-def parse_search_results(result_text: str, query: str, case_sensitive=True, html=True):
-    query_re = get_query_re(query, case_sensitive)
-    lines = filter(lambda l: l != '', result_text.split('\n'))
-    results, count = {}, 0
+def match_spans(query_re, srcline):
+    """
+    Returns the [start, end) offsets of the query's matches in a raw source
+    line, skipping empty matches (e.g. of ^ or a*).
+    """
+    return [[m.start(), m.end()] for m in query_re.finditer(srcline) if m.end() > m.start()]
+
+
+def highlight(srcline, spans):
+    """
+    Renders a source line as html with its matches highlighted, in one pass.
+    """
+    # important!!! escape src manually here to avoid our own markup we
+    # might have in source code from not showing up properly in code
+    # search reuslts. in the django template we mark this value as
+    # safe, which disables escaping to allow us to render the searched
+    # term as highlighted in the search results.
+    out, pos = [], 0
+    for start, end in spans:
+        out.append(escape(srcline[pos:start]))
+        out.append(HIGHLIGHT_QUERY_TEMPLATE % escape(srcline[start:end]))
+        pos = end
+    out.append(escape(srcline[pos:]))
+    return ''.join(out)
+
+
+@lru_cache(maxsize=QUERY_RE_CACHE_SIZE)
+def get_query_re(query, case_sensitive=True):
+    """
+    Compiles the query into the regex csearch matched lines with. csearch
+    uses RE2 syntax, which python's re mostly shares; queries it can't
+    compile are highlighted as plain text instead.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    try:
+        return re.compile(query, flags)
+    except re.error as e:
+        log.info('highlighting %r as plain text: %s', query, e)
+        return re.compile(re.escape(query), flags)
+
+
+def parse_search_results(output, query: str, case_sensitive=True, html=True):
+    """
+    Parses csearch output, either as one string or as an iterable of lines,
+    into the nested results dict. Returns (results, count).
+    """
+    if isinstance(output, str):
+        output = output.split('\n')
+    results, count, _ = group_search_results(iter_search_results(output, query, case_sensitive, html))
+    return results, count
 
-    # default_git_branches is a map of repo to default branch
-    # (sproutsocial/oak => 'main')
-    default_git_branches = {}
 
-    for line in lines:
+def iter_search_results(lines, query: str, case_sensitive=True, html=True, stats=None):
+    """
+    Parses csearch output lines lazily, yielding a
+    (fully_qualified_repo_name, vcs_loc, filename, result) tuple per match,
+    where result is a ui.results.Match. The time this takes is added to
+    stats (see ui.metrics).
+    """
+    try:
+        parser = ResultParser(query, case_sensitive, html, stats)
+        for line in lines:
+            match = parser.parse(line)
+            if match is not None:
+                yield match
+    finally:
+        close_iter(lines)
+
+
+class ResultParser(object):
+    """
+    Parses csearch output one line at a time, for iter_search_results() and
+    for the asyncio search in ui.aio.
+    """
+
+    def __init__(self, query: str, case_sensitive=True, html=True, stats=None):
+        self.query_re = get_query_re(query, case_sensitive)
+        self.html = html
+        self.stats = stats
+        self.count = 0
+        # repos is a map of (vcs_loc, repo) to the metadata of that
+        # repository, e.g. ('github', 'sproutsocial/oak') =>
+        # {'repo_type': 'git', 'default_branch': 'main', ...}
+        self.repos = {}
+        # files is a map of the paths in csearch output to the SourceFile
+        # that all of the matches in that file share
+        self.files = {}
+        s = time.perf_counter()
+        repo_metadata.refresh()
+        if stats is not None:
+            stats.add('metadata', time.perf_counter() - s)
+
+    def parse(self, line):
+        """
+        Returns a (fully_qualified_repo_name, vcs_loc, filename, result)
+        tuple, or None for lines that aren't matches.
+        """
+        if line == '':
+            return None
+        s, metadata_time = time.perf_counter(), 0
         log.debug('line=%s', line)
         fields = line.split(':', 2)  # don't split on colons that are part of source code :)
         try:
             fullpath, lineno, srcline = fields
             # codesearch's line #s are off by one
             # https://github.com/google/codesearch/issues/25
-            lineno = str(int(lineno)+1)
-            vcs_loc, fully_qualified_repo_name, filename, repo_type = get_repo_and_filepath(fullpath)
-
-            if is_vcs_folder(filename):
-                continue
+            lineno = int(lineno) + 1
+            source = self.files.get(fullpath)
+            if source is None:
+                vcs_loc, fully_qualified_repo_name, filename = split_repo_path(fullpath)
+                if (vcs_loc, fully_qualified_repo_name) not in self.repos:
+                    m = time.perf_counter()
+                    self.repos[vcs_loc, fully_qualified_repo_name] = get_repo_metadata(vcs_loc,
+                                                                                       fully_qualified_repo_name)
+                    metadata_time = time.perf_counter() - m
+                repo = self.repos[vcs_loc, fully_qualified_repo_name]
+                link, anchor = deep_link_parts(vcs_loc, fully_qualified_repo_name, filename, repo.get('repo_type'),
+                                               repo.get('default_branch'))
+                source = self.files[fullpath] = SourceFile(vcs_loc, fully_qualified_repo_name, filename, link, anchor)
+        except ValueError as e:
+            log.error('ValueError: %s (cause: %s)', fields, e)
+            return None
 
+        self.count += 1
+        spans = match_spans(self.query_re, srcline)
+        if self.html:
+            # html results have the matches marked up instead of spans
+            result = Match(source, lineno, highlight(srcline, spans), self.count)
+        else:
+            result = Match(source, lineno, srcline, self.count, spans)
+
+        if self.stats is not None:
+            self.stats.add('metadata', metadata_time)
+            self.stats.add('parse', time.perf_counter() - s - metadata_time)
+        return source.repo, source.vcs_loc, source.filename, result
+
+
+def group_search_results(matches, max_results=None):
+    """
+    Groups (fully_qualified_repo_name, vcs_loc, filename, result) tuples into
+    the nested results dict. Stops consuming matches (which in turn stops
+    csearch) once max_results have been grouped. Returns
+    (results, count, truncated).
+    """
+    results, count, truncated = {}, 0, False
+    try:
+        for fully_qualified_repo_name, vcs_loc, filename, result in matches:
+            if max_results is not None and count >= max_results:
+                truncated = True
+                break
             count += 1
 
-            if repo_type == 'git' and fully_qualified_repo_name not in default_git_branches:
-                git_dir = fullpath.split(fully_qualified_repo_name)[0] + fully_qualified_repo_name + '/.git'
-                cmd = "git --git-dir %s branch" % git_dir
-                p = Popen([cmd], stdout=PIPE, stderr=PIPE, shell=True, encoding='utf-8')
-                out, err = p.communicate()
-                if p.returncode == 0:
-                    log.debug("Default Branch for %s is %s" % (fully_qualified_repo_name, out.split(' ')[1].strip()))
-                    default_git_branches[fully_qualified_repo_name] = out.split(' ')[1].strip()
-
-            result = {
-                'filename': filename,
-                'lineno': int(lineno),
-                'srcline': prepare_source_line(query_re, srcline, html),
-                'deeplink': deep_link(vcs_loc, fully_qualified_repo_name, filename, repo_type, lineno, default_git_branches.get(fully_qualified_repo_name, None)),
-                'count': count
-            }
             if fully_qualified_repo_name not in results:
                 results[fully_qualified_repo_name] = {}
 
             if vcs_loc not in results[fully_qualified_repo_name]:
                 results[fully_qualified_repo_name][vcs_loc] = {}
-                results[fully_qualified_repo_name][vcs_loc]['files'] = OrderedDict()
+                results[fully_qualified_repo_name][vcs_loc]['files'] = {}
 
             if filename not in results[fully_qualified_repo_name][vcs_loc]['files']:
                 results[fully_qualified_repo_name][vcs_loc]['files'][filename] = []
 
             results[fully_qualified_repo_name][vcs_loc]['files'][filename].append(result)
-        except ValueError as e:
-            log.error('ValueError: %s (cause: %s)', fields, e)
+    finally:
+        close_iter(matches)
 
     # sort results -- have to because the lines are sorted lexicographically
     # but within each repository source site (bitbucket, github) due to
     # CODE_ROOT directory structure layout. we want it to be sorted
     # lexicographically across all repository sources
-    results = OrderedDict((k, results[k]) for k in sorted(results.keys()))
-    return results, count
+    results = {k: results[k] for k in sorted(results.keys())}
+    return results, count, truncated
 
 
-def is_vcs_folder(filename):
-    return filename.startswith('.hg') or filename.startswith('.git')
+def close_iter(it):
+    # generators propagate an early stop down the pipeline (and eventually to
+    # the csearch process) through close()
+    close = getattr(it, 'close', None)
+    if close is not None:
+        close()
 
 
-def get_repo_and_filepath(fully_qualified_filename):
+def split_repo_path(fully_qualified_filename):
     relpath = path.relpath(fully_qualified_filename, CODE_ROOT)
     vcs_loc, orgname, reponame, rel_file_path = relpath.split('/', 3)
-    repo_type = get_repo_type(path.join(CODE_ROOT, vcs_loc, orgname, reponame))
-    return vcs_loc, '%s/%s' % (orgname, reponame), rel_file_path, repo_type
+    return vcs_loc, '%s/%s' % (orgname, reponame), rel_file_path
+
+
+def get_repo_and_filepath(fully_qualified_filename):
+    vcs_loc, fully_qualified_repo_name, rel_file_path = split_repo_path(fully_qualified_filename)
+    repo_type = get_repo_metadata(vcs_loc, fully_qualified_repo_name).get('repo_type')
+    return vcs_loc, fully_qualified_repo_name, rel_file_path, repo_type
+
+
+def get_repo_metadata(vcs_loc, fully_qualified_repo_name):
+    """
+    Looks up a repository in the metadata written at fetch time. Searches
+    never inspect repositories on disk, ones that aren't in there (yet) get
+    the default branch of deep_link_parts.
+    """
+    metadata = repo_metadata.get(vcs_loc, fully_qualified_repo_name)
+    if metadata is not None:
+        return metadata
+    log.debug('no metadata for %s/%s', vcs_loc, fully_qualified_repo_name)
+    return {'repo_type': None, 'vcs_loc': vcs_loc, 'default_branch': None}
 
 
 def deep_link(vcs_loc, fully_qualified_repo_name, filepath, repo_type, lineno=None, git_branch=None):
+    link, anchor = deep_link_parts(vcs_loc, fully_qualified_repo_name, filepath, repo_type, git_branch)
+    return SourceFile(vcs_loc, fully_qualified_repo_name, filepath, link, anchor).deep_link(lineno)
+
+
+def deep_link_parts(vcs_loc, fully_qualified_repo_name, filepath, repo_type, git_branch=None):
+    """
+    Returns the deep link to a file, and the prefix of the anchors that link
+    to its lines.
+    """
     if vcs_loc not in ('github', 'bitbucket'):
         raise ValueError('unknown vcs location: %s' % vcs_loc)
 
@@ -217,13 +1003,7 @@ def deep_link(vcs_loc, fully_qualified_repo_name, filepath, repo_type, lineno=No
     if git_branch:
         branch = git_branch
 
-    fmt = DEEP_LINK_TEMPLATES[vcs_loc]
-    lineno_suffix_fmt = LINENO_TEMPLATES[vcs_loc]
-    src_file = path.split(filepath)[-1]
-    lineno_suffix_args = (src_file, lineno) if vcs_loc == 'bitbucket' else (lineno,)
-
     args = {'fully_qualified_repo_name': fully_qualified_repo_name, 'fpath': filepath, 'branch': branch}
-    link = fmt % args
-    link += '#' + lineno_suffix_fmt % lineno_suffix_args if lineno else ''
-
-    return link
+    link = DEEP_LINK_TEMPLATES[vcs_loc] % args
+    anchor = LINE_ANCHOR_TEMPLATES[vcs_loc] % {'src_file': path.split(filepath)[-1]}
+    return link, anchor
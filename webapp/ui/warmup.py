@@ -0,0 +1,107 @@
+"""
+Warms a new index generation up before users search it, run with
+`python manage.py warmup` by cron/index.sh after every index build and when
+the webapp starts.
+
+Right after a swap (or a restart) the shards of the current generation, and
+the repo files csearch reads to check its candidate matches, are cold on
+disk, so the first searches pay for reading them. Warming up:
+
+- prefaults every shard of the current generation into the page cache, by
+  reading it through once
+- replays the most popular searches of the query log (see ui.querylog)
+  through cached_search(), which reads the files they match and fills the
+  search cache for the new generation
+
+It runs at the lowest CPU and IO priority, and a replayed search that
+can't get a search slot is skipped rather than queued for, so it never
+slows down the searches of users.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+
+from django.http import QueryDict
+
+from codesearch.settings import SEARCH_TIMEOUT
+from ui import views
+from ui.admission import SearchBusyError
+from ui.deadline import Deadline
+from ui.index import get_index_generation
+from ui.index import get_shards
+from ui.querylog import popular_searches
+from ui.scope import ScopeError
+from ui.scope import get_scope
+
+CHUNK_SIZE = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+def lower_priority():
+    """
+    Makes this process, and the csearch processes it starts, run at idle CPU
+    and IO priority.
+    """
+    os.nice(19)
+    ionice = shutil.which('ionice')
+    if ionice is not None:
+        subprocess.call([ionice, '-c', '3', '-p', str(os.getpid())], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+
+
+def prefault(files, chunk_size=CHUNK_SIZE):
+    """
+    Reads files through once, so that they are in the page cache. Returns
+    the number of bytes read.
+    """
+    buf = bytearray(chunk_size)
+    total = 0
+    for name in files:
+        try:
+            with open(name, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    # start reading ahead the whole file while it's read
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    total += n
+        except OSError as e:
+            log.warning('unable to prefault %s: %s', name, e)
+    return total
+
+
+def prefault_index():
+    """
+    Prefaults the shards of the current index generation.
+    """
+    return prefault(get_shards())
+
+
+def replay(searches, generation=None):
+    """
+    Runs searches (see ui.querylog.popular_searches) against the given index
+    generation, the current one by default, so their results are cached.
+    Returns the number of searches run, those already cached included.
+    """
+    if generation is None:
+        generation = get_index_generation()
+    replayed = 0
+    for s in searches:
+        try:
+            scope = get_scope(QueryDict(s['scope']))
+            views.cached_search(s['query'], s['case_sensitive'], s['html'], generation, scope,
+                                Deadline(SEARCH_TIMEOUT), wait=False)
+        except SearchBusyError:
+            log.info('skipped replaying %r, the server is busy', s['query'])
+            continue
+        except (views.RegexError, views.CSearchMissingError, ScopeError) as e:
+            log.warning('unable to replay %r: %s', s['query'], e)
+            continue
+        replayed += 1
+    return replayed
+